@@ -0,0 +1,609 @@
+"""
+asyncio engine for the bridge, selected with `engine: asyncio` in config.yaml .
+
+XMPP is handled by slixmpp and Matrix messages are sent with aiohttp, all on a single event loop.
+BridgeBot's handlers are unchanged and still run on the dispatcher's worker threads; Matrix
+ messages they send are handed to the event loop and sent without waiting for the homeserver,
+ so many sends can be in flight at once (in order within each room).
+
+Requires the slixmpp and aiohttp packages.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import signal
+import threading
+import time
+from typing import Callable, Dict
+from urllib.parse import quote
+
+import aiohttp
+import slixmpp
+from slixmpp.exceptions import IqError, IqTimeout
+from slixmpp.xmlstream.handler import Callback
+from slixmpp.xmlstream.matcher import MatchXPath
+
+from matrix_client.api import MatrixHttpApi, MATRIX_V2_API_PATH
+from matrix_client.errors import MatrixRequestError
+from mxpp.client_matrix import ClientMatrix
+from mxpp.main import BridgeBot, CONFIG_FILE
+from mxpp.outbound import OutboundSender
+from mxpp.provision import retry_after
+from mxpp.mam import MamCollector, QUERY_TIMEOUT, RESULT_XPATH
+from mxpp.roster import RosterItem, preload_roster
+from mxpp.scheduling import ClassedBuffer
+from mxpp.supervisor import Backoff
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a roster or session start requested from outside the event loop
+XMPP_TIMEOUT = 60
+# Seconds to let in-flight Matrix sends finish during shutdown
+SHUTDOWN_GRACE = 10
+
+
+def in_loop(loop: asyncio.AbstractEventLoop) -> bool:
+    """
+    :return: True if called from the thread which is running the given event loop.
+    """
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class LoopQueue:
+    """
+    Queue backed by a ClassedBuffer, which may be put() to from any thread and awaited on the event loop.
+    """
+    buffer = None   # type: ClassedBuffer
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, buffer: ClassedBuffer):
+        self.loop = loop
+        self.buffer = buffer
+        self.ready = asyncio.Event()
+
+    def put(self, item):
+        self.buffer.push(item)
+        if in_loop(self.loop):
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def get(self):
+        while True:
+            found, item = self.buffer.pop()
+            if found:
+                return item
+            self.ready.clear()
+            await self.ready.wait()
+
+    def qsize(self) -> int:
+        return len(self.buffer)
+
+    def stats(self) -> Dict[str, int]:
+        return self.buffer.stats()
+
+    def close(self):
+        self.buffer.close()
+
+
+class AsyncClientXMPP(slixmpp.ClientXMPP):
+    """
+    slixmpp counterpart of mxpp.client_xmpp.ClientXMPP .
+
+    Methods which send stanzas may be called from any thread; they are forwarded to the event loop.
+    """
+    roster_dict = {}            # type: Dict[str, str]
+    jid_nick_map = {}           # type: Dict[str, str]
+    inbound_queue = None        # type: LoopQueue
+    accept_message = None       # type: Callable[[object], bool]
+
+    def __init__(self,
+                 inbound_queue: LoopQueue,
+                 jid: str,
+                 password: str,
+                 auto_authorize: bool=True,
+                 auto_subscribe: bool=True,
+                 roster: Dict[str, RosterItem]=None,
+                 roster_version: str=None,
+                 accept_message: Callable[[object], bool]=None):
+        """
+        :param roster: Roster stored by a previous run, if any
+        :param roster_version: Version of `roster`; roster requests only ask the server for
+            changes since this version (XEP-0237).
+        :param accept_message: Called with each inbound message before it is queued; the message
+            is dropped if it returns False.
+        """
+        self.inbound_queue = inbound_queue
+        self.accept_message = accept_message
+        self.session_started = threading.Event()
+        self.mam = MamCollector()
+
+        slixmpp.ClientXMPP.__init__(self, jid, password)
+
+        self.add_event_handler('session_start', self.handle_session_start)
+        self.add_event_handler('disconnected', self.handle_disconnected)
+        self.add_event_handler('roster_update', self.inbound_queue.put)
+        self.add_event_handler('presence_available', self.inbound_queue.put)
+        self.add_event_handler('presence_unavailable', self.inbound_queue.put)
+        self.add_event_handler('message', self.handle_message)
+        self.add_event_handler('groupchat_message', self.handle_groupchat_message)
+        # MAM results have no <body/>, so never reach handle_message
+        self.register_handler(Callback('MAM result', MatchXPath(RESULT_XPATH), self.mam.deliver))
+
+        self.register_plugin('xep_0030')  # Service Discovery
+        self.register_plugin('xep_0004')  # Data Forms
+        self.register_plugin('xep_0060')  # PubSub
+        self.register_plugin('xep_0199')  # XMPP Ping
+        self.register_plugin('xep_0045')  # Multi-User Chats (MUC)
+
+        # Newer slixmpp versions only provide the snake_case names
+        muc = self.plugin['xep_0045']
+        if not hasattr(muc, 'joinMUC'):
+            muc.joinMUC = muc.join_muc
+            muc.leaveMUC = muc.leave_muc
+
+        self.auto_authorize = auto_authorize
+        self.auto_subscribe = auto_subscribe
+        preload_roster(self.client_roster, roster or {}, roster_version)
+
+    def send_query(self, query, to: str=None, itype: str='set', timeout: float=QUERY_TIMEOUT):
+        """
+        Send a query in an <iq/> and wait for the result. Must not be called from
+         the event loop.
+
+        :param query: Query element
+        :param to: JID to send the query to, or None for our own account
+        :param itype: Type of the <iq/>, 'set' or 'get'
+        :param timeout: Seconds to wait for the result
+        :return: The <iq/> result; raises IqError or IqTimeout otherwise.
+        """
+        iq = self.make_iq_set(query, ito=to)
+        iq['type'] = itype
+        future = asyncio.run_coroutine_threadsafe(self._send_iq(iq, timeout), self.loop)
+        return future.result()
+
+    async def _send_iq(self, iq, timeout: float):
+        return await iq.send(timeout=timeout)
+
+    def handle_message(self, message):
+        if self.mam.is_result(message):
+            return
+        self.handle_groupchat_message(message)
+
+    def handle_groupchat_message(self, message):
+        if self.accept_message is not None and not self.accept_message(message):
+            return
+        self.inbound_queue.put(message)
+
+    def request_full_roster(self):
+        """
+        Request the whole roster, rather than only the changes since the last version we have.
+        """
+        self.client_roster.version = ''
+        return self.get_roster()
+
+    def on_loop(self) -> bool:
+        return in_loop(self.loop)
+
+    def call_on_loop(self, func: Callable, *args):
+        if self.on_loop():
+            return func(*args)
+        self.loop.call_soon_threadsafe(functools.partial(func, *args))
+
+    def send(self, data, *args, **kwargs):
+        self.call_on_loop(functools.partial(slixmpp.ClientXMPP.send, self, data, *args, **kwargs))
+
+    def send_raw(self, data):
+        self.call_on_loop(functools.partial(slixmpp.ClientXMPP.send_raw, self, data))
+
+    def disconnect(self, *args, **kwargs):
+        self.call_on_loop(functools.partial(slixmpp.ClientXMPP.disconnect, self, *args, **kwargs))
+
+    def get_roster(self, block: bool=False, **kwargs):
+        """
+        Request the roster. May be called from any thread.
+
+        :param block: If True (and not called from the event loop), wait for the roster to arrive.
+        :return: A future for the roster request.
+        """
+        if self.on_loop():
+            return slixmpp.ClientXMPP.get_roster(self, **kwargs)
+
+        future = asyncio.run_coroutine_threadsafe(self._get_roster(**kwargs), self.loop)
+        if block:
+            future.result(XMPP_TIMEOUT)
+        return future
+
+    async def _get_roster(self, **kwargs):
+        return await slixmpp.ClientXMPP.get_roster(self, **kwargs)
+
+    async def handle_session_start(self, _event):
+        try:
+            self.send_presence()
+            await slixmpp.ClientXMPP.get_roster(self)
+        except IqError as err:
+            logger.error('There was an error getting the roster')
+            logger.error(err.iq['error']['condition'])
+            self.disconnect()
+        except IqTimeout:
+            logger.error('Server is taking too long to respond')
+            self.disconnect()
+
+        logger.info('XMPP Logged in!')
+        self.session_started.set()
+
+    def handle_disconnected(self, _event):
+        logger.info('XMPP Disconnected!')
+
+
+class AsyncMatrixHttpApi(MatrixHttpApi):
+    """
+    MatrixHttpApi which sends message events with aiohttp on the event loop instead of blocking.
+
+    send_message_event() may be called from any thread and returns immediately. Events for the
+     same room are sent in the order they were submitted; up to `max_in_flight` events (across
+     all rooms) are sent at once. All other requests still use the blocking implementation.
+    """
+    error_handler = None        # type: Callable[[Exception], None]
+    response_callback = None    # type: Callable[[str, str, int], None]
+
+    def __init__(self,
+                 base_url: str,
+                 token: str=None,
+                 loop: asyncio.AbstractEventLoop=None,
+                 max_in_flight: int=32,
+                 max_retries: int=8,
+                 error_handler: Callable[[Exception], None]=None,
+                 response_callback: Callable[[str, str, int], None]=None):
+        MatrixHttpApi.__init__(self, base_url, token)
+        self.loop = loop
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.failed = 0
+        self.error_handler = error_handler
+        self.response_callback = response_callback
+
+        self.session = None         # type: aiohttp.ClientSession
+        self.in_flight = None       # type: asyncio.Semaphore
+        self.room_locks = {}        # type: Dict[str, asyncio.Lock]
+        self.tasks = set()
+        self.txn_ids = itertools.count()
+        self.prefetched_sync = None
+
+    def _make_async_txn_id(self) -> str:
+        return 'mxpp{}.{}'.format(int(time.time() * 1000), next(self.txn_ids))
+
+    async def request(self, method: str, path: str, content: Dict=None, query_params: Dict=None,
+                      api_path: str=MATRIX_V2_API_PATH) -> Dict:
+        """
+        Make a request to the homeserver, waiting and retrying when rate-limited.
+
+        :return: Decoded JSON response
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        url = self.base_url + api_path + path
+        headers = {'Authorization': 'Bearer {}'.format(self.token)}
+        ssl = None if getattr(self, 'validate_cert', True) else False
+
+        while True:
+            async with self.session.request(method, url, json=content, params=query_params,
+                                            headers=headers, ssl=ssl) as response:
+                text = await response.text()
+                if self.response_callback is not None:
+                    self.response_callback(method, api_path + path, response.status)
+                if response.status == 429:
+                    delay = retry_after(MatrixRequestError(response.status, text))
+                    logger.warning('Rate limited on {} {}, retrying in {}s'.format(method, path, delay))
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status < 200 or response.status >= 300:
+                    raise MatrixRequestError(code=response.status, content=text)
+                return await response.json(content_type=None)
+
+    def send_message_event(self, room_id: str, event_type: str, content: Dict,
+                           txn_id: str=None, timestamp: int=None, on_done: Callable[[], None]=None,
+                           user_id: str=None) -> Dict:
+        """
+        :param on_done: Called (on the event loop) once the homeserver has accepted the event, or
+            permanently rejected it; see OutboundSender.send .
+        :param user_id: Application service user to send as, or None to send as ourselves
+        """
+        if txn_id is None:
+            txn_id = self._make_async_txn_id()
+        path = '/rooms/{}/send/{}/{}'.format(quote(room_id), quote(event_type), quote(txn_id))
+        query_params = {}
+        if timestamp:
+            query_params['ts'] = timestamp
+        if user_id is not None:
+            query_params['user_id'] = user_id
+        query_params = query_params or None
+
+        self.loop.call_soon_threadsafe(self._start_send, room_id, path, content, query_params, on_done)
+        return {'txn_id': txn_id}
+
+    def _start_send(self, room_id: str, path: str, content: Dict, query_params: Dict or None,
+                    on_done: Callable[[], None] or None):
+        # Runs on the event loop, so tasks for each room are created (and queue on its lock) in order
+        task = asyncio.ensure_future(self._send_event(room_id, path, content, query_params, on_done))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send_event(self, room_id: str, path: str, content: Dict, query_params: Dict or None,
+                          on_done: Callable[[], None] or None):
+        lock = self.room_locks.setdefault(room_id, asyncio.Lock())
+        try:
+            async with lock:
+                if self.in_flight is None:
+                    self.in_flight = asyncio.Semaphore(self.max_in_flight)
+                async with self.in_flight:
+                    await self._put_with_retries(path, content, query_params)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error('Failed to send event to {}: {}'.format(room_id, e))
+            self.failed += 1
+            if self.error_handler is not None:
+                self.error_handler(e)
+            # As in OutboundSender, only a permanent rejection finishes with the event; otherwise
+            #  its journal entry is left for the next startup to replay
+            if not isinstance(e, MatrixRequestError) or e.code >= 500:
+                return
+
+        if on_done is not None:
+            on_done()
+
+    async def _put_with_retries(self, path: str, content: Dict, query_params: Dict or None):
+        # The transaction ID is part of the path, so retrying can't post the event twice
+        backoff = Backoff(maximum=60.0)
+        for attempt in itertools.count():
+            try:
+                return await self.request('PUT', path, content, query_params)
+            except (MatrixRequestError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries or (isinstance(e, MatrixRequestError) and e.code < 500):
+                    raise
+                delay = backoff.next()
+                logger.warning('Failed to send {} ({}), retrying in {:.1f}s'.format(path, e, delay))
+                await asyncio.sleep(delay)
+
+    async def async_sync(self, since: str=None, timeout_ms: int=30000, filter: str=None) -> Dict:
+        query_params = {'timeout': int(timeout_ms)}
+        if since is not None:
+            query_params['since'] = since
+        if filter is not None:
+            query_params['filter'] = filter
+        return await self.request('GET', '/sync', query_params=query_params)
+
+    def sync(self, *args, **kwargs) -> Dict:
+        # Lets MatrixClient._sync process a response which was fetched by async_sync
+        if self.prefetched_sync is not None:
+            response, self.prefetched_sync = self.prefetched_sync, None
+            return response
+        return MatrixHttpApi.sync(self, *args, **kwargs)
+
+    async def close(self, grace: float=SHUTDOWN_GRACE):
+        """
+        Wait up to `grace` seconds for in-flight sends, cancel the rest, and close the session.
+        """
+        if self.tasks:
+            _done, pending = await asyncio.wait(list(self.tasks), timeout=grace)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning('Dropped {} unsent Matrix events on shutdown'.format(len(pending)))
+                await asyncio.gather(*pending, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncOutboundSender(OutboundSender):
+    """
+    OutboundSender which hands events to AsyncMatrixHttpApi, to be sent on the event loop.
+    """
+    api = None      # type: AsyncMatrixHttpApi
+
+    def __init__(self, api: AsyncMatrixHttpApi):
+        self.api = api
+
+    @property
+    def failed(self) -> int:
+        return self.api.failed
+
+    def send(self, room_id: str, content: Dict, event_type: str='m.room.message',
+             on_done: Callable[[], None]=None, user_id: str=None) -> str:
+        return self.api.send_message_event(room_id, event_type, content, on_done=on_done, user_id=user_id)['txn_id']
+
+    def queue_depth(self) -> int:
+        return len(self.api.tasks)
+
+    def shutdown(self, grace: float=SHUTDOWN_GRACE):
+        # In-flight events are waited for by AsyncMatrixHttpApi.close()
+        pass
+
+
+class AsyncClientMatrix(ClientMatrix):
+    """
+    ClientMatrix which syncs on the event loop and sends messages through AsyncMatrixHttpApi.
+    """
+    api = None      # type: AsyncMatrixHttpApi
+
+    def __init__(self, *args,
+                 loop: asyncio.AbstractEventLoop=None,
+                 max_in_flight: int=32,
+                 max_retries: int=8,
+                 error_handler: Callable[[Exception], None]=None,
+                 **kwargs):
+        ClientMatrix.__init__(self, *args, **kwargs)
+        blocking_api = self.api
+        self.api = AsyncMatrixHttpApi(blocking_api.base_url, blocking_api.token,
+                                      loop=loop,
+                                      max_in_flight=max_in_flight,
+                                      max_retries=max_retries,
+                                      error_handler=error_handler,
+                                      response_callback=self.response_callback)
+        self.api.validate_cert = blocking_api.validate_cert
+
+    async def listen(self, timeout_ms: int=30000, bad_sync_timeout: int=5):
+        """
+        Sync forever. Events are processed (and listeners called) on a worker thread,
+         so blocking listeners don't stall the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        backoff = bad_sync_timeout
+        while True:
+            try:
+                response = await self.api.async_sync(self.sync_token, timeout_ms, self.sync_filter)
+                backoff = bad_sync_timeout
+            except MatrixRequestError as e:
+                if e.code < 500:
+                    raise
+                logger.warning('Sync failed with {}, retrying in {}s'.format(e.code, backoff))
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            await loop.run_in_executor(None, self.process_sync, response)
+
+    def process_sync(self, response: Dict):
+        self.api.prefetched_sync = response
+        self._sync()
+
+
+class AsyncBridgeBot(BridgeBot):
+    """
+    BridgeBot running on an asyncio event loop. Construct it outside the event loop
+     (e.g. with loop.run_in_executor), then await run().
+    """
+    xmpp_stanzas = slixmpp
+    loop = None             # type: asyncio.AbstractEventLoop
+    inbound_xmpp = None     # type: LoopQueue
+    matrix = None           # type: AsyncClientMatrix
+    xmpp = None             # type: AsyncClientXMPP
+
+    transient_errors = BridgeBot.transient_errors + (IqError, IqTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, config_file: str=CONFIG_FILE):
+        self.loop = loop
+        # slixmpp and asyncio.Queue look up the event loop when they are created
+        asyncio.set_event_loop(loop)
+        BridgeBot.__init__(self, config_file)
+
+    def create_inbound_queue(self) -> LoopQueue:
+        return LoopQueue(self.loop, self.create_inbound_buffer())
+
+    def create_matrix(self) -> AsyncClientMatrix:
+        return AsyncClientMatrix(sync_callback=self.save_sync_token,
+                                 response_callback=self.record_matrix_response,
+                                 loop=self.loop,
+                                 max_in_flight=self.async_max_in_flight,
+                                 max_retries=self.outbound_options.get('max_retries', 8),
+                                 error_handler=self.handle_handler_exception,
+                                 **self.matrix_server)
+
+    def create_outbound(self) -> AsyncOutboundSender:
+        return AsyncOutboundSender(self.matrix.api)
+
+    def create_xmpp(self) -> AsyncClientXMPP:
+        return AsyncClientXMPP(self.inbound_xmpp,
+                               roster=self.roster_items,
+                               roster_version=self.roster_version,
+                               accept_message=self.journal_received_message,
+                               **self.xmpp_login,
+                               **self.xmpp_roster_options)
+
+    def start_xmpp(self):
+        host, port = self.xmpp_server
+        self.loop.call_soon_threadsafe(functools.partial(self.xmpp.connect, (host, port)))
+        if not self.xmpp.session_started.wait(XMPP_TIMEOUT):
+            raise Exception('Timed out waiting for XMPP session to start')
+
+    def start_matrix_listener(self):
+        # Syncing is started by run(); the appservice listener has its own thread
+        if self.appservice_options.get('enabled', False):
+            BridgeBot.start_matrix_listener(self)
+
+    def restart_xmpp(self, _error: Exception):
+        if not self.xmpp_connected:
+            self.xmpp.call_on_loop(self.xmpp.reconnect)
+
+    async def listen_matrix(self):
+        """
+        Run the Matrix listener, restarting it after a backoff (and logging in again if our
+         access token was rejected) when it fails with a transient error.
+        """
+        backoff = Backoff(**self.reconnect_backoff)
+        relogin = False
+        while True:
+            try:
+                if relogin:
+                    await self.loop.run_in_executor(None, self.matrix.password_login,
+                                                    self.matrix_login['username'], self.matrix_login['password'])
+                    relogin = False
+                await self.matrix.listen()
+            except self.transient_errors as e:
+                relogin = relogin or (isinstance(e, MatrixRequestError) and e.code == 401)
+                delay = backoff.next()
+                logger.warning('Matrix failed ({}), restarting in {:.0f}s'.format(e, delay))
+                await asyncio.sleep(delay)
+                self.matrix_supervisor.restarts += 1
+
+    async def run(self):
+        """
+        Handle inbound XMPP events and Matrix events until something fails, then cancel
+         everything and re-raise the failure.
+        """
+        tasks = [asyncio.ensure_future(self.pump_inbound())]
+        if not self.appservice_options.get('enabled', False):
+            tasks.append(asyncio.ensure_future(self.listen_matrix()))
+        try:
+            done, _pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def pump_inbound(self):
+        while self.exception is None:
+            if not self.dispatcher.has_capacity():
+                await self.loop.run_in_executor(None, self.dispatcher.wait_for_capacity, 1)
+                continue
+            queued = await self.inbound_xmpp.get()
+            if queued is None:
+                continue
+            self.dispatch_event(queued.event, queued.cls, queued.received)
+        raise self.exception
+
+    async def async_shutdown(self):
+        await self.loop.run_in_executor(None, self.shutdown)
+        await self.matrix.api.close()
+
+
+async def run_bot(loop: asyncio.AbstractEventLoop, config_file: str=CONFIG_FILE):
+    bot = None
+    try:
+        bot = await loop.run_in_executor(None, AsyncBridgeBot, loop, config_file)
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, bot.request_reload)
+        await bot.run()
+    finally:
+        if bot is not None:
+            if hasattr(signal, 'SIGHUP'):
+                loop.remove_signal_handler(signal.SIGHUP)
+            await bot.async_shutdown()
+
+
+def main(config_file: str=CONFIG_FILE):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    while True:
+        try:
+            loop.run_until_complete(run_bot(loop, config_file))
+        except Exception as e:
+            logger.error('Fatal Exception: {}'.format(e))
+        time.sleep(1)
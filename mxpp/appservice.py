@@ -0,0 +1,358 @@
+"""
+Matrix application service support: the homeserver pushes events to the bridge in transactions
+ (instead of the bridge long-polling /sync), and each XMPP contact gets its own Matrix user.
+
+Run `python3 -m mxpp.appservice [config.yaml]` to print the registration file to give the homeserver.
+"""
+import hmac
+import json
+import logging
+import re
+import sys
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from typing import Callable, Dict, List
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+import yaml
+
+from matrix_client.api import MatrixHttpApi
+from matrix_client.errors import MatrixRequestError
+from mxpp.metrics import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+APP_API_PATH_RE = re.compile(r'^/_matrix/app/v1')
+
+# Characters allowed in the localpart of a Matrix user ID, other than '_' and '=' (used for escaping)
+LOCALPART_SAFE = set('abcdefghijklmnopqrstuvwxyz0123456789.-/')
+
+
+def escape_localpart(text: str) -> str:
+    """
+    Map arbitrary text (e.g. a JID) onto characters allowed in a Matrix user ID, reversibly:
+     upper case letters become '_' and the lower case letter, '_' becomes '__', and anything else
+     outside [a-z0-9.-/] becomes '=' and its UTF-8 bytes in hex.
+    """
+    escaped = []
+    for char in text:
+        if char in LOCALPART_SAFE:
+            escaped.append(char)
+        elif char == '_':
+            escaped.append('__')
+        elif 'A' <= char <= 'Z':
+            escaped.append('_' + char.lower())
+        else:
+            escaped.append(''.join('={:02x}'.format(b) for b in char.encode('utf-8')))
+    return ''.join(escaped)
+
+
+def unescape_localpart(localpart: str) -> str or None:
+    """
+    :return: The text escape_localpart mapped onto `localpart`, or None if it isn't a valid escape.
+    """
+    data = bytearray()
+    i = 0
+    try:
+        while i < len(localpart):
+            char = localpart[i]
+            if char == '_':
+                data += localpart[i + 1].upper().encode('ascii')
+                i += 2
+            elif char == '=':
+                hex_byte = localpart[i + 1:i + 3]
+                if len(hex_byte) != 2:
+                    return None
+                data.append(int(hex_byte, 16))
+                i += 3
+            else:
+                data += char.encode('ascii')
+                i += 1
+        return data.decode('utf-8')
+    except (IndexError, ValueError, UnicodeError):
+        return None
+
+
+def registration(config: Dict) -> Dict:
+    """
+    Build the application service registration for the homeserver from the bot's config.
+
+    :param config: Parsed config file
+    :return: Registration, to be saved as YAML and listed in the homeserver's app_service_config_files
+    """
+    options = config['appservice']
+    sender = config['matrix']['login']['username']
+    localpart, server_name = sender[1:].split(':', 1)
+    prefix = options.get('user_prefix', 'xmpp_')
+    return {
+        'id': options.get('id', 'mxpp'),
+        'url': options.get('url', 'http://{}:{}'.format(options.get('host', '127.0.0.1'), options.get('port', 9225))),
+        'as_token': options['as_token'],
+        'hs_token': options['hs_token'],
+        'sender_localpart': localpart,
+        'rate_limited': options.get('rate_limited', False),
+        'namespaces': {
+            'users': [{'exclusive': True,
+                       'regex': '@{}.*:{}'.format(re.escape(prefix), re.escape(server_name))}],
+            'aliases': [],
+            'rooms': [],
+        },
+    }
+
+
+class TransactionServer:
+    """
+    Receives the transactions pushed by the homeserver to the application service.
+
+    Transactions are handled one at a time, in the order they arrive. All the events of a
+     transaction are handed to `handle_events` as one batch, and the transaction is only
+     acknowledged once they have been handled, so the homeserver retries it if the bridge fails
+     part way. The IDs of the last `remember` transactions are kept, so a transaction retried
+     after it was handled (e.g. because the acknowledgement was lost) isn't handled twice.
+    """
+    def __init__(self,
+                 handle_events: Callable[[List[Dict]], None],
+                 hs_token: str,
+                 query_user: Callable[[str], bool]=None,
+                 exception_handler: Callable[[Exception], None]=None,
+                 host: str='127.0.0.1',
+                 port: int=9225,
+                 remember: int=1000):
+        """
+        :param handle_events: Called with the events of each new transaction
+        :param hs_token: Token the homeserver authenticates itself with
+        :param query_user: Called with a user ID in our namespace which the homeserver asks about;
+            returns True if the user exists (having created it if needed).
+        :param exception_handler: Called with anything raised by `handle_events`. The transaction
+            is then refused, so the homeserver sends it again later.
+        :param host: Address to listen on
+        :param port: Port to listen on, or 0 for any free port (see self.port)
+        :param remember: Number of transaction IDs to remember
+        """
+        self.handle_events = handle_events
+        self.hs_token = hs_token
+        self.query_user = query_user
+        self.exception_handler = exception_handler
+        self.remember = remember
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()       # type: Dict[str, None]
+        self.transactions = 0
+        self.events = 0
+        self.duplicates = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self, 'GET')
+
+            def do_POST(self):
+                server.handle(self, 'POST')
+
+            def do_PUT(self):
+                server.handle(self, 'PUT')
+
+            def log_message(self, format, *args):
+                logger.debug('Appservice request: ' + format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mxpp-appservice', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info('Listening for appservice transactions on port {}'.format(self.port))
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str):
+        url = urlparse(request.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(request.rfile.read(length).decode('utf-8')) if length else {}
+        except ValueError:
+            self.respond(request, 400, {'errcode': 'M_NOT_JSON', 'error': 'Invalid JSON'})
+            return
+
+        authorization = request.headers.get('Authorization', '')
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else query.get('access_token')
+        if token is None:
+            self.respond(request, 401, {'errcode': 'M_UNAUTHORIZED', 'error': 'Missing token'})
+            return
+        # Constant-time comparison, so the token can't be guessed from response times
+        if not hmac.compare_digest(token.encode('utf-8'), self.hs_token.encode('utf-8')):
+            self.respond(request, 403, {'errcode': 'M_FORBIDDEN', 'error': 'Bad token'})
+            return
+
+        parts = [unquote(part) for part in APP_API_PATH_RE.sub('', url.path).split('/')[1:]]
+        if method == 'PUT' and len(parts) == 2 and parts[0] == 'transactions':
+            code = self.transaction(parts[1], body.get('events', []))
+            self.respond(request, code, {} if code == 200 else {'errcode': 'M_UNKNOWN', 'error': 'Failed'})
+        elif method == 'GET' and len(parts) == 2 and parts[0] == 'users':
+            found = self.query_user is not None and self.query_user(parts[1])
+            self.respond(request, 200 if found else 404, {} if found else {'errcode': 'M_NOT_FOUND'})
+        elif method == 'POST' and parts == ['ping']:
+            self.respond(request, 200, {})
+        else:
+            # Includes room alias queries: we don't provide any aliases
+            self.respond(request, 404, {'errcode': 'M_NOT_FOUND', 'error': 'Not found'})
+
+    def transaction(self, txn_id: str, events: List[Dict]) -> int:
+        """
+        :return: HTTP status to answer the transaction with
+        """
+        with self.lock:
+            if txn_id in self.seen:
+                self.duplicates += 1
+                logger.debug('Skipping repeated transaction {}'.format(txn_id))
+                return 200
+
+            try:
+                self.handle_events(events)
+            except Exception as e:
+                logger.warning('Failed to handle transaction {} ({}), the homeserver will retry it'.format(
+                    txn_id, e))
+                if self.exception_handler is not None:
+                    self.exception_handler(e)
+                return 500
+
+            self.seen[txn_id] = None
+            while len(self.seen) > self.remember:
+                self.seen.popitem(last=False)
+            self.transactions += 1
+            self.events += len(events)
+        return 200
+
+    @staticmethod
+    def respond(request: BaseHTTPRequestHandler, code: int, content: Dict):
+        data = json.dumps(content).encode('utf-8')
+        request.send_response(code)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+class VirtualUsers:
+    """
+    One Matrix user per XMPP contact, in the application service's user namespace, who sends the
+     contact's messages and carries the contact's name (instead of renaming the bot in each room).
+
+    Users are registered, named and joined to rooms on first use. Names are saved through `save`,
+     so users aren't renamed again on every start.
+    """
+    api = None          # type: MatrixHttpApi
+    names = None        # type: Dict[str, str]
+
+    def __init__(self,
+                 api: MatrixHttpApi,
+                 server_name: str,
+                 prefix: str='xmpp_',
+                 stored: Dict[str, str]=None,
+                 save: Callable[[str, str], None]=None):
+        """
+        :param api: API authenticated with the application service token
+        :param server_name: Homeserver name, the part of user IDs after the ':'
+        :param prefix: Start of the localpart of every virtual user
+        :param stored: {jid: display name} of users registered by a previous run
+        :param save: Called with (jid, display name) when a user is registered or renamed
+        """
+        self.api = api
+        self.server_name = server_name
+        self.prefix = prefix
+        self.save = save
+        self.lock = threading.Lock()
+        self.names = dict(stored or {})
+        self.joined = set()
+
+    def user_id(self, jid: str) -> str:
+        return '@{}{}:{}'.format(self.prefix, escape_localpart(jid), self.server_name)
+
+    def jid(self, user_id: str) -> str or None:
+        """
+        :return: The JID of a virtual user, or None if `user_id` isn't one.
+        """
+        suffix = ':' + self.server_name
+        if not user_id.startswith('@' + self.prefix) or not user_id.endswith(suffix):
+            return None
+        return unescape_localpart(user_id[1 + len(self.prefix):-len(suffix)])
+
+    def ensure(self, jid: str, name: str=None) -> str:
+        """
+        Register the contact's user if it hasn't been yet, and update its display name.
+
+        :param jid: Bare JID of the contact
+        :param name: Display name, or None to use the JID
+        :return: User ID of the contact's user
+        """
+        user_id = self.user_id(jid)
+        name = name or jid
+        with self.lock:
+            known_name = self.names.get(jid)
+        if known_name == name:
+            return user_id
+
+        if known_name is None:
+            try:
+                self.api._send('POST', '/register', {'type': 'm.login.application_service',
+                                                     'username': user_id[1:].split(':', 1)[0]})
+                logger.info('Registered {} for {}'.format(user_id, jid))
+            except MatrixRequestError as e:
+                if 'M_USER_IN_USE' not in str(e.content):
+                    raise
+        self.api._send('PUT', '/profile/{}/displayname'.format(quote(user_id)), {'displayname': name},
+                       query_params={'user_id': user_id})
+
+        with self.lock:
+            self.names[jid] = name
+        if self.save is not None:
+            self.save(jid, name)
+        return user_id
+
+    def join(self, room_id: str, jid: str, name: str=None) -> str:
+        """
+        Make sure the contact's user is in a room (invited by the bot), registering it if needed.
+
+        :param room_id: Room to join
+        :param jid: Bare JID of the contact
+        :param name: Display name, or None to use the JID
+        :return: User ID of the contact's user
+        """
+        user_id = self.ensure(jid, name)
+        with self.lock:
+            if (room_id, user_id) in self.joined:
+                return user_id
+
+        try:
+            self.api.invite_user(room_id, user_id)
+        except MatrixRequestError as e:
+            # Already invited or joined
+            if e.code != 403:
+                raise
+        self.api._send('POST', '/rooms/{}/join'.format(quote(room_id)), {}, query_params={'user_id': user_id})
+
+        with self.lock:
+            self.joined.add((room_id, user_id))
+        return user_id
+
+    def forget_room(self, room_id: str):
+        with self.lock:
+            self.joined = {(joined_room, user_id) for joined_room, user_id in self.joined if joined_room != room_id}
+
+
+def main(argv: List[str]=None):
+    argv = sys.argv[1:] if argv is None else argv
+    config_file = argv[0] if argv else 'config.yaml'
+    with open(config_file, 'r') as conf_file:
+        config = yaml.safe_load(conf_file)
+    yaml.safe_dump(registration(config), sys.stdout, default_flow_style=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import html
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from matrix_client.room import Room as MatrixRoom
+from mxpp.outbound import html_content, text_content
+
+logger = logging.getLogger(__name__)
+
+
+class RoomBatcher:
+    """
+    Collects lines of text destined for a single Matrix room and sends them as one event.
+
+    A batch is sent once its first line is `max_delay` seconds old, or once it holds
+     `max_lines` lines or `max_bytes` bytes of text, whichever comes first.
+    """
+    room_getter = None      # type: Callable[[], MatrixRoom]
+    send_event = None       # type: Callable[[MatrixRoom, Dict, Callable[[], None]], None]
+    lines = None            # type: List[Tuple[str, bool, Callable[[], None] or None]]
+
+    def __init__(self,
+                 room_getter: Callable[[], MatrixRoom],
+                 send_event: Callable[[MatrixRoom, Dict, Callable[[], None]], None],
+                 max_delay: float=2.0,
+                 max_lines: int=20,
+                 max_bytes: int=8000):
+        """
+        :param room_getter: Returns the room to send batches to.
+        :param send_event: Called with (room, message content, on_done) to send each batch;
+            on_done should be called once the batch has been delivered.
+        :param max_delay: Maximum number of seconds a line may wait before being sent.
+        :param max_lines: Maximum number of lines per batch.
+        :param max_bytes: Maximum size of a batch's text, in bytes.
+        """
+        self.room_getter = room_getter
+        self.send_event = send_event
+        self.max_delay = max_delay
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        self.lines = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.timer = None       # type: threading.Timer
+
+    def add(self, text: str, notice: bool=False, on_done: Callable[[], None]=None):
+        """
+        Queue a line to be sent.
+
+        :param text: Text to send
+        :param notice: True if the line would otherwise have been sent as a notice
+        :param on_done: Called once the batch containing the line has been delivered
+        """
+        flush_now = False
+        with self.lock:
+            self.lines.append((text, notice, on_done))
+            self.size += len(text.encode('utf-8'))
+
+            if len(self.lines) >= self.max_lines or self.size >= self.max_bytes:
+                flush_now = True
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all queued lines right away.
+        """
+        # send_lock keeps batches in order if two flushes race
+        with self.send_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                lines = self.lines
+                self.lines = []
+                self.size = 0
+
+            if not lines:
+                return
+
+            try:
+                self.send(lines)
+            except Exception:
+                logger.exception('Failed to send batch of {} lines'.format(len(lines)))
+
+    def shutdown(self):
+        self.flush()
+
+    def send(self, lines: List[Tuple[str, bool, Callable[[], None] or None]]):
+        """
+        Send a batch of lines to the room. A single line is sent as-is; multiple lines are sent
+         as one HTML list, with notices in italics.
+
+        :param lines: [(text, notice, on_done)]
+        """
+        room = self.room_getter()
+        callbacks = [on_done for _text, _notice, on_done in lines if on_done is not None]
+
+        def on_done():
+            for callback in callbacks:
+                callback()
+
+        if len(lines) == 1:
+            text, notice, _on_done = lines[0]
+            self.send_event(room, text_content(text, 'm.notice' if notice else 'm.text'), on_done)
+            return
+
+        items = []
+        for text, notice, _on_done in lines:
+            item = html.escape(text).replace('\n', '<br/>')
+            if notice:
+                item = '<em>' + item + '</em>'
+            items.append('<li>' + item + '</li>')
+
+        body = '\n'.join(text for text, _notice, _on_done in lines)
+        msgtype = 'm.notice' if all(notice for _text, notice, _on_done in lines) else 'm.text'
+        self.send_event(room, html_content('<ul>' + ''.join(items) + '</ul>', body=body, msgtype=msgtype), on_done)
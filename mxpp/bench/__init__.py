@@ -0,0 +1,5 @@
+"""
+Benchmarks for the bridge, run against local stand-ins for the Matrix homeserver and the XMPP server.
+
+Run with `python3 -m mxpp.bench --help`.
+"""
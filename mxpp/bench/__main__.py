@@ -0,0 +1,3 @@
+from mxpp.bench.run import main
+
+main()
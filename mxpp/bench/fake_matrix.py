@@ -0,0 +1,357 @@
+"""
+In-process stand-in for the parts of the Matrix client-server API which the bridge uses.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+from mxpp.metrics import normalize_endpoint
+
+logger = logging.getLogger(__name__)
+
+API_PATH_RE = re.compile(r'^/_matrix/client/[^/]+')
+
+
+class FakeRoom:
+    def __init__(self, room_id: str, creator: str):
+        self.room_id = room_id
+        self.state = {}     # type: Dict[Tuple[str, str], Dict]
+        self.members = {creator: 'join'}    # type: Dict[str, str]
+
+
+class FakeMatrixServer:
+    """
+    Minimal Matrix homeserver: login, sync (with long-polling), createRoom, send, state,
+     invite, join, leave, members and filters.
+
+    With an `as_token`, it also acts as the homeserver of an application service: requests made
+     with the token act as the bot (or as the user given by ?user_id=), appservice users can be
+     registered, and every event is pushed in transactions to `appservice_url` once it is set.
+
+    :param latency: Seconds to wait before answering each request (except the sync long-poll).
+    :param rate_limit: Probability of answering a write request with 429.
+    :param retry_after_ms: retry_after_ms to send with 429 responses.
+    :param as_token: Application service token, or None for no application service
+    :param hs_token: Token to push transactions with
+    :param max_transaction: Most events to push in one transaction
+    """
+    def __init__(self,
+                 server_name: str='bench.local',
+                 host: str='127.0.0.1',
+                 port: int=0,
+                 latency: float=0.0,
+                 rate_limit: float=0.0,
+                 retry_after_ms: int=100,
+                 as_token: str=None,
+                 hs_token: str=None,
+                 max_transaction: int=100):
+        self.server_name = server_name
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after_ms = retry_after_ms
+        self.as_token = as_token
+        self.hs_token = hs_token
+        self.max_transaction = max_transaction
+        self.appservice_url = None  # type: str
+        self.transactions = 0
+        self.running = False
+
+        self.rooms = {}             # type: Dict[str, FakeRoom]
+        self.timeline = []          # type: List[Tuple[str, Dict]]
+        self.txn_ids = set()
+        self.request_counts = {}    # type: Dict[str, int]
+        self.rate_limited = 0
+        self.filters = {}           # type: Dict[str, Dict]
+        self.counter = 0
+        self.condition = threading.Condition()
+
+        # Called with (room_id, event) for each event sent by a client
+        self.on_event = None        # type: Callable[[str, Dict], None]
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self, 'GET')
+
+            def do_POST(self):
+                server.handle(self, 'POST')
+
+            def do_PUT(self):
+                server.handle(self, 'PUT')
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.base_url = 'http://{}:{}'.format(host, self.port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-matrix', daemon=True)
+        self.pusher = threading.Thread(target=self._push, name='fake-matrix-push', daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        if self.as_token is not None:
+            self.pusher.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def set_appservice_url(self, url: str):
+        with self.condition:
+            self.appservice_url = url
+            self.condition.notify_all()
+
+    def _push(self):
+        # Push the timeline to the application service in order, retrying each transaction until it is accepted
+        position = 0
+        while True:
+            with self.condition:
+                while self.running and (self.appservice_url is None or len(self.timeline) <= position):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                url = '{}/_matrix/app/v1/transactions/{}'.format(self.appservice_url, self.transactions)
+                events = [dict(event, room_id=room_id)
+                          for room_id, event in self.timeline[position:position + self.max_transaction]]
+
+            request = urllib.request.Request(url, data=json.dumps({'events': events}).encode('utf-8'), method='PUT',
+                                             headers={'Content-Type': 'application/json',
+                                                      'Authorization': 'Bearer {}'.format(self.hs_token)})
+            try:
+                urllib.request.urlopen(request, timeout=30).close()
+            except OSError as e:
+                logger.debug('Transaction push failed ({}), retrying'.format(e))
+                time.sleep(0.1)
+                continue
+            position += len(events)
+            self.transactions += 1
+
+    def _next_id(self, prefix: str) -> str:
+        with self.condition:
+            self.counter += 1
+            return '{}{}:{}'.format(prefix, self.counter, self.server_name)
+
+    def add_event(self, room_id: str, event: Dict):
+        """
+        Append an event to a room's timeline, waking up any waiting syncs.
+        """
+        event = dict(event)
+        event.setdefault('event_id', self._next_id('$'))
+        event.setdefault('origin_server_ts', int(time.time() * 1000))
+        with self.condition:
+            room = self.rooms[room_id]
+            if 'state_key' in event:
+                room.state[(event['type'], event['state_key'])] = event
+                if event['type'] == 'm.room.member':
+                    room.members[event['state_key']] = event['content'].get('membership')
+            self.timeline.append((room_id, event))
+            self.condition.notify_all()
+
+    def inject_message(self, room_id: str, sender: str, body: str):
+        """
+        Make it look like a user sent a message to a room.
+        """
+        self.add_event(room_id, {'type': 'm.room.message', 'sender': sender,
+                                 'content': {'msgtype': 'm.text', 'body': body}})
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str):
+        url = urlparse(request.path)
+        path = API_PATH_RE.sub('', url.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length).decode('utf-8')) if length else {}
+        user_id = '@bot:' + self.server_name
+        if self.as_token is not None and request.headers.get('Authorization') == 'Bearer ' + self.as_token:
+            user_id = query.get('user_id', user_id)
+
+        endpoint = '{} {}'.format(method, normalize_endpoint(path))
+        with self.condition:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+        if path != '/sync' and self.latency > 0:
+            time.sleep(self.latency)
+
+        if method in ('POST', 'PUT') and path != '/login' and random.random() < self.rate_limit:
+            with self.condition:
+                self.rate_limited += 1
+            self.respond(request, 429, {'errcode': 'M_LIMIT_EXCEEDED', 'error': 'Too many requests',
+                                        'retry_after_ms': self.retry_after_ms})
+            return
+
+        try:
+            code, response = self.route(method, [unquote(p) for p in path.split('/')[1:]], query, body, user_id)
+        except KeyError:
+            code, response = 404, {'errcode': 'M_NOT_FOUND', 'error': 'Not found'}
+        self.respond(request, code, response)
+
+    def route(self, method: str, parts: List[str], query: Dict, body: Dict, user_id: str) -> Tuple[int, Dict]:
+        if parts == ['login']:
+            return 200, {'user_id': user_id, 'access_token': 'token', 'home_server': self.server_name,
+                         'device_id': 'BENCH'}
+
+        if parts == ['register'] and body.get('type') == 'm.login.application_service':
+            return 200, {'user_id': '@{}:{}'.format(body['username'], self.server_name)}
+
+        if parts == ['joined_rooms']:
+            with self.condition:
+                joined = [room_id for room_id, room in self.rooms.items() if room.members.get(user_id) == 'join']
+            return 200, {'joined_rooms': joined}
+
+        if parts == ['sync']:
+            return 200, self.sync(query.get('since'), int(query.get('timeout', 0)) / 1000)
+
+        if parts == ['createRoom']:
+            room_id = self._next_id('!')
+            with self.condition:
+                self.rooms[room_id] = FakeRoom(room_id, user_id)
+            self.add_event(room_id, {'type': 'm.room.member', 'sender': user_id, 'state_key': user_id,
+                                     'content': {'membership': 'join'}})
+            if 'name' in body:
+                self.add_event(room_id, {'type': 'm.room.name', 'sender': user_id, 'state_key': '',
+                                         'content': {'name': body['name']}})
+            if 'topic' in body:
+                self.add_event(room_id, {'type': 'm.room.topic', 'sender': user_id, 'state_key': '',
+                                         'content': {'topic': body['topic']}})
+            for event in body.get('initial_state', []):
+                self.add_event(room_id, dict(event, sender=user_id))
+            for invitee in body.get('invite', []):
+                self.add_event(room_id, {'type': 'm.room.member', 'sender': user_id, 'state_key': invitee,
+                                         'content': {'membership': 'invite'}})
+            return 200, {'room_id': room_id}
+
+        if len(parts) == 4 and parts[0] == 'user' and parts[2] == 'filter' and method == 'POST':
+            filter_id = str(len(self.filters))
+            self.filters[filter_id] = body
+            return 200, {'filter_id': filter_id}
+
+        if parts[0] == 'profile':
+            return 200, {}
+
+        if parts[0] == 'rooms':
+            room_id = parts[1]
+            room = self.rooms[room_id]
+            action = parts[2]
+
+            if action == 'send' and method == 'PUT':
+                txn_key = (room_id, parts[4])
+                with self.condition:
+                    duplicate = txn_key in self.txn_ids
+                    self.txn_ids.add(txn_key)
+                event = {'type': parts[3], 'sender': user_id, 'content': body}
+                if not duplicate:
+                    self.add_event(room_id, event)
+                    if self.on_event is not None:
+                        self.on_event(room_id, event)
+                return 200, {'event_id': self._next_id('$')}
+
+            if action == 'state':
+                key = (parts[3], parts[4] if len(parts) > 4 else '')
+                if method == 'PUT':
+                    self.add_event(room_id, {'type': key[0], 'state_key': key[1], 'sender': user_id,
+                                             'content': body})
+                    return 200, {'event_id': self._next_id('$')}
+                return 200, dict(room.state[key]['content'])
+
+            if action == 'invite':
+                self.add_event(room_id, {'type': 'm.room.member', 'sender': user_id, 'state_key': body['user_id'],
+                                         'content': {'membership': 'invite'}})
+                return 200, {}
+
+            if action == 'join' and method == 'POST':
+                self.add_event(room_id, {'type': 'm.room.member', 'sender': user_id, 'state_key': user_id,
+                                         'content': {'membership': 'join'}})
+                return 200, {'room_id': room_id}
+
+            if action == 'leave':
+                self.add_event(room_id, {'type': 'm.room.member', 'sender': user_id, 'state_key': user_id,
+                                         'content': {'membership': 'leave'}})
+                return 200, {}
+
+            if action == 'joined_members':
+                with self.condition:
+                    joined = {u: {} for u, m in room.members.items() if m == 'join'}
+                return 200, {'joined': joined}
+
+            if action == 'members':
+                with self.condition:
+                    chunk = [e for (t, _k), e in room.state.items() if t == 'm.room.member']
+                return 200, {'chunk': chunk}
+
+        raise KeyError(parts)
+
+    def sync(self, since: str or None, timeout: float) -> Dict:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if since is None:
+                position = len(self.timeline)
+                joined = {}
+                for room_id, room in self.rooms.items():
+                    if room.members.get('@bot:' + self.server_name) != 'join':
+                        continue
+                    joined[room_id] = self._room_sync(list(room.state.values()), [])
+                return self._sync_response(position, joined, {})
+
+            position = int(since)
+            while len(self.timeline) <= position:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            new_events = self.timeline[position:]
+            position = len(self.timeline)
+
+        bot_id = '@bot:' + self.server_name
+        joined, left = {}, {}
+        for room_id, event in new_events:
+            if event['type'] == 'm.room.member' and event['state_key'] == bot_id \
+                    and event['content'].get('membership') == 'leave':
+                left.setdefault(room_id, self._room_sync([], []))
+                joined.pop(room_id, None)
+                continue
+            joined.setdefault(room_id, self._room_sync([], []))['timeline']['events'].append(event)
+        return self._sync_response(position, joined, left)
+
+    @staticmethod
+    def _room_sync(state: List[Dict], timeline: List[Dict]) -> Dict:
+        return {'state': {'events': state},
+                'timeline': {'events': timeline, 'prev_batch': '0', 'limited': False},
+                'ephemeral': {'events': []},
+                'account_data': {'events': []},
+                'unread_notifications': {}}
+
+    @staticmethod
+    def _sync_response(position: int, joined: Dict, left: Dict) -> Dict:
+        return {'next_batch': str(position),
+                'presence': {'events': []},
+                'account_data': {'events': []},
+                'to_device': {'events': []},
+                'rooms': {'join': joined, 'invite': {}, 'leave': left}}
+
+    @staticmethod
+    def respond(request: BaseHTTPRequestHandler, code: int, content: Dict):
+        data = json.dumps(content).encode('utf-8')
+        request.send_response(code)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
@@ -0,0 +1,200 @@
+"""
+Minimal in-process XMPP server: SASL PLAIN (without TLS), resource binding, sessions, a static
+ roster, and delivery of stanzas to and from the single connected client.
+"""
+import asyncio
+import itertools
+import logging
+import threading
+from typing import Callable, List, Tuple
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+logger = logging.getLogger(__name__)
+
+NS_CLIENT = 'jabber:client'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_ROSTER = 'jabber:iq:roster'
+
+
+class ClientSession:
+    def __init__(self, server: 'FakeXMPPServer', writer: asyncio.StreamWriter):
+        self.server = server
+        self.writer = writer
+        self.authenticated = False
+        self.jid = None
+        self.reset()
+
+    def reset(self):
+        self.parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self.root = None
+        self.depth = 0
+
+    def write(self, data: str):
+        self.writer.write(data.encode('utf-8'))
+
+    def feed(self, data: bytes) -> bool:
+        """
+        :return: False once the client has closed its stream.
+        """
+        self.parser.feed(data)
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                self.depth += 1
+                if self.depth == 1:
+                    self.root = elem
+                    self.open_stream()
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.write('</stream:stream>')
+                    return False
+                if self.depth == 1:
+                    self.root.remove(elem)
+                    if self.handle(elem):
+                        # Stream restart: the old parser's remaining events are meaningless
+                        self.reset()
+                        break
+        return True
+
+    def open_stream(self):
+        self.write("<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+                   "xmlns:stream='http://etherx.jabber.org/streams' id='{}' from='{}' version='1.0'>".format(
+                       next(self.server.ids), self.server.domain))
+        if self.authenticated:
+            self.write("<stream:features><bind xmlns='{}'/><session xmlns='{}'/></stream:features>".format(
+                NS_BIND, NS_SESSION))
+        else:
+            self.write("<stream:features><mechanisms xmlns='{}'><mechanism>PLAIN</mechanism>"
+                       "</mechanisms></stream:features>".format(NS_SASL))
+
+    def handle(self, elem: ElementTree.Element) -> bool:
+        """
+        :return: True if the stream should be restarted.
+        """
+        if elem.tag == '{%s}auth' % NS_SASL:
+            self.authenticated = True
+            self.write("<success xmlns='{}'/>".format(NS_SASL))
+            return True
+
+        if elem.tag == '{%s}iq' % NS_CLIENT:
+            self.handle_iq(elem)
+        elif elem.tag == '{%s}presence' % NS_CLIENT:
+            if elem.get('to') is None and elem.get('type') is None:
+                self.server.client_ready.set()
+        elif elem.tag == '{%s}message' % NS_CLIENT:
+            if self.server.on_message is not None:
+                self.server.on_message(elem)
+        return False
+
+    def handle_iq(self, iq: ElementTree.Element):
+        iq_id = quoteattr(iq.get('id', ''))
+        iq_type = iq.get('type')
+        if iq_type not in ('get', 'set'):
+            return
+
+        if iq.find('{%s}bind' % NS_BIND) is not None:
+            resource = iq.findtext('{%s}bind/{%s}resource' % (NS_BIND, NS_BIND)) or 'mxpp'
+            self.jid = '{}@{}/{}'.format(self.server.username, self.server.domain, resource)
+            self.server.sessions.append(self)
+            self.write("<iq type='result' id={}><bind xmlns='{}'><jid>{}</jid></bind></iq>".format(
+                iq_id, NS_BIND, escape(self.jid)))
+
+        elif iq.find('{%s}query' % NS_ROSTER) is not None and iq_type == 'get':
+            items = ''.join("<item jid={} name={} subscription='both'/>".format(quoteattr(jid), quoteattr(name))
+                            for jid, name in self.server.roster)
+            self.write("<iq type='result' id={} to={}><query xmlns='{}'>{}</query></iq>".format(
+                iq_id, quoteattr(self.jid or ''), NS_ROSTER, items))
+
+        else:
+            self.write("<iq type='result' id={}/>".format(iq_id))
+
+
+class FakeXMPPServer:
+    """
+    Accepts a single user (any password) whose roster is `roster`, a list of (jid, name).
+    Runs its own event loop on a background thread.
+    """
+    def __init__(self,
+                 roster: List[Tuple[str, str]],
+                 username: str='bench',
+                 domain: str='bench.local',
+                 host: str='127.0.0.1',
+                 port: int=0):
+        self.roster = roster
+        self.username = username
+        self.domain = domain
+        self.host = host
+        self.port = port
+
+        self.ids = itertools.count()
+        self.sessions = []          # type: List[ClientSession]
+        self.client_ready = threading.Event()
+        # Called with each message stanza sent by the client
+        self.on_message = None      # type: Callable[[ElementTree.Element], None]
+
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='fake-xmpp', daemon=True)
+
+    @property
+    def jid(self) -> str:
+        return '{}@{}'.format(self.username, self.domain)
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(asyncio.start_server(self._handle_client, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+        server.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = ClientSession(self, writer)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data or not session.feed(data):
+                    break
+        except Exception:
+            logger.exception('Fake XMPP session failed')
+        finally:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            self.client_ready.clear()
+            writer.close()
+
+    def send(self, stanza: str):
+        """
+        Send a raw stanza to every connected client. May be called from any thread.
+        """
+        def write():
+            for session in self.sessions:
+                session.write(stanza)
+        self.loop.call_soon_threadsafe(write)
+
+    def send_message(self, from_jid: str, body: str, mtype: str='chat'):
+        self.send("<message from={} to={} type={}><body>{}</body></message>".format(
+            quoteattr(from_jid), quoteattr(self.jid), quoteattr(mtype), escape(body)))
+
+    def send_presence(self, from_jid: str, available: bool=True):
+        self.send("<presence from={} to={}{}/>".format(
+            quoteattr(from_jid), quoteattr(self.jid), '' if available else " type='unavailable'"))
+
+    def send_roster_push(self, items: List[Tuple[str, str]]):
+        """
+        :param items: (jid, subscription) of each changed roster item
+        """
+        self.send("<iq type='set' id='push{}' to={}><query xmlns='{}'>{}</query></iq>".format(
+            next(self.ids), quoteattr(self.jid), NS_ROSTER,
+            ''.join('<item jid={} subscription={}/>'.format(quoteattr(jid), quoteattr(subscription or 'both'))
+                    for jid, subscription in items)))
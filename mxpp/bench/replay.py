@@ -0,0 +1,254 @@
+"""
+Replay driver: feeds a traffic recording (see mxpp.recorder) into a BridgeBot running against the
+ stand-in servers, at 1x to 100x the recorded speed, and reports the latency of each kind of
+ event and the bot's backlog over time as a JSON line.
+
+    python3 -m mxpp.bench.replay mxpp_traffic.jsonl --speed 10
+"""
+import argparse
+import json
+import logging
+import re
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Set, Tuple
+
+import yaml
+
+from mxpp.bench.fake_matrix import FakeMatrixServer
+from mxpp.bench.fake_xmpp import FakeXMPPServer
+from mxpp.bench.run import OWNER_ID, RunningBot, latency_report, make_config, wait_for
+from mxpp.rooms import DIRECT_ROOM, GROUPCHAT_ROOM
+
+logger = logging.getLogger(__name__)
+
+REPLAY_DOMAIN = 'replay.local'
+MUC_DOMAIN = 'muc.replay.local'
+TAG_RE = re.compile(r'replay-(\d+)\b')
+# Categories of event which the bot bridges, so their latency can be measured
+BRIDGED = ('xmpp_chat', 'xmpp_groupchat', 'matrix_message')
+
+
+def load_recording(path: str) -> Tuple[Dict, List[Dict]]:
+    """
+    :return: (header, events) of a recording
+    """
+    with open(path, 'r', encoding='utf-8') as recording:
+        lines = [json.loads(line) for line in recording if line.strip()]
+    if not lines or 'v' not in lines[0]:
+        raise ValueError('{} is not a traffic recording'.format(path))
+    return lines[0], lines[1:]
+
+
+class Replay:
+    """
+    Works out the roster and group chats a recording needs, and turns each recorded event back
+     into traffic for the stand-in servers.
+    """
+    def __init__(self, header: Dict, events: List[Dict]):
+        self.anonymised = header.get('anon', True)
+        self.events = events
+        self.groupchats = set()     # type: Set[str]
+        contacts = set()            # type: Set[str]
+        for event in events:
+            if event['s'] == 'x' and event['e'] == 'message' and event.get('y') == 'groupchat':
+                self.groupchats.add(event['f'])
+            elif event['s'] == 'x' and event['e'] == 'roster':
+                contacts.update(jid for jid, _subscription in event.get('i', []))
+            elif event['s'] == 'm' and event.get('k') == GROUPCHAT_ROOM:
+                self.groupchats.add(event['f'])
+            elif event.get('f'):
+                contacts.add(event['f'])
+        contacts -= self.groupchats
+        self.roster = [(self.jid(contact), contact) for contact in sorted(contacts)]
+
+    def jid(self, recorded: str, groupchat: bool=False) -> str:
+        """
+        :return: The JID to replay a recorded JID (or its pseudonym) as
+        """
+        if not self.anonymised:
+            return recorded
+        return '{}@{}'.format(recorded, MUC_DOMAIN if groupchat else REPLAY_DOMAIN)
+
+    @staticmethod
+    def body(index: int, size: int) -> str:
+        """
+        :return: Message body tagged with the event's index, padded to the recorded size
+        """
+        tag = 'replay-{}'.format(index)
+        return tag + ' ' + 'x' * max(0, (size or 0) - len(tag) - 1)
+
+    def send(self, index: int, event: Dict, bot, matrix: FakeMatrixServer, xmpp: FakeXMPPServer) -> str or None:
+        """
+        Send one recorded event to the bot.
+
+        :return: Category of the event for the report, or None if it can't be replayed
+            (e.g. the bridge's own messages, which the bot sends again by itself).
+        """
+        if event.get('o'):
+            return None
+
+        if event['s'] == 'x':
+            if event['e'] == 'message':
+                if event.get('y') == 'groupchat':
+                    xmpp.send_message('{}/{}'.format(self.jid(event['f'], groupchat=True), event.get('nick') or 'nick'),
+                                      self.body(index, event.get('n')), mtype='groupchat')
+                    return 'xmpp_groupchat'
+                if event.get('y') in ('chat', 'normal'):
+                    xmpp.send_message(self.jid(event['f']) + '/replay', self.body(index, event.get('n')),
+                                      mtype=event['y'])
+                    return 'xmpp_chat'
+            elif event['e'] == 'presence':
+                xmpp.send_presence(self.jid(event['f']) + '/replay', available=event.get('y') == 'available')
+                return 'xmpp_presence'
+            elif event['e'] == 'roster' and event.get('y') == 'set':
+                xmpp.send_roster_push([(self.jid(jid), subscription) for jid, subscription in event.get('i', [])])
+                return 'xmpp_roster'
+            return None
+
+        if event['e'] != 'm.room.message':
+            return None
+        kind = event.get('k')
+        if kind in (DIRECT_ROOM, GROUPCHAT_ROOM):
+            entry = bot.rooms.by_jid(self.jid(event['f'], groupchat=kind == GROUPCHAT_ROOM), kind)
+            room_id = entry.room_id if entry is not None else None
+        else:
+            room = bot.special_room(kind) if kind is not None else None
+            room_id = room.room_id if room is not None else None
+        if room_id is None:
+            return None
+        matrix.inject_message(room_id, OWNER_ID, self.body(index, event.get('n')))
+        return 'matrix_message' if kind in (DIRECT_ROOM, GROUPCHAT_ROOM) else 'matrix_special'
+
+
+def backlog(running: RunningBot) -> Dict[str, int]:
+    bot = running.bot
+    return {'inbound': bot.inbound_xmpp.qsize(),
+            'dispatched': bot.dispatcher.total_depth(),
+            'outbound': bot.outbound.queue_depth()}
+
+
+def run_replay(args: argparse.Namespace) -> Dict:
+    header, events = load_recording(args.recording)
+    replay = Replay(header, events)
+
+    matrix = FakeMatrixServer(latency=args.latency_ms / 1000)
+    xmpp = FakeXMPPServer(replay.roster, domain=REPLAY_DOMAIN)
+    matrix.start()
+    xmpp.start()
+
+    sent = {}           # type: Dict[int, float]
+    received = {}       # type: Dict[int, float]
+    categories = {}     # type: Dict[int, str]
+
+    def on_received(text: str):
+        now = time.monotonic()
+        for match in TAG_RE.finditer(text):
+            received.setdefault(int(match.group(1)), now)
+
+    matrix.on_event = lambda _room_id, event: on_received(event.get('content', {}).get('body', ''))
+    xmpp.on_message = lambda stanza: on_received(stanza.findtext('{jabber:client}body') or '')
+
+    result = {'recording': args.recording, 'speed': args.speed, 'events': len(events),
+              'contacts': len(replay.roster), 'groupchats': len(replay.groupchats)}
+    with tempfile.TemporaryDirectory() as workdir:
+        running = RunningBot(make_config(matrix, xmpp, workdir, args.config_overrides), matrix)
+        result['startup_s'] = running.startup_s
+        wait_for(lambda: running.bot.rooms.count(DIRECT_ROOM) >= len(replay.roster), args.timeout)
+        for room_jid in sorted(replay.groupchats):
+            running.bot.create_groupchat_room(replay.jid(room_jid, groupchat=True))
+
+        samples = []
+        done = threading.Event()
+        start = time.monotonic()
+
+        def sample():
+            while not done.wait(args.sample_interval):
+                depths = backlog(running)
+                depths['t'] = round(time.monotonic() - start, 3)
+                depths['unanswered'] = sum(1 for i in list(sent) if categories.get(i) in BRIDGED and i not in received)
+                samples.append(depths)
+
+        sampler = threading.Thread(target=sample, name='replay-sampler', daemon=True)
+        sampler.start()
+
+        skipped = 0
+        max_lag = 0.0
+        for index, event in enumerate(events):
+            due = start + event['t'] / args.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+            sent_at = time.monotonic()
+            category = replay.send(index, event, running.bot, matrix, xmpp)
+            if category is None:
+                skipped += 1
+                continue
+            categories[index] = category
+            sent[index] = sent_at
+
+        result['replay_s'] = time.monotonic() - start
+        result['recorded_s'] = events[-1]['t'] if events else 0
+        result['schedule_lag_max_s'] = max_lag
+        result['skipped'] = skipped
+
+        # Let the bot catch up with whatever is still queued
+        bridged = [i for i in sent if categories[i] in BRIDGED]
+        wait_for(lambda: all(i in received for i in bridged) and running.idle(), args.timeout)
+        result['drain_s'] = time.monotonic() - start - result['replay_s']
+        done.set()
+        sampler.join()
+        running.stop()
+
+    xmpp.stop()
+    matrix.stop()
+
+    result['latency'] = {}
+    for category in sorted(set(categories.values())):
+        indexes = [i for i, c in categories.items() if c == category]
+        result['latency'][category] = latency_report({i: sent[i] for i in indexes},
+                                                     {i: received[i] for i in indexes if i in received})
+    result['backlog'] = samples
+    return result
+
+
+def main(argv: List[str]=None):
+    parser = argparse.ArgumentParser(prog='python3 -m mxpp.bench.replay',
+                                     description='Replay a traffic recording against local stand-in servers.')
+    parser.add_argument('recording', help='Recording made with the recording: option in config.yaml')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='Replay speed, from 1 (as recorded) to 100 (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Latency added to each homeserver request (default: %(default)s)')
+    parser.add_argument('--sample-interval', type=float, default=0.5,
+                        help='Seconds between backlog samples (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='Seconds to wait for the bot to start, and to drain (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=YAML',
+                        help='Override a top-level config.yaml option, e.g. --set inbound_workers=8')
+    parser.add_argument('--output', help='Also append results to this file')
+    args = parser.parse_args(argv)
+    if not 1 <= args.speed <= 100:
+        parser.error('--speed must be between 1 and 100')
+
+    args.config_overrides = {}
+    for override in args.set:
+        key, _, value = override.partition('=')
+        args.config_overrides[key] = yaml.safe_load(value)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    line = json.dumps(run_replay(args), sort_keys=True)
+    print(line)
+    sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'a') as output:
+            output.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+Benchmark driver: starts the stand-in servers, runs a BridgeBot against them with a synthetic
+ roster, and reports startup time, roster sync time, throughput and latency as JSON lines.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import yaml
+
+from mxpp.main import BridgeBot
+from mxpp.rooms import DIRECT_ROOM
+from mxpp.bench.fake_matrix import FakeMatrixServer
+from mxpp.bench.fake_xmpp import FakeXMPPServer
+
+logger = logging.getLogger(__name__)
+
+BOT_ID = '@bot:bench.local'
+OWNER_ID = '@owner:bench.local'
+INBOUND_RE = re.compile(r'^bench-(\d+)$')
+OUTBOUND_RE = re.compile(r'^mbench-(\d+)$')
+AS_TOKEN = 'bench-as'
+HS_TOKEN = 'bench-hs'
+
+
+class BenchBridgeBot(BridgeBot):
+    def create_xmpp(self):
+        xmpp = BridgeBot.create_xmpp(self)
+        # The stand-in XMPP server doesn't do TLS
+        xmpp.plugin['feature_mechanisms'].unencrypted_plain = True
+        return xmpp
+
+
+class StopBenchmark(Exception):
+    pass
+
+
+def percentile(values: List[float], q: float) -> float or None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_report(sent: Dict[int, float], received: Dict[int, float]) -> Dict:
+    latencies = [received[i] - sent[i] for i in received if i in sent]
+    report = {
+        'sent': len(sent),
+        'received': len(received),
+        'p50_s': percentile(latencies, 0.5),
+        'p99_s': percentile(latencies, 0.99),
+        'msgs_per_s': None,
+    }
+    if received:
+        elapsed = max(received.values()) - min(sent.values())
+        if elapsed > 0:
+            report['msgs_per_s'] = len(received) / elapsed
+    return report
+
+
+def wait_for(condition, timeout: float, interval: float=0.01) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def make_config(matrix: FakeMatrixServer, xmpp: FakeXMPPServer, workdir: str, options: Dict) -> str:
+    config = {
+        'matrix': {
+            'server': {'base_url': matrix.base_url, 'valid_cert_check': False},
+            'login': {'username': BOT_ID, 'password': 'bench'},
+            'users_to_invite': [OWNER_ID],
+            'room_topics': {'control': 'xmpp-bot-control', 'all_chat': 'xmpp-bot-all_chat'},
+            'groupchat_flag': '<groupchat>',
+        },
+        'xmpp': {
+            'server': {'host': xmpp.host, 'port': xmpp.port},
+            'login': {'jid': xmpp.jid, 'password': 'bench'},
+            'roster_options': {'auto_authorize': True, 'auto_subscribe': True},
+            'groupchat_nick': 'bench',
+        },
+        'groupchat_mute_own_nick': True,
+        'groupchat_send_messages_to_all_chat': False,
+        'send_messages_to_all_chat': True,
+        'send_messages_to_jid_rooms': True,
+        'send_presences_to_control': True,
+        'jid_groups': [],
+        'state_file': os.path.join(workdir, 'state.db'),
+        'room_provisioning': {'concurrency': 4, 'rate': 1000, 'burst': 1000, 'progress_interval': 1000},
+        'presence_digest': {'window': 1},
+    }
+    config.update(options)
+
+    path = os.path.join(workdir, 'config.yaml')
+    with open(path, 'w') as conf_file:
+        yaml.safe_dump(config, conf_file)
+    return path
+
+
+class RunningBot:
+    """
+    A BridgeBot with its inbound loop running on a background thread.
+    """
+    def __init__(self, config_file: str, matrix: FakeMatrixServer):
+        start = time.monotonic()
+        self.bot = BenchBridgeBot(config_file)
+        self.startup_s = time.monotonic() - start
+        if self.bot.appservice is not None:
+            matrix.set_appservice_url('http://127.0.0.1:{}'.format(self.bot.appservice.port))
+
+        self.thread = threading.Thread(target=self._run, name='bench-inbound', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.bot.handle_inbound_xmpp()
+        except StopBenchmark:
+            pass
+        except Exception:
+            logger.exception('Bot failed during benchmark')
+
+    def idle(self) -> bool:
+        return self.bot.inbound_xmpp.qsize() == 0 and self.bot.dispatcher.total_depth() == 0
+
+    def stop(self):
+        self.bot.handle_exception(StopBenchmark())
+        self.thread.join()
+        self.bot.shutdown()
+
+
+def run_size(contacts: int, args: argparse.Namespace) -> Dict:
+    roster = [('contact{}@bench.local'.format(i), 'Contact {}'.format(i)) for i in range(contacts)]
+    matrix = FakeMatrixServer(latency=args.latency_ms / 1000, rate_limit=args.rate_limit,
+                              retry_after_ms=args.retry_after_ms,
+                              as_token=AS_TOKEN if args.appservice else None, hs_token=HS_TOKEN)
+    xmpp = FakeXMPPServer(roster)
+    matrix.start()
+    xmpp.start()
+
+    inbound_sent, inbound_received = {}, {}
+    outbound_sent, outbound_received = {}, {}
+
+    def on_matrix_event(_room_id: str, event: Dict):
+        match = INBOUND_RE.match(event.get('content', {}).get('body', ''))
+        if match:
+            inbound_received.setdefault(int(match.group(1)), time.monotonic())
+
+    def on_xmpp_message(stanza):
+        match = OUTBOUND_RE.match(stanza.findtext('{jabber:client}body') or '')
+        if match:
+            outbound_received.setdefault(int(match.group(1)), time.monotonic())
+
+    matrix.on_event = on_matrix_event
+    xmpp.on_message = on_xmpp_message
+
+    overrides = dict(args.config_overrides)
+    if args.appservice:
+        overrides['appservice'] = {'enabled': True, 'as_token': AS_TOKEN, 'hs_token': HS_TOKEN, 'port': 0}
+
+    result = {'contacts': contacts, 'appservice': args.appservice}
+    with tempfile.TemporaryDirectory() as workdir:
+        config_file = make_config(matrix, xmpp, workdir, overrides)
+
+        # Cold start, then wait for a room to exist for every contact
+        running = RunningBot(config_file, matrix)
+        result['startup_s'] = running.startup_s
+        start = time.monotonic()
+        synced = wait_for(lambda: running.bot.rooms.count(DIRECT_ROOM) >= contacts, args.timeout)
+        result['roster_sync_s'] = time.monotonic() - start if synced else None
+
+        # XMPP -> Matrix message storm
+        for i in range(args.messages):
+            inbound_sent[i] = time.monotonic()
+            xmpp.send_message('{}/bench'.format(roster[i % contacts][0]), 'bench-{}'.format(i))
+        wait_for(lambda: len(inbound_received) >= args.messages, args.timeout)
+        result['xmpp_to_matrix'] = latency_report(inbound_sent, inbound_received)
+
+        # Matrix -> XMPP message storm
+        entries = [running.bot.rooms.by_jid(jid) for jid, _name in roster]
+        room_ids = [entry.room_id for entry in entries if entry is not None]
+        if room_ids:
+            for i in range(args.messages):
+                outbound_sent[i] = time.monotonic()
+                matrix.inject_message(room_ids[i % len(room_ids)], OWNER_ID, 'mbench-{}'.format(i))
+            wait_for(lambda: len(outbound_received) >= args.messages, args.timeout)
+        result['matrix_to_xmpp'] = latency_report(outbound_sent, outbound_received)
+
+        # Presence storm
+        start = time.monotonic()
+        for i in range(args.presences):
+            xmpp.send_presence('{}/bench'.format(roster[i % contacts][0]), available=(i // contacts) % 2 == 0)
+        time.sleep(0.1)
+        drained = wait_for(running.idle, args.timeout)
+        elapsed = time.monotonic() - start
+        result['presence'] = {'sent': args.presences,
+                              'drain_s': elapsed if drained else None,
+                              'per_s': args.presences / elapsed if drained and elapsed > 0 else None}
+
+        running.stop()
+
+        # Warm start, counting the Matrix requests it takes
+        before = sum(matrix.request_counts.values())
+        running = RunningBot(config_file, matrix)
+        result['warm_startup_s'] = running.startup_s
+        result['warm_startup_requests'] = sum(matrix.request_counts.values()) - before
+        running.stop()
+
+    result['matrix_requests'] = dict(sorted(matrix.request_counts.items()))
+    result['matrix_rate_limited'] = matrix.rate_limited
+    result['matrix_transactions'] = matrix.transactions
+
+    xmpp.stop()
+    matrix.stop()
+    return result
+
+
+def main(argv: List[str]=None):
+    parser = argparse.ArgumentParser(prog='python3 -m mxpp.bench',
+                                     description='Benchmark the bridge against local stand-in servers.')
+    parser.add_argument('--contacts', default='10,100,1000',
+                        help='Comma-separated roster sizes to benchmark (default: %(default)s)')
+    parser.add_argument('--messages', type=int, default=200,
+                        help='Messages to send in each direction (default: %(default)s)')
+    parser.add_argument('--presences', type=int, default=1000,
+                        help='Presence stanzas to send (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Latency added to each homeserver request (default: %(default)s)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Probability of a homeserver write being rate-limited (default: %(default)s)')
+    parser.add_argument('--retry-after-ms', type=int, default=100,
+                        help='retry_after_ms sent with rate-limited responses (default: %(default)s)')
+    parser.add_argument('--appservice', action='store_true',
+                        help='Run the bridge as an application service, with events pushed to it')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='Seconds to wait for each phase (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=YAML',
+                        help='Override a top-level config.yaml option, e.g. --set inbound_workers=8')
+    parser.add_argument('--output', help='Also append results to this file')
+    args = parser.parse_args(argv)
+
+    args.config_overrides = {}
+    for override in args.set:
+        key, _, value = override.partition('=')
+        args.config_overrides[key] = yaml.safe_load(value)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for contacts in [int(c) for c in args.contacts.split(',')]:
+        result = run_size(contacts, args)
+        line = json.dumps(result, sort_keys=True)
+        print(line)
+        sys.stdout.flush()
+        if args.output:
+            with open(args.output, 'a') as out_file:
+                out_file.write(line + '\n')
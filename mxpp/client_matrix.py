@@ -0,0 +1,159 @@
+import logging
+from typing import Callable, Dict, Iterable, List
+from urllib.parse import quote
+
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+
+logger = logging.getLogger(__name__)
+
+
+class ClientMatrix(MatrixClient):
+    sync_callback = None        # type: Callable[[str], None]
+    response_callback = None    # type: Callable[[str, str, int], None]
+
+    def __init__(self, *args,
+                 sync_callback: Callable[[str], None]=None,
+                 response_callback: Callable[[str, str, int], None]=None,
+                 **kwargs):
+        """
+        :param sync_callback: Called with the new sync token after every successful sync.
+        :param response_callback: Called with (method, path, status code) for every HTTP response
+            from the homeserver, including rate-limited (429) responses which are retried.
+        All other arguments are passed to MatrixClient.
+        """
+        self.sync_callback = sync_callback
+        self.response_callback = response_callback
+        MatrixClient.__init__(self, *args, **kwargs)
+
+        session = getattr(self.api, 'session', None)
+        if response_callback is not None and session is not None:
+            session.hooks['response'].append(self._handle_response)
+
+    def _handle_response(self, response, *_args, **_kwargs):
+        self.response_callback(response.request.method, response.request.path_url, response.status_code)
+
+    def _sync(self, *args, **kwargs):
+        MatrixClient._sync(self, *args, **kwargs)
+        if self.sync_callback is not None:
+            self.sync_callback(self.sync_token)
+
+    def register_filter(self, sync_filter: Dict) -> str:
+        """
+        Upload a filter to the homeserver.
+
+        :param sync_filter: Filter definition
+        :return: ID of the new filter
+        """
+        path = '/user/{}/filter'.format(quote(self.user_id))
+        return self.api._send('POST', path, sync_filter)['filter_id']
+
+    def password_login(self, username: str, password: str):
+        """
+        Log in (again) without syncing, keeping the rooms and sync token we already have.
+        Used to get a new access token if the old one stops working.
+
+        :param username: Matrix user ID to log in as
+        :param password: Password to log in with
+        """
+        response = self.api.login('m.login.password', user=username, password=password)
+        self.user_id = response['user_id']
+        self.token = response['access_token']
+        self.hs = response['home_server']
+        self.api.token = self.token
+
+    def login_and_sync(self,
+                       username: str,
+                       password: str,
+                       sync_filter: Dict=None,
+                       since: str=None,
+                       known_rooms: Iterable[str]=()):
+        """
+        Log in, then either resume syncing from a previous sync token or do a full initial sync.
+
+        Resuming only returns what changed since `since`, so the rooms we were already in must be
+         passed as `known_rooms`; their state (topic, name, ...) isn't synced and has to be
+         restored by the caller. Falls back to an initial sync if the homeserver rejects the token.
+
+        :param username: Matrix user ID to log in as
+        :param password: Password to log in with
+        :param sync_filter: Filter to use for all syncs, or None for the default
+        :param since: Sync token to resume from, or None for an initial sync
+        :param known_rooms: IDs of the rooms we were in as of `since`
+        """
+        self.password_login(username, password)
+
+        if sync_filter is not None:
+            self.sync_filter = self.register_filter(sync_filter)
+            logger.debug('Registered sync filter {}'.format(self.sync_filter))
+
+        known_rooms = list(known_rooms)
+        if since is not None and known_rooms:
+            for room_id in known_rooms:
+                self._mkroom(room_id)
+            self.sync_token = since
+            try:
+                self._sync()
+                logger.info('Resumed Matrix sync from stored token')
+                return
+            except MatrixRequestError as e:
+                if e.code >= 500:
+                    raise
+                logger.warning('Could not resume Matrix sync ({}), doing a full sync'.format(e.code))
+                self.rooms = {}
+                self.sync_token = None
+
+        self._sync()
+
+    def appservice_start(self, as_token: str, user_id: str, known_rooms: Iterable[str]=()):
+        """
+        Act as an application service's sender user instead of logging in and syncing: events are
+         pushed by the homeserver and handed to process_events.
+
+        Rooms are set up (without their state) from `known_rooms` and the rooms the user is in.
+
+        :param as_token: Application service token
+        :param user_id: User ID of the application service's sender user
+        :param known_rooms: IDs of rooms we were in as of the last run
+        """
+        self.user_id = user_id
+        self.token = as_token
+        self.api.token = as_token
+
+        room_ids = set(known_rooms) | set(self.api._send('GET', '/joined_rooms')['joined_rooms'])
+        for room_id in room_ids:
+            if room_id not in self.rooms:
+                self._mkroom(room_id)
+        logger.info('Started as application service user {} in {} rooms'.format(user_id, len(room_ids)))
+
+    def process_events(self, events: List[Dict]):
+        """
+        Handle a batch of events pushed to the application service, calling the same invite, leave,
+         room and global listeners as a sync would, in the order of the batch. Call for one batch
+         at a time, so events are handled in the order the homeserver sent them.
+
+        :param events: Events from a transaction, with their room_id
+        """
+        for event in events:
+            room_id = event.get('room_id')
+            if room_id is None:
+                continue
+            if event.get('type') == 'm.room.member' and event.get('state_key') == self.user_id:
+                membership = event.get('content', {}).get('membership')
+                if membership == 'invite':
+                    for listener in self.invite_listeners:
+                        listener(room_id, {'events': [event]})
+                    continue
+                if membership in ('leave', 'ban'):
+                    for listener in self.left_listeners:
+                        listener(room_id, {'timeline': {'events': [event]}})
+                    self.rooms.pop(room_id, None)
+                    continue
+
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self._mkroom(room_id)
+            room._put_event(event)
+            for listener in self.listeners:
+                if listener['event_type'] is None or listener['event_type'] == event['type']:
+                    listener['callback'](event)
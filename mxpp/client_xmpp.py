@@ -1,9 +1,14 @@
 import logging
-from typing import Dict
+from typing import Callable, Dict
 from queue import Queue
 
 import sleekxmpp
 from sleekxmpp.exceptions import IqError, IqTimeout
+from sleekxmpp.xmlstream.handler import Callback
+from sleekxmpp.xmlstream.matcher import MatchXPath
+
+from mxpp.mam import MamCollector, QUERY_TIMEOUT, RESULT_XPATH
+from mxpp.roster import RosterItem, preload_roster
 
 logger = logging.getLogger(__name__)
 
@@ -12,14 +17,27 @@ class ClientXMPP(sleekxmpp.ClientXMPP):
     roster_dict = {}            # type: Dict[str, str]
     jid_nick_map = {}           # type: Dict[str, str]
     inbound_queue = None          # type: Queue
+    accept_message = None         # type: Callable[[object], bool]
 
     def __init__(self,
                  inbound_queue: Queue,
                  jid: str,
                  password: str,
                  auto_authorize: bool=True,
-                 auto_subscribe: bool=True):
+                 auto_subscribe: bool=True,
+                 roster: Dict[str, RosterItem]=None,
+                 roster_version: str=None,
+                 accept_message: Callable[[object], bool]=None):
+        """
+        :param roster: Roster stored by a previous run, if any
+        :param roster_version: Version of `roster`; roster requests only ask the server for
+            changes since this version (XEP-0237).
+        :param accept_message: Called with each inbound message before it is queued; the message
+            is dropped if it returns False.
+        """
         self.inbound_queue = inbound_queue
+        self.accept_message = accept_message
+        self.mam = MamCollector()
 
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
 
@@ -30,6 +48,9 @@ class ClientXMPP(sleekxmpp.ClientXMPP):
         self.add_event_handler('presence_unavailable', self.handle_presence_unavailable)
         self.add_event_handler('message', self.handle_message)
         self.add_event_handler('groupchat_message', self.handle_groupchat_message)
+        # MAM results have no <body/>, so never reach handle_message. They are collected on the
+        #  reader thread (instream), so they are all in before the query's <iq/> result wakes send_query.
+        self.register_handler(Callback('MAM result', MatchXPath(RESULT_XPATH), self.mam.deliver, instream=True))
 
         self.register_plugin('xep_0030')  # Service Discovery
         self.register_plugin('xep_0004')  # Data Forms
@@ -39,6 +60,28 @@ class ClientXMPP(sleekxmpp.ClientXMPP):
 
         self.auto_authorize = auto_authorize
         self.auto_subscribe = auto_subscribe
+        preload_roster(self.client_roster, roster or {}, roster_version)
+
+    def send_query(self, query, to: str=None, itype: str='set', timeout: float=QUERY_TIMEOUT):
+        """
+        Send a query in an <iq/> and wait for the result.
+
+        :param query: Query element
+        :param to: JID to send the query to, or None for our own account
+        :param itype: Type of the <iq/>, 'set' or 'get'
+        :param timeout: Seconds to wait for the result
+        :return: The <iq/> result; raises IqError or IqTimeout otherwise.
+        """
+        iq = self.make_iq_set(query, ito=to)
+        iq['type'] = itype
+        return iq.send(block=True, timeout=timeout)
+
+    def request_full_roster(self):
+        """
+        Request the whole roster, rather than only the changes since the last version we have.
+        """
+        self.client_roster.version = ''
+        return self.get_roster()
 
     def handle_session_start(self, _event):
         try:
@@ -79,8 +122,14 @@ class ClientXMPP(sleekxmpp.ClientXMPP):
 
     def handle_message(self, message):
         logger.debug('XMPP Received message: {}'.format(message))
+        if self.mam.is_result(message):
+            return
+        if self.accept_message is not None and not self.accept_message(message):
+            return
         self.inbound_queue.put(message)
 
     def handle_groupchat_message(self, message):
         logger.debug('XMPP Received groupchat_message: {}'.format(message))
+        if self.accept_message is not None and not self.accept_message(message):
+            return
         self.inbound_queue.put(message)
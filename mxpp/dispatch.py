@@ -0,0 +1,186 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, Hashable, List, Set
+
+from mxpp.scheduling import ClassScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDispatcher:
+    """
+    Runs handlers on a bounded pool of worker threads.
+
+    Work items submitted under the same key (e.g. a bare JID or MUC JID) are run one at a time,
+     in the order they were submitted. Work items with different keys may run in parallel.
+
+    Each work item has a priority class (0 is most urgent). When a worker becomes free, it
+     takes the key whose next work item has the most urgent class, subject to a ClassScheduler's
+     starvation protection.
+
+    submit() never blocks; producers which want to stay within `max_queued` call
+     wait_for_capacity() first.
+    """
+    workers = None              # type: List[threading.Thread]
+    pending = None              # type: Dict[Hashable, deque]
+    ready = None                # type: List[deque]
+    active = None               # type: Set[Hashable]
+    exception_handler = None    # type: Callable[[Exception], None]
+
+    def __init__(self,
+                 num_workers: int=4,
+                 exception_handler: Callable[[Exception], None]=None,
+                 name: str='mxpp-dispatch',
+                 max_queued: int=None,
+                 num_classes: int=1,
+                 max_skips: int=16):
+        """
+        :param num_workers: Number of worker threads to run handlers on.
+        :param exception_handler: Called with any exception raised by a handler. If None,
+            the exception is logged and the worker continues.
+        :param name: Prefix for the worker thread names.
+        :param max_queued: Number of queued or running work items above which wait_for_capacity()
+            blocks, or None for no limit.
+        :param num_classes: Number of priority classes
+        :param max_skips: See ClassScheduler
+        """
+        if num_workers < 1:
+            raise ValueError('KeyedDispatcher needs at least one worker')
+
+        self.pending = {}
+        self.ready = [deque() for _cls in range(num_classes)]
+        self.scheduler = ClassScheduler(num_classes, max_skips)
+        self.active = set()
+        self.exception_handler = exception_handler
+        self.max_queued = max_queued
+        self.queued = 0
+        self.running = True
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)
+        self.capacity = threading.Condition(lock)
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='{}-{}'.format(name, i),
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key: Hashable, func: Callable, *args, priority: int=0):
+        """
+        Queue func(*args) to be run after all previously-submitted work for the same key.
+
+        :param key: Ordering key; work with equal keys is never run concurrently.
+        :param func: Handler to run.
+        :param args: Arguments for the handler.
+        :param priority: Priority class of the work, from 0 (most urgent) to num_classes - 1.
+        """
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('Dispatcher has been shut down')
+
+            queue = self.pending.get(key)
+            if queue is None:
+                queue = deque()
+                self.pending[key] = queue
+                self.ready[priority].append(key)
+                self.condition.notify()
+            queue.append((func, args, priority))
+            self.queued += 1
+
+    def has_capacity(self) -> bool:
+        """
+        :return: True if fewer than max_queued work items are queued or running.
+        """
+        with self.condition:
+            return self.max_queued is None or self.queued < self.max_queued
+
+    def wait_for_capacity(self, timeout: float=None) -> bool:
+        """
+        Block until fewer than max_queued work items are queued or running (or until shutdown).
+
+        :param timeout: Maximum number of seconds to wait, or None to wait indefinitely.
+        :return: False if the wait timed out.
+        """
+        with self.capacity:
+            return self.capacity.wait_for(
+                lambda: not self.running or self.max_queued is None or self.queued < self.max_queued,
+                timeout)
+
+    def queue_depth(self, key: Hashable) -> int:
+        """
+        :param key: Ordering key to check.
+        :return: Number of work items queued or running for the given key.
+        """
+        with self.condition:
+            depth = len(self.pending.get(key, ()))
+            if key in self.active:
+                depth += 1
+            return depth
+
+    def queue_depths(self) -> Dict[Hashable, int]:
+        """
+        :return: Snapshot of {key: number of work items queued or running} for all busy keys.
+        """
+        with self.condition:
+            depths = {key: len(queue) for key, queue in self.pending.items()}
+            for key in self.active:
+                depths[key] += 1
+            return depths
+
+    def total_depth(self) -> int:
+        """
+        :return: Number of work items queued or running across all keys.
+        """
+        with self.condition:
+            return self.queued
+
+    def shutdown(self, wait: bool=True):
+        """
+        Stop accepting work and stop the workers. Work which has not started yet is dropped.
+
+        :param wait: If True, wait for running handlers to finish.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+            self.capacity.notify_all()
+
+        if wait:
+            for worker in self.workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.running and not any(self.ready):
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+                cls = self.scheduler.pick([len(keys) > 0 for keys in self.ready])
+                key = self.ready[cls].popleft()
+                func, args, _priority = self.pending[key].popleft()
+                self.active.add(key)
+
+            try:
+                func(*args)
+            except Exception as e:
+                if self.exception_handler is None:
+                    logger.exception('Unhandled exception in dispatcher for key {}'.format(key))
+                else:
+                    self.exception_handler(e)
+            finally:
+                with self.condition:
+                    self.queued -= 1
+                    self.capacity.notify()
+                    self.active.discard(key)
+                    if self.pending[key]:
+                        _func, _args, priority = self.pending[key][0]
+                        self.ready[priority].append(key)
+                        self.condition.notify()
+                    else:
+                        del self.pending[key]
@@ -0,0 +1,281 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_RE = re.compile(r'^segment-(\d+)\.log$')
+
+
+class JournalEntry:
+    """
+    A message which has been recorded in the journal but not yet acknowledged.
+
+    The entry is acknowledged once every hold() has been matched by a release(), counting the
+     reference taken when it was recorded.
+    """
+    entry_id = None     # type: int
+    kind = None         # type: str
+    data = None         # type: Dict
+    attempts = 0        # type: int
+    claimed = False     # type: bool
+
+    def __init__(self, journal: 'Journal', entry_id: int, kind: str, data: Dict, key: str or None,
+                 segment: int, attempts: int=0):
+        self.journal = journal
+        self.entry_id = entry_id
+        self.kind = kind
+        self.data = data
+        self.key = key
+        self.segment = segment
+        self.attempts = attempts
+        self.refs = 1
+        self.lock = threading.Lock()
+
+    def hold(self):
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            done = self.refs == 0
+        if done:
+            self.journal.ack(self.entry_id)
+
+    def claim(self) -> bool:
+        """
+        Take charge of delivering the message, when an entry can be reached in more than one way
+         (e.g. both replayed and found again by its key).
+
+        :return: True the first time; False if the entry had already been claimed.
+        """
+        with self.lock:
+            claimed, self.claimed = self.claimed, True
+        return not claimed
+
+
+class Journal:
+    """
+    Append-only on-disk journal of messages being bridged.
+
+    Each message is recorded when it is received and acknowledged once it has been delivered.
+     Records are JSON lines, appended to numbered segment files; a new segment is started once
+     the current one reaches `segment_size` bytes, and old segments are deleted once everything
+     recorded in them has been acknowledged. Writes are flushed immediately but fsync'd in
+     batches every `fsync_interval` seconds, so recording a message never waits for the disk.
+
+    Entries left unacknowledged by a previous run are loaded when the journal is opened;
+     see replay_pending().
+    """
+    directory = None    # type: str
+    pending = None      # type: Dict[int, JournalEntry]
+
+    def __init__(self,
+                 directory: str,
+                 segment_size: int=4 * 1024 * 1024,
+                 fsync_interval: float=0.05,
+                 dedup_size: int=10000):
+        """
+        :param directory: Directory to keep segment files in. Created if it doesn't exist.
+        :param segment_size: Size in bytes at which to start a new segment
+        :param fsync_interval: Seconds between fsyncs of the current segment
+        :param dedup_size: Number of acknowledged message keys to remember for deduplication
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.dedup_size = dedup_size
+
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.pending_keys = {}          # type: Dict[str, int]
+        self.acked_keys = OrderedDict()  # type: Dict[str, None]
+        self.segment_counts = {}        # type: Dict[int, int]
+        self.next_id = 0
+        self.recovered = []             # type: List[JournalEntry]
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self._segments()
+        for segment in segments:
+            self._load(segment)
+        self.recovered = list(self.pending.values())
+
+        self.segment = segments[-1] + 1 if segments else 0
+        self.file = open(self._path(self.segment), 'a', encoding='utf-8')
+        self.segment_counts[self.segment] = 0
+        self._delete_finished_segments()
+
+        self.dirty = False
+        self.closed = threading.Event()
+        self.fsync_thread = threading.Thread(target=self._fsync_loop, name='mxpp-journal', daemon=True)
+        self.fsync_thread.start()
+
+        if self.recovered:
+            logger.info('Journal has {} unacknowledged messages from a previous run'.format(len(self.recovered)))
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, 'segment-{:08d}.log'.format(segment))
+
+    def _segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_RE.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _load(self, segment: int):
+        self.segment_counts[segment] = 0
+        with open(self._path(segment), 'r', encoding='utf-8') as segment_file:
+            for line in segment_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash
+                    logger.warning('Skipping damaged journal record in segment {}'.format(segment))
+                    continue
+
+                entry_id = record['id']
+                self.next_id = max(self.next_id, entry_id + 1)
+                if record['op'] == 'add':
+                    entry = JournalEntry(self, entry_id, record['kind'], record['data'], record.get('key'), segment)
+                    self.pending[entry_id] = entry
+                    if entry.key is not None:
+                        self.pending_keys[entry.key] = entry_id
+                    self.segment_counts[segment] += 1
+                elif record['op'] == 'replay' and entry_id in self.pending:
+                    self.pending[entry_id].attempts += 1
+                elif record['op'] == 'ack' and entry_id in self.pending:
+                    self._forget(self.pending.pop(entry_id))
+
+    def _forget(self, entry: JournalEntry):
+        self.segment_counts[entry.segment] -= 1
+        if entry.key is not None:
+            self.pending_keys.pop(entry.key, None)
+            self.acked_keys[entry.key] = None
+            while len(self.acked_keys) > self.dedup_size:
+                self.acked_keys.popitem(last=False)
+
+    def _write(self, record: Dict):
+        # Called with self.lock held
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.dirty = True
+
+        if self.file.tell() >= self.segment_size:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.segment += 1
+            self.file = open(self._path(self.segment), 'a', encoding='utf-8')
+            self.segment_counts[self.segment] = 0
+            self._delete_finished_segments()
+
+    def _delete_finished_segments(self):
+        # Segments are deleted oldest-first, so an entry's ack is never deleted before the entry itself
+        for segment in sorted(self.segment_counts):
+            if segment == self.segment or self.segment_counts[segment] > 0:
+                break
+            del self.segment_counts[segment]
+            try:
+                os.remove(self._path(segment))
+            except OSError as e:
+                logger.warning('Could not delete journal segment {}: {}'.format(segment, e))
+
+    def _fsync_loop(self):
+        while not self.closed.wait(self.fsync_interval):
+            with self.lock:
+                if self.dirty and not self.file.closed:
+                    os.fsync(self.file.fileno())
+                    self.dirty = False
+
+    def is_duplicate(self, key: str) -> bool:
+        """
+        :param key: Message key, e.g. a Matrix event ID
+        :return: True if a message with this key is pending or was recently acknowledged.
+        """
+        with self.lock:
+            return key in self.pending_keys or key in self.acked_keys
+
+    def find(self, key: str) -> JournalEntry or None:
+        """
+        :param key: Message key given to record()
+        :return: The pending entry with this key, or None if there is none.
+        """
+        with self.lock:
+            entry_id = self.pending_keys.get(key)
+            return self.pending.get(entry_id) if entry_id is not None else None
+
+    def record(self, kind: str, data: Dict, key: str=None) -> JournalEntry or None:
+        """
+        Record a message which has just been received.
+
+        :param kind: What sort of message this is, so it can be replayed
+        :param data: JSON-serializable data needed to replay the message
+        :param key: Unique key for the message (e.g. a Matrix event ID), used to skip duplicates
+        :return: The new entry, or None if the message is a duplicate.
+        """
+        with self.lock:
+            if key is not None and (key in self.pending_keys or key in self.acked_keys):
+                return None
+
+            entry = JournalEntry(self, self.next_id, kind, data, key, self.segment)
+            self.next_id += 1
+            self.pending[entry.entry_id] = entry
+            if key is not None:
+                self.pending_keys[key] = entry.entry_id
+            self.segment_counts[self.segment] += 1
+            self._write({'op': 'add', 'id': entry.entry_id, 'kind': kind, 'key': key, 'data': data})
+            return entry
+
+    def ack(self, entry_id: int):
+        """
+        Mark a message as delivered.
+
+        :param entry_id: ID of the entry to acknowledge
+        """
+        with self.lock:
+            entry = self.pending.pop(entry_id, None)
+            if entry is None or self.file.closed:
+                return
+            self._forget(entry)
+            self._write({'op': 'ack', 'id': entry_id})
+            self._delete_finished_segments()
+
+    def replay_pending(self, replay: Callable[[JournalEntry], None], max_attempts: int=3):
+        """
+        Replay the entries left unacknowledged by a previous run, oldest first.
+
+        :param replay: Called with each entry; must release() the entry once it has been delivered.
+        :param max_attempts: Entries which have already been replayed this many times are
+            acknowledged and dropped instead, so a message which crashes the bot can't do so forever.
+        """
+        recovered, self.recovered = self.recovered, []
+        for entry in recovered:
+            if entry.attempts >= max_attempts:
+                logger.error('Dropping journaled {} message {} after {} replays'.format(
+                    entry.kind, entry.entry_id, entry.attempts))
+                self.ack(entry.entry_id)
+                continue
+
+            with self.lock:
+                self._write({'op': 'replay', 'id': entry.entry_id})
+            entry.attempts += 1
+            entry.claim()
+            replay(entry)
+
+    def pending_count(self) -> int:
+        with self.lock:
+            return len(self.pending)
+
+    def close(self):
+        self.closed.set()
+        self.fsync_thread.join()
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
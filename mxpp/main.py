@@ -1,23 +1,69 @@
 import logging
 from typing import Dict, Tuple, List
+import functools
+import signal
 import sys
+import threading
 import time
-from queue import Queue
+from xml.etree import ElementTree
 
 if sys.version_info[0] != 3 or sys.version_info[1] < 5:
     raise Exception('mxpp requires python >= 3.5')
 
 import sleekxmpp
 from sleekxmpp import stanza
+from sleekxmpp.exceptions import IqError, IqTimeout
 import requests
 import yaml
 
-from matrix_client.client import MatrixClient
-from matrix_client.errors import MatrixError
+from matrix_client.errors import MatrixError, MatrixRequestError
 from matrix_client.room import Room as MatrixRoom
+from mxpp.appservice import TransactionServer, VirtualUsers
+from mxpp.batch import RoomBatcher
+from mxpp.client_matrix import ClientMatrix
 from mxpp.client_xmpp import ClientXMPP
+from mxpp.dispatch import KeyedDispatcher
+from mxpp.journal import Journal, JournalEntry
+from mxpp.mam import ArchivedMessage, Checkpoint, CheckpointStore, iterate_archive
+from mxpp.media import MEDIA_MSGTYPES, OOB_NS, MediaBridge, MediaError, download_url, media_event, oob_url
+from mxpp.membership import MembershipIndex
+from mxpp.metrics import Metrics, MetricsServer, normalize_endpoint
+from mxpp.muc import (DELAY_NS, HISTORY_SLACK, STANZA_ID_NS, MucHistoryIndex, delay_stamp, format_stamp,
+                      groupchat_message_key, join_muc, stanza_id)
+from mxpp.outbound import OutboundSender, text_content
+from mxpp.pending import UnknownJidBuffer
+from mxpp.policy import (BATCH_MESSAGES_TO_ALL_CHAT, SEND_MESSAGES_TO_ALL_CHAT, SEND_MESSAGES_TO_JID_ROOMS,
+                         SEND_PRESENCES_TO_CONTROL, JidPolicy)
+from mxpp.presence import PresenceAggregator
+from mxpp.profiling import Profiler, ProfilerBusy, parse_duration
+from mxpp.provision import RoomProvisioner
+from mxpp.recorder import XMPP_EVENTS, TrafficRecorder
+from mxpp.rooms import DIRECT_ROOM, GROUPCHAT_ROOM, SPECIAL_ROOM, RoomRegistry
+from mxpp.roster import RosterDiff, RosterItem, diff_roster
+from mxpp.scheduling import CHAT, GROUPCHAT, PRESENCE, ROSTER, CLASS_NAMES, ClassedBuffer
+from mxpp.spill import SpillQueue
+from mxpp.state import StateStore
+from mxpp.supervisor import Backoff, ComponentSupervisor
 
 CONFIG_FILE = 'config.yaml'
+STATE_FILE = 'mxpp_state.db'
+JOURNAL_DIR = 'mxpp_journal'
+SPILL_FILE = 'mxpp_inbound.spill'
+
+# Dispatcher key for roster updates, which aren't tied to a single JID
+ROSTER_DISPATCH_KEY = '<roster>'
+
+# Config options which `reload` applies without restarting the bot
+LIVE_CONFIG_OPTIONS = (
+    'matrix.users_to_invite',
+    'jid_groups',
+    'send_messages_to_all_chat',
+    'send_messages_to_jid_rooms',
+    'send_presences_to_control',
+    'batch_messages_to_all_chat',
+    'groupchat_mute_own_nick',
+    'groupchat_send_messages_to_all_chat',
+)
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)-8s %(message)s')
@@ -27,287 +73,1272 @@ logging.getLogger(requests.__name__).setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
 
+def changed_options(old: Dict, new: Dict, prefix: str='') -> List[str]:
+    """
+    Compare two parsed config files.
+
+    :param old: Previous config
+    :param new: New config
+    :param prefix: Prefix for option names, used when comparing sections
+    :return: Names of options which differ, e.g. ['jid_groups', 'matrix.users_to_invite'].
+        The top-level sections (matrix, xmpp, ...) are compared option by option.
+    """
+    changed = []
+    for key in sorted(set(old) | set(new), key=str):
+        old_value, new_value = old.get(key), new.get(key)
+        if old_value == new_value:
+            continue
+        if not prefix and isinstance(old_value, dict) and isinstance(new_value, dict):
+            changed += changed_options(old_value, new_value, '{}.'.format(key))
+        else:
+            changed.append(prefix + str(key))
+    return changed
+
+
 class BridgeBot:
     xmpp = None                # type: ClientXMPP
-    matrix = None              # type: MatrixClient
-    topic_room_id_map = None   # type: Dict[str, str]
-    special_rooms = None       # type: Dict[str, MatrixRoom]
+    matrix = None              # type: ClientMatrix
+    state = None               # type: StateStore
+    provisioner = None         # type: RoomProvisioner
+    membership = None          # type: MembershipIndex
+    presence = None            # type: PresenceAggregator
+    all_chat_batcher = None    # type: RoomBatcher or None
+    metrics = None             # type: Metrics
+    metrics_server = None      # type: MetricsServer or None
+    outbound = None            # type: OutboundSender
+    journal = None             # type: Journal or None
+    rooms = None               # type: RoomRegistry
+    roster_items = None        # type: Dict[str, RosterItem]
+    roster_version = None      # type: str or None
     special_room_names = None  # type: Dict[str, str]
     groupchat_flag = None      # type: str
-    groupchat_jids = None      # type: List[str]
 
     users_to_invite = None      # type: List[str]
     matrix_room_topics = None   # type: Dict[str, str]
     matrix_server = None        # type: Dict[str, str]
     matrix_login = None         # type: Dict[str, str]
+    matrix_sync = None          # type: Dict[str, bool or int]
     xmpp_server = None          # type: Tuple[str, int]
     xmpp_login = None           # type: Dict[str, str]
     xmpp_roster_options = None  # type: Dict[str, bool]
     xmpp_groupchat_nick = None  # type: str
-
-    default_actions = None          # type: Dict[str, bool]
-    jid_actions = None              # type: Dict[str, Dict[str, bool]]
+    state_file = STATE_FILE     # type: str
+    room_provisioning = None    # type: Dict[str, float]
+    presence_digest = None      # type: Dict[str, float]
+    unknown_jid_options = None  # type: Dict[str, float]
+    groupchat_history = None    # type: Dict[str, int]
+    catch_up_options = None     # type: Dict[str, int or bool]
+    media_options = None        # type: Dict[str, int or str or bool]
+    appservice_options = None   # type: Dict[str, int or str or bool]
+    all_chat_batching = None    # type: Dict[str, float]
+    async_max_in_flight = 32    # type: int
+    metrics_options = None      # type: Dict[str, str or int]
+    reconnect_backoff = None    # type: Dict[str, float]
+    outbound_options = None     # type: Dict[str, float]
+    journal_options = None      # type: Dict[str, str or float]
+    profiling_options = None    # type: Dict[str, str or float]
+    recording_options = None    # type: Dict[str, str or bool]
+
+    jid_policy = None               # type: JidPolicy
     groupchat_mute_own_nick = True                  # type: bool
     groupchat_send_messages_to_all_chat = True      # type: bool
 
-    inbound_xmpp = None         # type: Queue
+    inbound_xmpp = None         # type: SpillQueue
+    inbound_queue_options = None    # type: Dict[str, int or str]
+    inbound_workers = 4         # type: int
+    dispatcher = None           # type: KeyedDispatcher
+    unknown_jids = None         # type: UnknownJidBuffer
+    muc_history = None          # type: MucHistoryIndex
+    checkpoints = None          # type: CheckpointStore
+    catch_up = None             # type: KeyedDispatcher or None
+    media = None                # type: MediaBridge or None
+    media_dispatcher = None     # type: KeyedDispatcher or None
+    media_senders = 'roster'    # type: str
+    appservice = None           # type: TransactionServer or None
+    virtual_users = None        # type: VirtualUsers or None
+    profiler = None             # type: Profiler
+    recorder = None             # type: TrafficRecorder or None
+
+    config_file = CONFIG_FILE   # type: str
+    config = None               # type: Dict
+    matrix_supervisor = None    # type: ComponentSupervisor
+    xmpp_supervisor = None      # type: ComponentSupervisor
+    xmpp_connected = False      # type: bool
 
     exception = None            # type: Exception or None
 
+    # Errors which only cost us the event being handled (or a reconnect), rather than a restart
+    transient_errors = (MatrixError, requests.RequestException, IqError, IqTimeout)
+    # Errors which mean the bot itself is in trouble, rather than the event being handled
+    fatal_errors = (MemoryError, SystemError)
+
+    # Module providing the Presence, Message and Iq stanza classes used by self.xmpp
+    xmpp_stanzas = sleekxmpp
 
     @property
     def bot_id(self) -> str:
         return self.matrix_login['username']
 
     def __init__(self, config_file: str=CONFIG_FILE):
-        self.groupchat_jids = []
-        self.topic_room_id_map = {}
-        self.special_rooms = {
-                'control': None,
-                'all_chat': None,
-                }
         self.special_room_names = {
                 'control': 'XMPP Control Room',
                 'all_chat': 'XMPP All Chat',
                 }
         self.xmpp_roster_options = {}
-        self.inbound_xmpp = Queue()
-
+        self.room_provisioning = {}
+        self.presence_digest = {}
+        self.all_chat_batching = {}
+        self.metrics_options = {}
+        self.reconnect_backoff = {}
+        self.outbound_options = {}
+        self.journal_options = {}
+        self.inbound_queue_options = {}
+        self.journal_context = threading.local()
+        self.membership = MembershipIndex()
+
+        self.config_file = config_file
         self.load_config(config_file)
+        self.rooms = RoomRegistry(self.groupchat_flag, self.special_room_names.keys())
+        self.inbound_xmpp = self.create_inbound_queue()
+        self.dispatcher = KeyedDispatcher(self.inbound_workers,
+                                          exception_handler=self.handle_handler_exception,
+                                          max_queued=self.inbound_queue_options.get('max_dispatched', 1000),
+                                          num_classes=len(CLASS_NAMES),
+                                          max_skips=self.inbound_queue_options.get('max_skips', 16))
+        self.unknown_jids = UnknownJidBuffer(self.is_known_jid,
+                                             lambda: self.xmpp.get_roster(block=False),
+                                             self.dispatcher.submit,
+                                             stranger=self.held_stranger_event,
+                                             **self.unknown_jid_options)
+        self.matrix_supervisor = ComponentSupervisor('Matrix', self.restart_matrix,
+                                                     Backoff(**self.reconnect_backoff))
+        self.xmpp_supervisor = ComponentSupervisor('XMPP', self.restart_xmpp,
+                                                   Backoff(**self.reconnect_backoff))
+        self.setup_metrics()
+        self.profiler = Profiler(**self.profiling_options)
+        self.presence = PresenceAggregator(self.send_presence_digest, **self.presence_digest)
+        if self.all_chat_batching.pop('enabled', False):
+            self.all_chat_batcher = RoomBatcher(lambda: self.special_room('all_chat'),
+                                                self.send_event,
+                                                **self.all_chat_batching)
+
+        self.state = StateStore(self.state_file)
+        self.muc_history = MucHistoryIndex(self.state.get_muc_history(),
+                                           self.state.set_muc_history,
+                                           keys_per_room=self.groupchat_history.get('keys_per_room', 200))
+        self.checkpoints = CheckpointStore(self.state.get_checkpoints(),
+                                           self.state.set_checkpoint,
+                                           self.state.remove_checkpoint)
+        if self.catch_up_options.get('enabled', True):
+            self.catch_up = KeyedDispatcher(self.catch_up_options.get('workers', 4), name='mxpp-catchup')
+        if self.journal_options.pop('enabled', True):
+            self.journal = Journal(self.journal_options.pop('directory', JOURNAL_DIR), **self.journal_options)
+        self.matrix = self.create_matrix()
+        self.outbound = self.create_outbound()
+        self.media_senders = self.media_options.pop('senders', self.media_senders)
+        if self.media_options.pop('enabled', True):
+            self.media = MediaBridge(self.matrix.api,
+                                     lambda *args, **kwargs: self.xmpp.send_query(*args, **kwargs),
+                                     **self.media_options)
+            self.media_dispatcher = KeyedDispatcher(self.media_options.get('max_transfers', 4), name='mxpp-media')
+
+        # Start from the roster stored by the last run, so only changes since then are fetched
+        self.roster_items = self.state.get_roster()
+        self.roster_version = self.state.roster_version
+        self.xmpp = self.create_xmpp()
+        for jid, item in self.roster_items.items():
+            self.xmpp.roster_dict[jid] = item.name
+            self.xmpp.jid_nick_map[jid] = item.name
+
+        # Resume syncing from where we left off if we know which rooms we were in,
+        #  otherwise do a (filtered) initial sync
+        stored_room_ids = set(self.state.get_room_map().values()) | set(self.state.get_special_rooms().values())
+        if self.appservice_options.get('enabled', False):
+            # Events are pushed to us instead (see start_matrix_listener)
+            self.matrix.appservice_start(self.appservice_options['as_token'], self.bot_id,
+                                         known_rooms=stored_room_ids)
+            self.virtual_users = VirtualUsers(self.matrix.api,
+                                              self.bot_id.split(':', 1)[1],
+                                              prefix=self.appservice_options.get('user_prefix', 'xmpp_'),
+                                              stored=self.state.get_virtual_users(),
+                                              save=self.state.set_virtual_user)
+        else:
+            since = self.state.sync_token if self.matrix_sync.get('resume', True) else None
+            self.matrix.login_and_sync(self.matrix_login['username'],
+                                       self.matrix_login['password'],
+                                       sync_filter=self.sync_filter(),
+                                       since=since,
+                                       known_rooms=stored_room_ids)
+        self.provisioner = RoomProvisioner(self.matrix,
+                                           self.users_to_invite,
+                                           on_created=self.provisioned_room,
+                                           report=self.report_provisioning,
+                                           **self.room_provisioning)
+
+        # Recover existing matrix rooms. Topics are taken from the state store where possible,
+        #  and only fetched from the server for rooms the store doesn't know about.
+        stored_topics = {room_id: topic for topic, room_id in self.state.get_room_map().items()}
+        stored_topics.update({room_id: kind for kind, room_id in self.state.get_special_rooms().items()})
+        stored_names = self.state.get_room_names()
+        rooms = self.matrix.get_rooms()
+
+        for room in list(rooms.values()):
+            topic = stored_topics.get(room.room_id)
+            if topic is None:
+                logger.debug('Room {} is not in the state store, fetching its topic'.format(room.room_id))
+                room.update_room_topic()
+                topic = room.topic
+            elif room.topic is not None and room.topic != topic:
+                logger.warning('Room {} has topic {} but the state store says {}, using the former'.format(
+                    room.room_id, room.topic, topic))
+                self.state.remove_room_id(room.room_id)
+                topic = room.topic
+            else:
+                room.topic = topic
 
-        self.matrix = MatrixClient(**self.matrix_server)
-        self.xmpp = ClientXMPP(self.inbound_xmpp,
-                               **self.xmpp_login,
-                               **self.xmpp_roster_options)
-
-        self.matrix.login_with_password(**self.matrix_login)
-
-        # Recover existing matrix rooms
-        for room in list(self.matrix.get_rooms().values()):
-            room.update_room_topic()
-            topic = room.topic
+            if room.name is None:
+                room.name = stored_names.get(room.room_id)
 
-            if topic in self.special_rooms.keys():
+            kind, room_jid = self.rooms.parse(topic) if topic is not None else (None, None)
+            if kind == SPECIAL_ROOM:
                 logger.debug('Recovering special room: ' + topic)
-                self.special_rooms[topic] = room
+                self.rooms.add(topic, room.room_id)
 
             elif topic is None:
+                self.state.remove_room_id(room.room_id)
                 room.leave()
 
-            elif topic.startswith(self.groupchat_flag):
-                room_jid = topic[len(self.groupchat_flag):]
-                self.groupchat_jids.append(room_jid)
+            elif kind == GROUPCHAT_ROOM:
+                self.state.add_groupchat(room_jid)
+                self.map_room(topic, room)
 
-            elif not self.jid_actions.get(topic, self.default_actions)['send_messages_to_jid_rooms']:
+            elif not self.jid_policy.allows(topic, SEND_MESSAGES_TO_JID_ROOMS):
                 logger.info('Room ' + topic + ' is not needed due to send_messages_to_jid_rooms setting, leaving!')
+                self.state.remove_room_id(room.room_id)
                 room.leave()
 
+            elif '@' in topic:
+                self.map_room(topic, room)
+
+        # Forget about any stored rooms and groupchats which we are no longer in
+        for room_id in stored_topics.keys():
+            if room_id not in rooms:
+                self.state.remove_room_id(room_id)
+        for room_jid in self.state.get_groupchat_jids():
+            if self.rooms.by_jid(room_jid, GROUPCHAT_ROOM) is None:
+                self.state.remove_groupchat(room_jid)
+
         # Prepare matrix special rooms and their listeners
-        for topic, room in self.special_rooms.items():
+        for topic in self.special_room_names.keys():
+            room = self.special_room(topic)
             if room is None:
                 room = self.matrix.create_room()
             self.setup_special_room(room, topic)
 
-        self.special_rooms['control'].add_listener(self.matrix_control_message, 'm.room.message')
-        self.special_rooms['all_chat'].add_listener(self.matrix_all_chat_message, 'm.room.message')
+        self.special_room('control').add_listener(self.matrix_control_message, 'm.room.message')
+        self.special_room('all_chat').add_listener(
+            functools.partial(self.journaled_matrix_message, 'matrix_all_chat_message'), 'm.room.message')
 
         # Invite users to special rooms
-        for room in self.special_rooms.values():
+        for topic in self.special_room_names.keys():
             for user_id in self.users_to_invite:
-                room.invite_user(user_id)
+                self.special_room(topic).invite_user(user_id)
 
-        # Connect to XMPP and start processing XMPP events
-        self.xmpp.connect(self.xmpp_server)
-        self.xmpp.process(block=False)
+        if self.recording_options.pop('enabled', False):
+            self.start_recording()
 
-        # Rejoin group chats
-        logger.debug('Rejoining group chats')
-        for room_jid in self.groupchat_jids:
-            self.xmpp.plugin['xep_0045'].joinMUC(room_jid, self.xmpp_groupchat_nick)
+        # Connect to XMPP and start processing XMPP events. Group chats are (re)joined
+        #  whenever an XMPP session starts.
+        self.xmpp.add_event_handler('session_start', self.xmpp_session_start)
+        self.xmpp.add_event_handler('disconnected', self.xmpp_disconnected)
+        self.xmpp.add_event_handler('connection_failed', self.xmpp_disconnected)
+        self.start_xmpp()
 
         # Listen for Matrix events
-        def exception_handler(e: Exception):
-            self.exception = e
+        self.matrix.add_listener(self.matrix_member_event, 'm.room.member')
+        self.start_matrix_listener()
 
-        self.matrix.start_listener_thread(exception_handler=exception_handler)
+        # Finish bridging whatever was in flight when the bot last stopped
+        if self.journal is not None:
+            self.journal.replay_pending(self.replay_journal_entry)
 
         logger.debug('Done with bot init')
 
+    def start_recording(self):
+        """
+        Record the XMPP events and Matrix room events reaching the bridge to a file, for
+         replaying offline with `python3 -m mxpp.bench.replay`; see TrafficRecorder.
+        """
+        self.recorder = TrafficRecorder(self.recording_options.get('file', 'mxpp_traffic.jsonl'),
+                                        anonymise=self.recording_options.get('anonymise', True),
+                                        salt=self.recording_options.get('salt'),
+                                        own_nick=self.xmpp_groupchat_nick)
+        for name in XMPP_EVENTS:
+            self.xmpp.add_event_handler(name, functools.partial(self.recorder.record_xmpp, name))
+        self.matrix.add_listener(self.record_matrix_event)
+
+    def record_matrix_event(self, event: Dict):
+        """
+        Record a Matrix room event, along with the kind and JID of its room.
+
+        :param event: Event received by the Matrix client's global listener
+        """
+        entry = self.rooms.by_room_id(event.get('room_id'))
+        if entry is None:
+            kind, jid = None, None
+        elif entry.kind == SPECIAL_ROOM:
+            kind, jid = entry.topic, None
+        else:
+            kind, jid = entry.kind, entry.jid
+        self.recorder.record_matrix(event, kind, jid, self.is_bridge_user(event.get('sender', '')))
+
+    def setup_metrics(self):
+        """
+        Create the bot's metrics, and start serving them over HTTP if a metrics port is configured.
+        """
+        self.metrics = Metrics()
+        self.xmpp_to_matrix_latency = self.metrics.histogram(
+            'mxpp_xmpp_to_matrix_seconds',
+            'Time from receiving an XMPP message to having handled it (sent it to Matrix)')
+        self.matrix_to_xmpp_latency = self.metrics.histogram(
+            'mxpp_matrix_to_xmpp_seconds',
+            'Time from a Matrix message reaching the homeserver to it being sent over XMPP')
+        self.class_latency = [
+            self.metrics.histogram('mxpp_inbound_{}_seconds'.format(name),
+                                   'Time from receiving an inbound XMPP {} event to having handled it'.format(name))
+            for name in CLASS_NAMES]
+        self.roster_update_time = self.metrics.histogram(
+            'mxpp_roster_update_seconds',
+            'Time taken to handle an XMPP roster update')
+        self.matrix_calls = self.metrics.counter(
+            'mxpp_matrix_requests_total',
+            'HTTP responses from the Matrix homeserver',
+            ('method', 'endpoint', 'status'))
+        self.matrix_rate_limits = self.metrics.counter(
+            'mxpp_matrix_rate_limited_total',
+            'Matrix requests which were rate-limited (429)',
+            ('method', 'endpoint'))
+        self.handler_errors = self.metrics.counter(
+            'mxpp_handler_errors_total',
+            'Inbound XMPP events dropped because their handler raised',
+            ('error',))
+        self.metrics.gauge('mxpp_reconnects',
+                           'Times the Matrix listener or XMPP connection has been restarted',
+                           lambda: self.matrix_supervisor.restarts + self.xmpp_supervisor.restarts)
+        self.metrics.gauge('mxpp_inbound_queue_depth',
+                           'XMPP events waiting to be dispatched',
+                           lambda: self.inbound_xmpp.qsize())
+        self.metrics.gauge('mxpp_inbound_queue_spilled',
+                           'XMPP events waiting to be dispatched which have been spilled to disk',
+                           lambda: self.inbound_xmpp.stats()['on_disk'])
+        self.metrics.gauge('mxpp_inbound_queue_high_water',
+                           'Most XMPP events which have been waiting to be dispatched at once',
+                           lambda: self.inbound_xmpp.stats()['high_water_items'])
+        self.metrics.gauge('mxpp_inbound_queue_high_water_bytes',
+                           'Most memory used by XMPP events waiting to be dispatched at once',
+                           lambda: self.inbound_xmpp.stats()['high_water_bytes'])
+        self.metrics.gauge('mxpp_unknown_jid_held',
+                           'XMPP events from unknown JIDs waiting for a roster refresh',
+                           lambda: self.unknown_jids.held_count())
+        self.metrics.gauge('mxpp_dispatch_queue_depth',
+                           'XMPP events waiting for or being handled by a worker',
+                           lambda: self.dispatcher.total_depth())
+        self.matrix_send_time = self.metrics.histogram(
+            'mxpp_matrix_send_seconds',
+            'Time from queueing a Matrix message to the homeserver accepting it')
+        self.metrics.gauge('mxpp_outbound_queue_depth',
+                           'Matrix messages waiting to be sent or being sent',
+                           lambda: self.outbound.queue_depth() if self.outbound is not None else 0)
+        self.metrics.gauge('mxpp_outbound_failed',
+                           'Matrix messages dropped after being rejected or running out of retries',
+                           lambda: self.outbound.failed if self.outbound is not None else 0)
+        self.metrics.gauge('mxpp_journal_pending',
+                           'Bridged messages recorded in the journal but not yet delivered',
+                           lambda: self.journal.pending_count() if self.journal is not None else 0)
+        self.metrics.gauge('mxpp_rooms_pending_creation',
+                           'Rooms queued for creation',
+                           lambda: self.provisioner.pending_count() if self.provisioner is not None else 0)
+
+        if self.metrics_options.get('port') is not None:
+            self.metrics_server = MetricsServer(self.metrics,
+                                                host=self.metrics_options.get('host', '127.0.0.1'),
+                                                port=self.metrics_options['port'])
+
+    def record_matrix_response(self, method: str, path: str, status: int):
+        """
+        Count an HTTP response from the Matrix homeserver.
+
+        :param method: HTTP method of the request
+        :param path: Path of the request
+        :param status: HTTP status code of the response
+        """
+        endpoint = normalize_endpoint(path)
+        self.matrix_calls.inc(method, endpoint, str(status))
+        if status == 429:
+            self.matrix_rate_limits.inc(method, endpoint)
+
+    def observe_matrix_to_xmpp(self, event: Dict):
+        """
+        Record the latency of bridging a Matrix event to XMPP, based on the event's server timestamp.
+
+        :param event: Matrix event which was just sent over XMPP
+        """
+        timestamp = event.get('origin_server_ts')
+        if timestamp is not None:
+            self.matrix_to_xmpp_latency.observe(max(0.0, time.time() - timestamp / 1000))
+
+    def sync_filter(self) -> Dict:
+        """
+        Build the filter used for Matrix syncs: only the event types the bot handles, a short
+         timeline, and lazy-loaded members.
+
+        :return: Filter definition
+        """
+        return {
+            'presence': {'not_types': ['*']},
+            'account_data': {'not_types': ['*']},
+            'room': {
+                'timeline': {
+                    'limit': self.matrix_sync.get('timeline_limit', 10),
+                    'types': ['m.room.message', 'm.room.topic', 'm.room.member'],
+                },
+                'state': {
+                    'types': ['m.room.topic', 'm.room.name', 'm.room.member'],
+                    'lazy_load_members': self.matrix_sync.get('lazy_load_members', True),
+                },
+                'ephemeral': {'not_types': ['*']},
+                'account_data': {'not_types': ['*']},
+            },
+        }
+
+    def create_inbound_buffer(self) -> ClassedBuffer:
+        return ClassedBuffer(self.inbound_queue_options.get('spill_file', SPILL_FILE),
+                             self.event_class,
+                             self.serialize_stanza,
+                             self.deserialize_stanza,
+                             memory_budget=self.inbound_queue_options.get('memory_budget', 16 * 1024 * 1024),
+                             max_skips=self.inbound_queue_options.get('max_skips', 16))
+
+    def create_inbound_queue(self) -> SpillQueue:
+        return SpillQueue(self.create_inbound_buffer())
+
+    def event_class(self, event) -> int:
+        """
+        :param event: Inbound XMPP stanza
+        :return: Scheduling class of the event: CHAT for one-to-one messages, GROUPCHAT for MUC
+            messages, PRESENCE for presence, and ROSTER for everything else.
+        """
+        stanzas = self.xmpp_stanzas
+        if isinstance(event, stanzas.Message):
+            return GROUPCHAT if event.get_type() == 'groupchat' else CHAT
+        elif isinstance(event, stanzas.Presence):
+            return PRESENCE
+        return ROSTER
+
+    @staticmethod
+    def serialize_stanza(stanza) -> str:
+        return ElementTree.tostring(stanza.xml, encoding='unicode')
+
+    def deserialize_stanza(self, data: str):
+        """
+        :param data: Stanza serialized by serialize_stanza
+        :return: Message, Presence or Iq stanza
+        """
+        xml = ElementTree.fromstring(data)
+        stanza_class = {
+                'message': self.xmpp_stanzas.Message,
+                'presence': self.xmpp_stanzas.Presence,
+                'iq': self.xmpp_stanzas.Iq,
+        }[xml.tag.split('}')[-1]]
+        return stanza_class(self.xmpp, xml=xml)
+
+    def create_matrix(self) -> ClientMatrix:
+        return ClientMatrix(sync_callback=self.save_sync_token,
+                            response_callback=self.record_matrix_response,
+                            **self.matrix_server)
+
+    def create_outbound(self) -> OutboundSender:
+        return OutboundSender(self.matrix.api,
+                              response_callback=self.record_matrix_response,
+                              sent_callback=self.matrix_send_time.observe,
+                              **self.outbound_options)
+
+    def create_xmpp(self) -> ClientXMPP:
+        return ClientXMPP(self.inbound_xmpp,
+                          roster=self.roster_items,
+                          roster_version=self.roster_version,
+                          accept_message=self.journal_received_message,
+                          **self.xmpp_login,
+                          **self.xmpp_roster_options)
+
+    def start_xmpp(self):
+        self.xmpp.connect(self.xmpp_server)
+        self.xmpp.process(block=False)
+
+    def start_matrix_listener(self):
+        if self.appservice_options.get('enabled', False):
+            self.start_appservice()
+            return
+        self.matrix.start_listener_thread(exception_handler=self.handle_matrix_exception)
+
+    def start_appservice(self):
+        """
+        Start listening for the transactions pushed by the homeserver, unless already listening.
+         Events are handled on the listener's thread, one transaction at a time.
+        """
+        if self.appservice is not None:
+            return
+        self.appservice = TransactionServer(self.matrix.process_events,
+                                            self.appservice_options['hs_token'],
+                                            query_user=self.query_virtual_user,
+                                            exception_handler=self.handle_handler_exception,
+                                            host=self.appservice_options.get('host', '127.0.0.1'),
+                                            port=self.appservice_options.get('port', 9225))
+        self.appservice.start()
+
+    def query_virtual_user(self, user_id: str) -> bool:
+        """
+        Answer the homeserver asking whether a user in our namespace exists, creating it if it
+         belongs to a contact in the roster.
+
+        :param user_id: User ID in the application service's namespace
+        :return: True if the user exists
+        """
+        jid = self.virtual_users.jid(user_id)
+        if jid is None or jid not in self.xmpp.jid_nick_map:
+            return False
+        try:
+            self.virtual_users.ensure(jid, self.xmpp.jid_nick_map[jid])
+        except self.transient_errors as e:
+            logger.warning('Could not create {} ({})'.format(user_id, e))
+            return False
+        return True
+
+    def is_bridge_user(self, user_id: str) -> bool:
+        """
+        :return: True if `user_id` is the bot or one of its virtual users, whose messages shouldn't be bridged.
+        """
+        return user_id == self.bot_id or (self.virtual_users is not None and
+                                          self.virtual_users.jid(user_id) is not None)
+
+    def contact_user(self, room: MatrixRoom, jid: str) -> str or None:
+        """
+        :param room: Room to send a contact's message to
+        :param jid: Bare JID of the contact
+        :return: User ID of the contact's virtual user (now joined to `room`) to send the message as,
+            or None to send it as the bot.
+        """
+        if self.virtual_users is None:
+            return None
+        try:
+            return self.virtual_users.join(room.room_id, jid, self.xmpp.jid_nick_map.get(jid))
+        except self.transient_errors as e:
+            logger.warning('Could not use the virtual user for {} ({}), sending as the bot'.format(jid, e))
+            return None
+
+    def set_contact_name(self, room: MatrixRoom, name: str):
+        """
+        Show a contact's name in its room: as its virtual user's display name if there are virtual
+         users, otherwise as the bot's display name in the room.
+
+        :param room: The contact's (mapped) room
+        :param name: Name to show
+        """
+        entry = self.rooms.by_room_id(room.room_id)
+        if self.virtual_users is not None and entry is not None and entry.kind == DIRECT_ROOM:
+            self.virtual_users.ensure(entry.jid, name)
+        else:
+            room.set_user_profile(displayname=name)
+
+    def restart_matrix(self, error: Exception):
+        """
+        Restart the Matrix listener after it failed, logging in again if our access token
+         was rejected. Rooms, listeners and the sync token are kept, so syncing carries on
+         from where it stopped.
+
+        :param error: The failure which stopped the listener
+        """
+        self.matrix.stop_listener_thread()
+        if isinstance(error, MatrixRequestError) and error.code == 401:
+            logger.info('Matrix access token was rejected, logging in again')
+            self.matrix.password_login(self.matrix_login['username'], self.matrix_login['password'])
+        self.start_matrix_listener()
+
+    def restart_xmpp(self, _error: Exception):
+        """
+        Reconnect to the XMPP server, unless the connection has already come back by itself.
+        Group chats are rejoined by xmpp_session_start once the new session starts.
+
+        :param _error: The failure (unused)
+        """
+        if self.xmpp_connected:
+            return
+        self.xmpp.reconnect()
+
     def shutdown(self):
+        self.matrix_supervisor.stop()
+        self.xmpp_supervisor.stop()
+        self.presence.shutdown()
+        self.unknown_jids.close()
+        if self.all_chat_batcher is not None:
+            self.all_chat_batcher.shutdown()
+        if self.outbound is not None:
+            self.outbound.shutdown()
         self.matrix.stop_listener_thread()
+        if self.appservice is not None:
+            self.appservice.shutdown()
         self.xmpp.disconnect()
+        if self.catch_up is not None:
+            self.catch_up.shutdown(wait=False)
+        if self.media is not None:
+            self.media_dispatcher.shutdown(wait=False)
+            self.media.close()
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown(wait=False)
+        if self.provisioner is not None:
+            self.provisioner.shutdown()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        self.muc_history.flush()
+        self.checkpoints.flush()
+        self.state.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.inbound_xmpp.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def save_sync_token(self, token: str):
+        """
+        Persist the latest Matrix sync token to the state store.
+
+        :param token: next_batch token from the latest sync
+        """
+        self.state.sync_token = token
+
+    def handle_exception(self, e: Exception):
+        """
+        Record an exception from a background thread and wake up handle_inbound_xmpp,
+         which will re-raise it.
+
+        :param e: The exception that was raised.
+        """
+        self.exception = e
+        self.inbound_xmpp.put(None)
+
+    def handle_handler_exception(self, e: Exception):
+        """
+        Handle an exception raised while handling an inbound XMPP event.
+
+        Errors from a single event (transient network, homeserver or XMPP server errors, as well
+         as bugs triggered by an odd stanza) only cost us that event: it is logged, counted and
+         dropped, and its journal entry (if any) is left pending, to be replayed on the next
+         startup (see Journal.replay_pending). Only self.fatal_errors are passed to
+         handle_exception, which restarts the bot.
+
+        :param e: The exception that was raised.
+        """
+        if isinstance(e, self.fatal_errors):
+            self.handle_exception(e)
+            return
+
+        if isinstance(e, self.transient_errors):
+            logger.error('Failed to handle XMPP event: {}'.format(e))
+        else:
+            logger.error('Error while handling XMPP event, dropping it', exc_info=e)
+        self.handler_errors.inc(type(e).__name__)
+
+    def handle_matrix_exception(self, e: Exception):
+        """
+        Handle an exception from the Matrix listener thread.
+
+        Transient errors stop the listener and have self.matrix_supervisor restart it after a backoff;
+         anything else is passed to handle_exception.
+
+        :param e: The exception that was raised.
+        """
+        if not isinstance(e, self.transient_errors):
+            self.handle_exception(e)
+            return
+
+        # Stop syncing until the supervisor restarts the listener
+        self.matrix.should_listen = False
+        self.matrix_supervisor.failed(e)
 
     def handle_inbound_xmpp(self):
+        """
+        Pull events off the inbound XMPP queue and dispatch them to their handlers.
+
+        Returns only by raising an exception from one of the handlers or from the Matrix listener.
+        """
         while self.exception is None:
-            event = self.inbound_xmpp.get()
+            # Leave events in self.inbound_xmpp (which spills to disk) rather than letting the
+            #  dispatcher's queues grow without limit
+            if not self.dispatcher.wait_for_capacity(timeout=1):
+                continue
+            queued = self.inbound_xmpp.get()
+            if queued is None:
+                continue
+            self.dispatch_event(queued.event, queued.cls, queued.received)
+        raise self.exception
 
-            if isinstance(event, sleekxmpp.Presence):
-                handler = {
-                        'available': self.xmpp_presence_available,
-                        'unavailable': self.xmpp_presence_unavailable,
-                }.get(event.get_type(), self.xmpp_unrecognized_event)
+    def dispatch_event(self, event, cls: int=None, received: float=None):
+        """
+        Pass an inbound XMPP event to its handler.
+
+        Handlers run on a pool of self.inbound_workers threads. Events from the same bare JID
+         (or MUC) are handled in the order they were received, while events from different JIDs
+         are handled in parallel. When workers are busy, one-to-one messages are handled first,
+         then MUC messages, presence and roster updates (see KeyedDispatcher).
 
-            elif isinstance(event, sleekxmpp.Message):
-                handler = {
-                        'normal': self.xmpp_message,
-                        'chat': self.xmpp_message,
-                        'groupchat': self.xmpp_groupchat_message,
-                }.get(event.get_type(), self.xmpp_unrecognized_event)
+        :param event: Inbound XMPP stanza
+        :param cls: Scheduling class of the event; see event_class()
+        :param received: time.time() when the event was received
+        """
+        if cls is None:
+            cls = self.event_class(event)
+        if received is None:
+            received = time.time()
+
+        stanzas = self.xmpp_stanzas
+        if isinstance(event, stanzas.Presence):
+            handler = {
+                    'available': self.xmpp_presence_available,
+                    'unavailable': self.xmpp_presence_unavailable,
+            }.get(event.get_type(), self.xmpp_unrecognized_event)
+
+        elif isinstance(event, stanzas.Message):
+            handler = {
+                    'normal': self.xmpp_message,
+                    'chat': self.xmpp_message,
+                    'groupchat': self.xmpp_groupchat_message,
+            }.get(event.get_type(), self.xmpp_unrecognized_event)
+
+        elif isinstance(event, stanzas.Iq) and event.get_query() == 'jabber:iq:roster':
+            handler = self.xmpp_roster_update
 
-            elif isinstance(event, sleekxmpp.Iq) and event.get_query() == 'jabber:iq:roster':
-                handler = self.xmpp_roster_update
+        else:
+            handler = self.xmpp_unrecognized_event
+
+        entry = None
+        if handler in (self.xmpp_message, self.xmpp_groupchat_message) and self.journal is not None:
+            key = self.xmpp_message_key(event)
+            entry = self.journal.find(key) if key is not None else None
+            if entry is None:
+                # Not recorded on receipt (see journal_received_message), e.g. a message without
+                #  an ID, or one imported from the archive
+                entry = self.journal.record('xmpp', {'stanza': self.serialize_stanza(event)}, key)
+                if entry is None:
+                    logger.debug('Skipping duplicate XMPP message {}'.format(event['id']))
+                    return
+            if not entry.claim():
+                # Also in the spill file saved by the previous run, and already being replayed
+                logger.debug('Skipping XMPP message {}, which is being replayed'.format(event['id']))
+                return
+        self.dispatcher.submit(self.dispatch_key(event), self.timed_handler,
+                               handler, event, cls, received, entry, priority=cls)
+
+    def timed_handler(self, handler, event, cls: int, received: float, entry: JournalEntry=None):
+        """
+        Run an event handler and record how long it has been since the event was received.
+
+        :param handler: Handler to run
+        :param event: Inbound XMPP stanza
+        :param cls: Scheduling class of the event
+        :param received: time.time() when the event was received
+        :param entry: Journal entry for the event, if any; see run_journaled
+        """
+        self.run_journaled(entry, handler, event)
+
+        elapsed = time.time() - received
+        self.class_latency[cls].observe(elapsed)
+        if cls in (CHAT, GROUPCHAT):
+            self.xmpp_to_matrix_latency.observe(elapsed)
+
+    @staticmethod
+    def xmpp_message_key(message) -> str or None:
+        """
+        :param message: Inbound XMPP message
+        :return: Key identifying the message for the journal's deduplication, or None if the
+            message has no ID.
+        """
+        if not message['id']:
+            return None
+        return 'xmpp:{}:{}'.format(message['from'].full, message['id'])
+
+    def journal_received_message(self, message) -> bool:
+        """
+        Record an XMPP message in the journal as soon as the XMPP client receives it, before it is
+         queued in self.inbound_xmpp: the queue only writes the events it holds in memory to disk
+         when it is closed, so they would be lost in a crash. dispatch_event finds the entry again
+         by the message's key.
+
+        Messages without an ID have no key to find their entry by, so they are only journaled
+         when they are dispatched.
+
+        :param message: Message received by the XMPP client
+        :return: False if the message is a duplicate, and should be dropped.
+        """
+        if self.journal is None or message['type'] not in ('normal', 'chat', 'groupchat'):
+            return True
+        key = self.xmpp_message_key(message)
+        if key is None:
+            return True
+        if self.journal.record('xmpp', {'stanza': self.serialize_stanza(message)}, key) is None:
+            logger.debug('Skipping duplicate XMPP message {}'.format(message['id']))
+            return False
+        return True
+
+    def run_journaled(self, entry: JournalEntry or None, handler, *args):
+        """
+        Run a message handler on behalf of a journal entry.
+
+        Messages the handler sends to Matrix hold the entry open until the homeserver has accepted
+         them (see send_event), so the entry is only acknowledged once the message has been fully
+         bridged. If the handler raises, the entry is left unacknowledged and replayed on the
+         next startup.
+
+        :param entry: Journal entry for the message, or None if it isn't journaled
+        :param handler: Handler to run
+        :param args: Arguments for the handler
+        """
+        if entry is None:
+            handler(*args)
+            return
+
+        self.journal_context.entry = entry
+        try:
+            handler(*args)
+        finally:
+            self.journal_context.entry = None
+        entry.release()
+
+    def journaled_matrix_message(self, handler_name: str, room: MatrixRoom, event: Dict):
+        """
+        Record a Matrix message in the journal, then pass it to its handler.
+        Messages which are already in the journal (e.g. re-sent by the homeserver after a restart)
+         are skipped.
+
+        :param handler_name: Name of the handler method, e.g. 'matrix_message'
+        :param room: Room the message was sent to
+        :param event: The Matrix event that was received
+        """
+        handler = getattr(self, handler_name)
+        if self.journal is None or self.is_bridge_user(event['sender']) or 'event_id' not in event:
+            handler(room, event)
+            return
+
+        entry = self.journal.record('matrix',
+                                    {'handler': handler_name, 'room_id': room.room_id, 'event': event},
+                                    event['event_id'])
+        if entry is None:
+            logger.debug('Skipping duplicate Matrix event {}'.format(event['event_id']))
+            return
+        self.run_journaled(entry, handler, room, event)
+
+    def replay_journal_entry(self, entry: JournalEntry):
+        """
+        Queue a message left unacknowledged in the journal by a previous run to be bridged again.
 
+        :param entry: Journal entry to replay
+        """
+        if entry.kind == 'xmpp':
+            message = self.deserialize_stanza(entry.data['stanza'])
+            if message['type'] == 'groupchat':
+                handler = self.xmpp_groupchat_message
             else:
-                handler = self.xmpp_unrecognized_event
+                handler = self.xmpp_message
+            self.dispatcher.submit(self.dispatch_key(message), self.run_journaled, entry, handler, message,
+                                   priority=self.event_class(message))
 
-            handler(event)
-        raise self.exception
+        elif entry.kind == 'matrix':
+            room = self.matrix.get_rooms().get(entry.data['room_id'])
+            if room is None:
+                logger.warning('Not replaying message for room {}, which no longer exists'.format(
+                    entry.data['room_id']))
+                entry.release()
+                return
+            handler = getattr(self, entry.data['handler'])
+            self.dispatcher.submit(room.room_id, self.run_journaled, entry, handler, room, entry.data['event'])
+
+    def dispatch_key(self, event) -> str:
+        """
+        Determine the ordering key for an inbound XMPP event.
+
+        :param event: Inbound XMPP stanza
+        :return: Bare JID the event came from, or ROSTER_DISPATCH_KEY for roster updates.
+        """
+        if isinstance(event, (self.xmpp_stanzas.Presence, self.xmpp_stanzas.Message)):
+            return event['from'].bare
+        return ROSTER_DISPATCH_KEY
 
     def load_config(self, path: str):
         with open(path, 'r') as conf_file:
             config = yaml.safe_load(conf_file)
+        self.config = config
 
-        self.users_to_invite = config['matrix']['users_to_invite']
+        self.load_live_config(config)
         self.matrix_room_topics = config['matrix']['room_topics']
         self.groupchat_flag = config['matrix']['groupchat_flag']
 
         self.matrix_server = config['matrix']['server']
         self.matrix_login = config['matrix']['login']
+        self.matrix_sync = config['matrix'].get('sync', {})
         self.xmpp_server = (config['xmpp']['server']['host'],
                             config['xmpp']['server']['port'])
         self.xmpp_login = config['xmpp']['login']
         self.xmpp_groupchat_nick = config['xmpp']['groupchat_nick']
 
-        self.default_actions = {k: config[k] for k in ('send_messages_to_all_chat',
-                                                       'send_messages_to_jid_rooms',
-                                                       'send_presences_to_control')}
-        self.jid_actions = {}
-        for group in config['jid_groups']:
-            group_data = group.copy()
-            group_jids = group_data.pop('jids')
-            for jid in group['jids']:
-                self.jid_actions.setdefault(jid, self.default_actions.copy())
-                self.jid_actions[jid].update(group_data)
+        self.xmpp_roster_options = config['xmpp']['roster_options']
+
+        self.inbound_workers = config.get('inbound_workers', self.inbound_workers)
+        self.state_file = config.get('state_file', self.state_file)
+        self.room_provisioning = config.get('room_provisioning', {})
+        self.presence_digest = config.get('presence_digest', {})
+        self.unknown_jid_options = config.get('unknown_jids', {})
+        self.groupchat_history = dict(config.get('groupchat_history', {}))
+        self.catch_up_options = dict(config.get('catch_up', {}))
+        self.media_options = dict(config.get('media', {}))
+        self.appservice_options = dict(config.get('appservice', {}))
+        self.all_chat_batching = dict(config.get('all_chat_batching', {}))
+        self.async_max_in_flight = config.get('async_max_in_flight', self.async_max_in_flight)
+        self.metrics_options = config.get('metrics', {})
+        self.outbound_options = config.get('outbound', {})
+        self.journal_options = dict(config.get('journal', {}))
+        self.profiling_options = config.get('profiling', {})
+        self.recording_options = dict(config.get('recording', {}))
+        self.inbound_queue_options = config.get('inbound_queue', {})
+        self.reconnect_backoff = config.get('reconnect', {})
+
+    def load_live_config(self, config: Dict):
+        """
+        Load the options which can be changed while the bot is running (see LIVE_CONFIG_OPTIONS).
+
+        :param config: Parsed config file
+        """
+        default_actions = {k: config[k] for k in ('send_messages_to_all_chat',
+                                                  'send_messages_to_jid_rooms',
+                                                  'send_presences_to_control')}
+        default_actions['batch_messages_to_all_chat'] = config.get('batch_messages_to_all_chat', True)
+
+        # Swap in a whole new index so handlers running on other threads never see a half-built one
+        self.jid_policy = JidPolicy(default_actions, config['jid_groups'] or [],
+                                    cache_size=config.get('jid_policy_cache_size', 4096))
+        self.users_to_invite = config['matrix']['users_to_invite']
+        if self.provisioner is not None:
+            self.provisioner.users_to_invite = self.users_to_invite
 
         self.groupchat_mute_own_nick = config['groupchat_mute_own_nick']
         self.groupchat_send_messages_to_all_chat = config['groupchat_send_messages_to_all_chat']
 
-        self.xmpp_roster_options = config['xmpp']['roster_options']
+    def reload_config(self) -> str:
+        """
+        Re-read the config file and apply the options listed in LIVE_CONFIG_OPTIONS.
+
+        Rooms for JIDs which no longer have send_messages_to_jid_rooms set are left, and the roster
+         is re-requested so that missing rooms are created and new users_to_invite are invited.
+         Changes to any other option only take effect after a restart.
+
+        :return: Summary of what was reloaded, for the control room
+        """
+        with open(self.config_file, 'r') as conf_file:
+            config = yaml.safe_load(conf_file)
+
+        changed = changed_options(self.config, config)
+        needs_restart = [option for option in changed if option not in LIVE_CONFIG_OPTIONS]
+        self.load_live_config(config)
+
+        for jid in self.rooms.jids(DIRECT_ROOM):
+            if not self.jid_policy.allows(jid, SEND_MESSAGES_TO_JID_ROOMS):
+                logger.info('Room ' + jid + ' is not needed due to send_messages_to_jid_rooms setting, leaving!')
+                self.leave_mapped_room(jid)
+
+        self.dispatcher.submit(ROSTER_DISPATCH_KEY, self.resync_roster_rooms, priority=ROSTER)
+
+        msg = 'Reloaded {}'.format(self.config_file)
+        if needs_restart:
+            msg += '; changes to {} need a restart'.format(', '.join(needs_restart))
+        logger.info(msg)
+        return msg
+
+    def request_reload(self, *_args):
+        """
+        Reload the config file (see reload_config) on a separate thread, reporting the result
+         to the control room. Usable as a signal handler.
+        """
+        def reload():
+            try:
+                msg = self.reload_config()
+            except Exception as e:
+                logger.exception('Failed to reload config')
+                msg = 'Failed to reload {}: {}'.format(self.config_file, e)
+            self.send_notice(self.special_room('control'), msg)
+
+        threading.Thread(target=reload, name='mxpp-reload', daemon=True).start()
+
+    def request_diagnostic(self, name: str, *args):
+        """
+        Run one of self.profiler's diagnostics on a separate thread, posting its summary to the
+         control room when it finishes.
+
+        :param name: Diagnostic to run, see Profiler.run
+        :param args: Arguments for the diagnostic (e.g. its duration)
+        """
+        def run():
+            try:
+                msg = self.profiler.run(name, *args)
+            except ProfilerBusy as e:
+                msg = str(e)
+            except Exception as e:
+                logger.exception('Diagnostic {} failed'.format(name))
+                msg = 'Diagnostic {} failed: {}'.format(name, e)
+            self.send_notice(self.special_room('control'), msg)
+
+        if args:
+            self.send_notice(self.special_room('control'), 'Running {} for {:g}s'.format(
+                name.replace('_', ' '), self.profiler.clamp(args[0])))
+        threading.Thread(target=run, name='mxpp-profiler', daemon=True).start()
 
     def get_room_for_topic(self, jid: str) -> MatrixRoom:
         """
         Return the room corresponding to the given XMPP JID
+        If the room is still queued for creation, moves it to the front of the queue and waits
+         (up to room_provisioning's wait_timeout) for it to be created.
+
         :param jid: bare XMPP JID, should not include the resource
         :return: Matrix room object for chatting with that JID
+        :raises KeyError: if there is no room for the JID, or it wasn't created in time.
+        """
+        entry = self.rooms.by_topic(jid)
+        if entry is None and self.provisioner.is_pending(jid):
+            logger.debug('Waiting for room with topic {} to be created'.format(jid))
+            if self.provisioner.wait_for(jid, self.provisioner.wait_timeout) is None:
+                logger.warning('Room with topic {} was not created within {}s'.format(
+                    jid, self.provisioner.wait_timeout))
+            entry = self.rooms.by_topic(jid)
+
+        if entry is None:
+            raise KeyError(jid)
+        return self.matrix.get_rooms()[entry.room_id]
+
+    def special_room(self, topic: str) -> MatrixRoom or None:
         """
-        room_id = self.topic_room_id_map[jid]
-        return self.matrix.get_rooms()[room_id]
+        :param topic: Topic of a special room, e.g. 'control'
+        :return: The special room, or None if it hasn't been set up yet.
+        """
+        entry = self.rooms.by_topic(topic)
+        if entry is None:
+            return None
+        return self.matrix.get_rooms().get(entry.room_id)
 
     def get_unmapped_rooms(self) -> List[MatrixRoom]:
         """
-        Returns a list of all Matrix rooms which are not a special room (e.g., the control room) and
-        do not have a corresponding entry in the topic -> room map.
+        Returns a list of all Matrix rooms which are not in self.rooms (neither mapped nor special).
         :return: List of unmapped, non-special Matrix room objects.
         """
-        special_room_ids = [r.room_id for r in self.special_rooms.values()]
-        valid_room_ids = [v for v in self.topic_room_id_map.values()] + special_room_ids
-        unmapped_rooms = [room for room_id, room in self.matrix.get_rooms().items()
-                          if room_id not in valid_room_ids]
-        return unmapped_rooms
+        return [room for room_id, room in self.matrix.get_rooms().items()
+                if self.rooms.by_room_id(room_id) is None]
 
     def get_empty_rooms(self) -> List[MatrixRoom]:
         """
-        Returns a list of all Matrix rooms which are occupied by only one user
-        (the bot itself).
+        Returns a list of all Matrix rooms which are occupied by only the bot itself
+        (and its virtual users).
         :return: List of Matrix rooms occupied by only the bot.
         """
-        empty_rooms = [room for room in self.matrix.get_rooms().values()
-                       if len(room.get_joined_members()) < 2]
+        empty_rooms = []
+        for room in self.matrix.get_rooms().values():
+            self.ensure_membership(room)
+            if not [user_id for user_id in self.membership.members(room.room_id)
+                    if not self.is_bridge_user(user_id)]:
+                empty_rooms.append(room)
         return empty_rooms
 
+    def ensure_membership(self, room: MatrixRoom):
+        """
+        Seed the membership index for a room from its joined members, unless it is already seeded.
+
+        :param room: Room to check
+        """
+        if not self.membership.is_seeded(room.room_id):
+            self.seed_membership(room)
+
+    def seed_membership(self, room: MatrixRoom):
+        """
+        (Re-)seed the membership index for a room by fetching its joined members from the server.
+
+        :param room: Room to fetch members for
+        """
+        # Depending on the matrix_client version, this is either a dict keyed by user ID
+        #  or a list of User objects
+        members = room.get_joined_members()
+        user_ids = [getattr(member, 'user_id', member) for member in members]
+        self.membership.seed(room.room_id, {user_id: 'join' for user_id in user_ids})
+
+    def invite_users(self, room: MatrixRoom):
+        """
+        Invite each of self.users_to_invite who hasn't already joined or been invited to the room.
+
+        :param room: Room to invite users to
+        """
+        self.ensure_membership(room)
+        for user_id in self.membership.missing(room.room_id, self.users_to_invite):
+            if room.invite_user(user_id) is not False:
+                self.membership.update(room.room_id, user_id, 'invite')
+
+    def resync_membership(self) -> int:
+        """
+        Throw away the membership index and re-seed it from the server for every room.
+
+        :return: Number of rooms which were re-seeded
+        """
+        self.membership.clear()
+        rooms = list(self.matrix.get_rooms().values())
+        for room in rooms:
+            self.seed_membership(room)
+        return len(rooms)
+
     def setup_special_room(self, room, topic: str):
         """
-        Sets up a Matrix room with the requested topic and adds it to the self.special_rooms map.
+        Sets up a Matrix room with the requested topic and registers it in self.rooms .
 
-        If a special room with that topic already exists, it is replaced in the special_rooms
-         map by the new room.
+        If a special room with that topic already exists, it is replaced in self.rooms by the new room.
         :param room: Room to set up
         :param topic: Topic for the room
         """
         room.set_room_topic(topic)
         room.set_room_name(self.special_room_names[topic])
-        self.special_rooms[topic] = room
+        self.rooms.add(topic, room.room_id)
+        self.state.set_special_room(topic, room.room_id)
 
         logger.debug('Set up special room with topic {} and id'.format(
             str(room.topic), room.room_id))
 
     def create_mapped_room(self, topic: str, name: str=None) -> MatrixRoom or None:
         """
-        Create a new room and add it to self.topic_room_id_map.
+        Create a new room and add it to self.rooms .
 
         :param topic: Topic for the new room
         :param name: (Optional) Name for the new room
         :return: Room which was created
         """
-        if topic in self.groupchat_jids:
+        entry = self.rooms.by_topic(topic)
+        if self.rooms.by_jid(topic, GROUPCHAT_ROOM) is not None:
             logger.debug('Topic {} is a groupchat without its flag, ignoring'.format(topic))
             return None
-        elif topic in self.topic_room_id_map.keys():
-            room_id = self.topic_room_id_map[topic]
-            room = self.matrix.get_rooms()[room_id]
+        elif entry is not None:
+            room = self.matrix.get_rooms()[entry.room_id]
             logger.debug('Room with topic {} already exists!'.format(topic))
         else:
-            room = self.matrix.create_room()
-            room.set_room_topic(topic)
-            self.topic_room_id_map[topic] = room.room_id
+            room = self.provisioner.create_room(topic, self.mapped_room_name(topic, name))
+            self.provisioned_room(topic, room)
             logger.info('Created mapped room with topic {} and id {}'.format(topic, str(room.room_id)))
-            room.add_listener(self.matrix_message, 'm.room.message')
+            return room
 
         if room.name != name:
             if name != "":
                 room.set_room_name(name)
-                room.set_user_profile(displayname=name)
+                self.set_contact_name(room, name)
             else:
                 room.set_room_name(topic.split('@')[0])
+            self.state.set_room_name(room.room_id, room.name)
 
         return room
 
+    @staticmethod
+    def mapped_room_name(topic: str, name: str or None) -> str or None:
+        """
+        Determine the name to give a new mapped room.
+
+        :param topic: Topic for the room
+        :param name: Contact's name from the roster; "" if the contact has no name, or None for no name.
+        :return: Name for the room, or None if it shouldn't be named.
+        """
+        if name == "":
+            return topic.split('@')[0]
+        return name
+
+    def provisioned_room(self, topic: str, room: MatrixRoom):
+        """
+        Map a newly created room, and set the bot's display name in it to the contact's name.
+
+        :param topic: Topic of the new room
+        :param room: The new room
+        """
+        self.map_room(topic, room)
+        self.state.set_room_name(room.room_id, room.name)
+        memberships = {user_id: 'invite' for user_id in self.users_to_invite}
+        memberships[self.bot_id] = 'join'
+        self.membership.seed(room.room_id, memberships)
+
+        name = self.xmpp.jid_nick_map.get(topic)
+        if name:
+            self.set_contact_name(room, name)
+
+    def report_provisioning(self, message: str):
+        """
+        Post room provisioning progress to the control room.
+
+        :param message: Progress message
+        """
+        logger.info(message)
+        self.send_notice(self.special_room('control'), message)
+
     def leave_mapped_room(self, topic: str) -> bool:
         """
-        Leave an existing, mapped room and remove it from self.topic_room_id_map.
+        Leave an existing, mapped room and remove it from self.rooms .
 
         :param topic: Topic for room to leave
         :retrun: True if the room was left, False if the room was not found.
         """
-        if topic in self.groupchat_jids:
+        if self.rooms.by_jid(topic, GROUPCHAT_ROOM) is not None:
             logger.debug('Topic {} is a groupchat without its flag, ignoring'.format(topic))
             return False
 
-        if topic not in self.topic_room_id_map.keys():
+        entry = self.rooms.by_topic(topic)
+        if entry is None or entry.kind == SPECIAL_ROOM:
             err_msg = 'Room with topic {} isn\'t mapped or doesn\'t exist'.format(topic)
             logger.warning(err_msg)
             return False
 
-        if topic.startswith(self.groupchat_flag):
+        if entry.kind == GROUPCHAT_ROOM:
             # Leave the groupchat
-            room_jid = topic[len(self.groupchat_flag):]
-            if room_jid in self.groupchat_jids:
-                self.groupchat_jids.remove(room_jid)
+            room_jid = entry.jid
+            self.state.remove_groupchat(room_jid)
+            self.muc_history.forget(room_jid)
+            self.checkpoints.forget(room_jid)
             logger.info('XMPP MUC leave: {}'.format(room_jid))
             self.xmpp.plugin['xep_0045'].leaveMUC(room_jid, self.xmpp_groupchat_nick)
 
-        room = self.get_room_for_topic(topic)
-        del self.topic_room_id_map[topic]
+        room = self.matrix.get_rooms()[entry.room_id]
+        self.rooms.remove(topic)
+        self.state.remove_room(topic)
+        self.membership.forget(room.room_id)
+        if self.virtual_users is not None:
+            self.virtual_users.forget_room(room.room_id)
         room.leave()
         logger.info('Left mapped room with topic {}'.format(topic))
         return True
 
+    def map_room(self, topic: str, room: MatrixRoom):
+        """
+        Add a room to self.rooms (and the state store), and listen to messages from it.
+
+        :param topic: Topic of the room
+        :param room: Room to map
+        """
+        self.rooms.add(topic, room.room_id)
+        self.state.set_room(topic, room.room_id)
+        room.add_listener(functools.partial(self.journaled_matrix_message, 'matrix_message'), 'm.room.message')
+
     def map_rooms_by_topic(self):
         """
-        Add unmapped rooms to self.topic_room_id_map, and listen to messages from those rooms.
+        Add unmapped rooms to self.rooms, and listen to messages from those rooms.
 
         Rooms whose topics are empty or do not contain an '@' symbol are assumed to be special
          rooms, and will not be mapped.
+
+        Rooms which are already known (e.g. recovered from the state store) are skipped, so the
+         topic is only fetched from the server for rooms which appeared unexpectedly.
         """
         unmapped_rooms = self.get_unmapped_rooms()
 
@@ -319,24 +1350,31 @@ class BridgeBot:
             if room.topic is None or '@' not in room.topic:
                 logger.debug('Leaving it as-is (special room, topic does not contain @)')
             else:
-                self.topic_room_id_map[room.topic] = room.room_id
-                room.add_listener(self.matrix_message, 'm.room.message')
+                self.map_room(room.topic, room)
 
     def matrix_control_message(self, room: MatrixRoom, event: Dict):
         """
         Handle a message sent to the control room.
 
         Does nothing unless a valid command is received:
-          refresh  Probes the presence of all XMPP contacts, and updates the roster.
+          refresh  Probes the presence of all XMPP contacts, and updates the roster. Every contact
+                   gets a room if it's missing one.
           purge    Leaves any ((un-mapped and non-special) or empty) Matrix rooms.
           joinmuc some@muc.com   Joins a muc
           leavemuc some@muc.com  Leaves a muc
+          queues   Lists the JIDs with inbound XMPP events waiting to be handled
+          resync   Re-fetches the membership of every room from the server
+          stats    Shows latency, queue depth and Matrix request statistics
+          reload   Re-reads config.yaml and applies jid_groups, users_to_invite, etc. without restarting
+          profile [30s]      Samples the stacks of every thread and shows the hottest functions
+          memsnapshot [30s]  Traces memory allocations and shows the largest allocation sites
+          threads  Shows where every thread is (e.g. what it is blocked on)
 
         :param room: Matrix room object representing the control room
         :param event: The Matrix event that was received. Assumed to be an m.room.message .
         """
         # Always ignore our own messages
-        if event['sender'] == self.bot_id:
+        if self.is_bridge_user(event['sender']):
             return
 
         logger.debug('matrix_control_message: {}  {}'.format(room.room_id, str(event)))
@@ -351,21 +1389,23 @@ class BridgeBot:
                 return
 
             if message_parts[0] == 'refresh':
-                for jid in self.topic_room_id_map.keys():
+                for jid in self.rooms.jids(DIRECT_ROOM):
                     self.xmpp.send_presence(pto=jid, ptype='probe')
                 self.xmpp.send_presence()
-                self.xmpp.get_roster()
+                self.xmpp.request_full_roster()
 
             elif message_parts[0] == 'purge':
-                self.special_rooms['control'].send_text('Purging unused rooms')
+                self.send_text(self.special_room('control'), 'Purging unused rooms')
 
                 # Leave from unwanted rooms
                 for room in self.get_unmapped_rooms() + self.get_empty_rooms():
                     logger.info('Leaving room {r.room_id} ({r.name}) [{r.topic}]'.format(r=room))
 
-                    if room.topic in self.topic_room_id_map.keys():
-                        self.leave_mapped_room(room.topic)
+                    entry = self.rooms.by_room_id(room.room_id)
+                    if entry is not None and entry.kind != SPECIAL_ROOM:
+                        self.leave_mapped_room(entry.topic)
                     else:
+                        self.membership.forget(room.room_id)
                         room.leave()
 
             elif message_parts[0] == 'joinmuc':
@@ -376,7 +1416,7 @@ class BridgeBot:
                 room_jid = message_parts[1]
                 logger.info('XMPP MUC join: {}'.format(room_jid))
                 self.create_groupchat_room(room_jid)
-                self.xmpp.plugin['xep_0045'].joinMUC(room_jid, self.xmpp_groupchat_nick)
+                self.join_groupchat(room_jid)
 
             elif message_parts[0] == 'leavemuc':
                 if len(message_parts) < 2:
@@ -384,14 +1424,60 @@ class BridgeBot:
                     return
 
                 room_jid = message_parts[1]
-                room_topic = self.groupchat_flag + room_jid
+                room_topic = self.rooms.topic(room_jid, GROUPCHAT_ROOM)
 
                 success = self.leave_mapped_room(room_topic)
                 if not success:
                     msg = 'Groupchat {} isn\'t mapped or doesn\'t exist'.format(room_jid)
                 else:
                     msg = 'Left groupchat {}'.format(room_jid)
-                self.special_rooms['control'].send_notice(msg)
+                self.send_notice(self.special_room('control'), msg)
+
+            elif message_parts[0] == 'queues':
+                depths = self.dispatcher.queue_depths() if self.dispatcher is not None else {}
+                lines = ['{}: {}'.format(key, depth)
+                         for key, depth in sorted(depths.items(), key=lambda kv: -kv[1])]
+                stats = self.inbound_xmpp.stats()
+                msg = ('Inbound queue: {} waiting ({} on disk), {} busy JIDs, {} waiting for the roster\n'
+                       'Waiting by class: {}\n'
+                       'High water: {} waiting, {} bytes in memory, {} on disk').format(
+                    self.inbound_xmpp.qsize(), stats['on_disk'], len(depths), self.unknown_jids.held_count(),
+                    ', '.join('{} {}'.format(name, stats['waiting_' + name]) for name in CLASS_NAMES),
+                    stats['high_water_items'], stats['high_water_bytes'], stats['high_water_on_disk'])
+                self.send_notice(self.special_room('control'), '\n'.join([msg] + lines))
+
+            elif message_parts[0] == 'stats':
+                self.send_notice(self.special_room('control'), self.metrics.summarize())
+
+            elif message_parts[0] == 'resync':
+                num_rooms = self.resync_membership()
+                self.send_notice(self.special_room('control'), 'Resynced membership of {} rooms'.format(num_rooms))
+
+            elif message_parts[0] == 'reload':
+                self.request_reload()
+
+            elif message_parts[0] in ('profile', 'memsnapshot'):
+                try:
+                    duration = parse_duration(message_parts[1]) if len(message_parts) > 1 else 30
+                except ValueError as e:
+                    self.send_notice(self.special_room('control'), str(e))
+                    return
+                name = 'profile' if message_parts[0] == 'profile' else 'memory_snapshot'
+                self.request_diagnostic(name, duration)
+
+            elif message_parts[0] == 'threads':
+                self.request_diagnostic('thread_dump')
+
+    def matrix_member_event(self, event: Dict):
+        """
+        Keep the membership index up to date with m.room.member events from the sync stream.
+
+        :param event: The Matrix event that was received. Assumed to be an m.room.member .
+        """
+        membership = event.get('content', {}).get('membership')
+        if membership is None or 'state_key' not in event:
+            return
+        self.membership.update(event['room_id'], event['state_key'], membership)
 
     def matrix_all_chat_message(self, room: MatrixRoom, event: Dict):
         """
@@ -404,7 +1490,7 @@ class BridgeBot:
         :param event: The Matrix event that was received. Assumed to be an m.room.message .
         """
         # Always ignore our own messages
-        if event['sender'] == self.bot_id:
+        if self.is_bridge_user(event['sender']):
             return
 
         logger.debug('matrix_all_chat_message: {}  {}'.format(room.room_id, str(event)))
@@ -417,8 +1503,9 @@ class BridgeBot:
                 payload = message_body[message_body.find(jid) + len(jid) + 1:]
                 logger.info('sending manual message to '+ jid + ' : ' + payload)
                 self.xmpp.send_message(mto=jid, mbody=payload, mtype='chat')
+                self.observe_matrix_to_xmpp(event)
             else:
-                room.send_notice('Expected message format: "/m DEST_JID your message here"')
+                self.send_notice(room, 'Expected message format: "/m DEST_JID your message here"')
 
     def matrix_message(self, room: MatrixRoom, event: Dict):
         """
@@ -429,42 +1516,187 @@ class BridgeBot:
         :param room: Matrix room object representing the room in which the message was received.
         :param event: The Matrix event that was received. Assumed to be an m.room.message .
         """
-        if event['sender'] == self.bot_id:
+        if self.is_bridge_user(event['sender']):
             return
 
-        if room.topic in self.special_rooms.keys():
-            logger.error('matrix_message called on special channel')
+        entry = self.rooms.by_room_id(room.room_id)
+        if entry is None or entry.kind == SPECIAL_ROOM:
+            logger.error('matrix_message called on a special or unmapped room {}'.format(room.room_id))
+            return
 
         logger.debug('matrix_message: {}  {}'.format(room.room_id, event))
 
-        if event['content']['msgtype'] == 'm.text':
-            message_body = event['content']['body']
+        content = event['content']
+        if content.get('msgtype') == 'm.text':
+            bridge = self.bridge_matrix_text
+        elif content.get('msgtype') in MEDIA_MSGTYPES and content.get('url'):
+            bridge = self.bridge_matrix_media
+        else:
+            return
 
-            if room.topic.startswith(self.groupchat_flag):
-                jid = room.topic[len(self.groupchat_flag):]
-                message_type = 'groupchat'
-            else:
-                jid = room.topic
-                message_type = 'chat'
+        # Files are copied in the background, and later messages to the room wait behind them
+        if self.media_dispatcher is not None and (bridge == self.bridge_matrix_media or
+                                                  self.media_dispatcher.queue_depth(room.room_id)):
+            self.media_dispatcher.submit(room.room_id, self.run_held, self.hold_journal_entry(), bridge, room, event)
+        else:
+            bridge(room, event)
 
-            logger.info('Matrix received message to {} : {}'.format(jid, message_body))
-            self.xmpp.send_message(mto=jid, mbody=message_body, mtype=message_type)
+    def matrix_room_target(self, room: MatrixRoom) -> Tuple[str, str]:
+        """
+        :param room: Mapped Matrix room
+        :return: (JID, message type) to send the room's messages to
+        """
+        entry = self.rooms.by_room_id(room.room_id)
+        if entry.kind == GROUPCHAT_ROOM:
+            return entry.jid, 'groupchat'
+        return entry.jid, 'chat'
 
-            # Possible that we're in a room that wasn't mapped
-            if jid not in self.xmpp.jid_nick_map:
-                logger.error('Received message in matrix room with topic {},'.format(jid) +
-                              'which wasn\'t in the jid_nick_map')
-            name = self.xmpp.jid_nick_map.get(jid, jid)
+    def bridge_matrix_text(self, room: MatrixRoom, event: Dict):
+        """
+        Send a Matrix text message to the room's XMPP handle.
 
-            send_message = self.jid_actions.get(jid, self.default_actions)['send_messages_to_all_chat']
-            if send_message:
-                self.special_rooms['all_chat'].send_notice('To {} : {}'.format(name, message_body))
+        :param room: Room the message was sent to
+        :param event: m.room.message event with msgtype m.text
+        """
+        message_body = event['content']['body']
+        jid, message_type = self.matrix_room_target(room)
+
+        logger.info('Matrix received message to {} : {}'.format(jid, message_body))
+        self.xmpp.send_message(mto=jid, mbody=message_body, mtype=message_type)
+        self.observe_matrix_to_xmpp(event)
+        self.report_matrix_message(jid, message_body)
+
+    def bridge_matrix_media(self, room: MatrixRoom, event: Dict):
+        """
+        Send a Matrix file (image, video, ...) to the room's XMPP handle, as a link to a copy on the
+         XMPP server's HTTP upload service (see self.media), or to the homeserver's copy if the
+         file can't be copied there.
+
+        :param room: Room the message was sent to
+        :param event: m.room.message event with a media msgtype
+        """
+        content = event['content']
+        jid, message_type = self.matrix_room_target(room)
+        filename = content.get('body') or 'file'
+
+        url = None
+        if self.media is not None:
+            try:
+                url = self.media.to_xmpp(content['url'], filename, content.get('info', {}).get('mimetype'))
+            except (MediaError,) + self.transient_errors as e:
+                logger.warning('Could not copy {} to the upload service ({}), sending a link instead'.format(
+                    content['url'], e))
+        if url is None:
+            url = download_url(self.matrix.api.base_url, content['url'])
+
+        logger.info('Matrix received file to {} : {}'.format(jid, url))
+        message = self.xmpp.make_message(mto=jid, mbody=url, mtype=message_type)
+        oob = ElementTree.Element('{{{}}}x'.format(OOB_NS))
+        ElementTree.SubElement(oob, '{{{}}}url'.format(OOB_NS)).text = url
+        message.append(oob)
+        message.send()
+        self.observe_matrix_to_xmpp(event)
+        self.report_matrix_message(jid, filename)
+
+    def report_matrix_message(self, jid: str, text: str):
+        """
+        Copy a message bridged from Matrix to the all-chat room, if enabled for the JID.
+
+        :param jid: JID the message was sent to
+        :param text: Text of the message
+        """
+        # Possible that we're in a room that wasn't mapped
+        if jid not in self.xmpp.jid_nick_map:
+            logger.error('Received message in matrix room with topic {},'.format(jid) +
+                          'which wasn\'t in the jid_nick_map')
+        name = self.xmpp.jid_nick_map.get(jid, jid)
+
+        send_message = self.jid_policy.allows(jid, SEND_MESSAGES_TO_ALL_CHAT)
+        if send_message:
+            self.send_to_all_chat(jid, 'To {} : {}'.format(name, text), notice=True)
+
+    @staticmethod
+    def run_held(release, func, *args):
+        """
+        Run func(*args), then call `release` (if not None); see hold_journal_entry.
+        """
+        try:
+            func(*args)
+        finally:
+            if release is not None:
+                release()
+
+    def send_event(self, room: MatrixRoom, content: Dict, on_done=None, user_id: str=None):
+        """
+        Queue a message to be sent to a room by self.outbound; see OutboundSender.
+
+        If called from a journaled handler (see run_journaled), the handler's journal entry is
+         held until the message has been sent, or dropped after the homeserver rejected it. If
+         retries run out, the entry stays held, so the message is replayed on the next start.
+
+        :param room: Room to send to
+        :param content: Message content
+        :param on_done: Called once the message has been sent (or permanently rejected), instead of
+            releasing the journal entry. A message which runs out of retries keeps its entry, to be
+            replayed on the next startup.
+        :param user_id: Virtual user to send as (see contact_user), or None to send as the bot
+        """
+        if on_done is None:
+            on_done = self.hold_journal_entry()
+        self.outbound.send(room.room_id, content, on_done=on_done, user_id=user_id)
+
+    def hold_journal_entry(self):
+        """
+        :return: If called from a journaled handler, holds its journal entry and returns the function
+            which releases it again. Otherwise returns None.
+        """
+        entry = getattr(self.journal_context, 'entry', None)
+        if entry is None:
+            return None
+        entry.hold()
+        return entry.release
+
+    def send_text(self, room: MatrixRoom, text: str, user_id: str=None):
+        self.send_event(room, text_content(text), user_id=user_id)
+
+    def send_notice(self, room: MatrixRoom, text: str):
+        self.send_event(room, text_content(text, 'm.notice'))
+
+    def send_to_all_chat(self, jid: str, text: str, notice: bool=False, media: Dict=None):
+        """
+        Send a line to the all-chat room, batching it if batching is enabled for the JID.
+
+        :param jid: JID (or MUC JID) the line is about
+        :param text: Text to send
+        :param notice: Send as a notice rather than as text
+        :param media: File to send with `text` as its description (see copy_media_to_matrix);
+            never batched.
+        """
+        batcher = self.all_chat_batcher
+        if media is not None:
+            if batcher is not None:
+                batcher.flush()
+            self.send_event(self.special_room('all_chat'), media_event(media, text))
+            return
+
+        if batcher is not None:
+            if self.jid_policy.allows(jid, BATCH_MESSAGES_TO_ALL_CHAT):
+                batcher.add(text, notice, on_done=self.hold_journal_entry())
+                return
+            # Keep the all-chat room in order
+            batcher.flush()
+
+        if notice:
+            self.send_notice(self.special_room('all_chat'), text)
+        else:
+            self.send_text(self.special_room('all_chat'), text)
 
     def xmpp_message(self, message: Dict):
         """
         Handle a message received by the XMPP client.
 
         Sends the message to the relevant mapped Matrix room, as well as the Matrix all-chat room.
+         Messages from JIDs which aren't in the roster are held until it has been refreshed.
 
         :param message: The message that was received.
         :return:
@@ -472,27 +1704,107 @@ class BridgeBot:
         logger.info('XMPP received {} : {}'.format(message['from'].full, message['body']))
 
         if message['type'] in ('normal', 'chat'):
-            from_jid = message['from'].bare
-            from_name = self.xmpp.jid_nick_map.get(from_jid, from_jid)
+            if self.hold_for_roster(message['from'].bare, self.bridge_xmpp_message, message):
+                return
+            self.bridge_xmpp_message(message)
+
+    def bridge_xmpp_message(self, message: Dict):
+        """
+        Send a one-to-one XMPP message to the sender's mapped Matrix room, as well as the Matrix
+         all-chat room; see deliver_xmpp_message. Files are copied on self.media_dispatcher.
+
+        :param message: The message that was received.
+        """
+        if not self.defer_to_media(message['from'].bare, self.deliver_xmpp_message, message):
+            self.deliver_xmpp_message(message)
+
+    def deliver_xmpp_message(self, message: Dict):
+        """
+        Copy the file shared by a one-to-one XMPP message (if any), then send the message to the
+         sender's mapped Matrix room, as well as the Matrix all-chat room.
+
+        Senders which aren't in the roster have no mapped room, so their messages only go to the
+         all-chat room.
+
+        :param message: The message that was received.
+        """
+        from_jid = message['from'].bare
+        from_name = self.xmpp.jid_nick_map.get(from_jid, from_jid)
+        media = self.copy_media_to_matrix(message)
+        body = media['filename'] if media is not None else message['body']
+
+        send_message2all = self.jid_policy.allows(from_jid, SEND_MESSAGES_TO_ALL_CHAT)
+        if send_message2all:
+            self.send_to_all_chat(from_jid, 'From  ({})\n{}: {}'.format(from_jid, from_name, body), media=media)
+
+        send_message2room = self.jid_policy.allows(from_jid, SEND_MESSAGES_TO_JID_ROOMS)
+        if send_message2room and not self.is_known_jid(from_jid):
+            logger.info('{} is not in the roster, not bridging its message to a room of its own'.format(from_jid))
+            send_message2room = False
+        if send_message2room:
+            room = self.get_room_for_topic(from_jid)
+            sender = self.contact_user(room, from_jid)
+            if media is not None:
+                self.send_event(room, media_event(media, body), user_id=sender)
+            else:
+                self.send_text(room, body, user_id=sender)
+
+        self.checkpoints.update(from_jid, delay_stamp(message) or time.time(),
+                                stanza_id(message.xml, self.xmpp.boundjid.bare))
+
+    def defer_to_media(self, key: str, handler, message: Dict) -> bool:
+        """
+        Hand an XMPP message to self.media_dispatcher if it shares a file, so that copying the
+         file (up to `media: max_size:`) doesn't hold up an inbound worker, or if earlier messages
+         from the same JID are still waiting there, so that messages stay in order.
+
+        A deferred message keeps its journal entry (if any) open until it has been handled, as in
+         hold_for_roster.
 
-            send_message2all = self.jid_actions.get(from_jid, self.default_actions)['send_messages_to_all_chat']
-            if send_message2all:
-                self.special_rooms['all_chat'].send_text('From  ({})\n{}: {}'.format(from_jid, from_name, message['body']))
+        :param key: Bare JID (or MUC JID) the message came from
+        :param handler: Handler to run on the media dispatcher
+        :param message: Inbound XMPP message
+        :return: True if the message was deferred; False if the caller should handle it now.
+        """
+        if self.media_dispatcher is None:
+            return False
+        if oob_url(message) is None and not self.media_dispatcher.queue_depth(key):
+            return False
+        entry = getattr(self.journal_context, 'entry', None)
+        if entry is not None:
+            entry.hold()
+        self.media_dispatcher.submit(key, self.run_journaled, entry, handler, message)
+        return True
 
-            send_message2room  = self.jid_actions.get(from_jid, self.default_actions)['send_messages_to_jid_rooms']
-            if send_message2room:
-                if from_jid not in self.xmpp.jid_nick_map.keys():
-                    logger.error('xmpp_message: JID {} NOT IN ROSTER!?'.format(from_jid))
-                    self.xmpp.get_roster(block=True)
+    def copy_media_to_matrix(self, message: Dict) -> Dict or None:
+        """
+        Copy the file shared by an XMPP message (if any) to the Matrix media repository; see self.media.
 
-                room = self.get_room_for_topic(from_jid)
-                room.send_text(message['body'])
+        :param message: Inbound XMPP message
+        Unless `media: senders:` is 'any', only files from roster contacts and joined group chats
+         are copied; other senders' links are bridged as text, without the bridge fetching them.
+
+        :return: The uploaded file, as returned by MediaBridge.to_matrix, or None if the message
+            should be bridged as text (it isn't a file, or the file couldn't be copied).
+        """
+        url = oob_url(message) if self.media is not None else None
+        if url is None:
+            return None
+        if self.media_senders != 'any' and not self.is_known_jid(message['from'].bare):
+            logger.info('Not copying {} from unknown sender {}'.format(url, message['from'].bare))
+            return None
+        try:
+            return self.media.to_matrix(url)
+        except (MediaError,) + self.transient_errors as e:
+            logger.warning('Could not copy {} to Matrix ({}), bridging the link instead'.format(url, e))
+            return None
 
     def xmpp_groupchat_message(self, message: Dict):
         """
         Handle a groupchat message received by the XMPP client.
 
-        Sends the message to the relevant mapped Matrix room, as well as the Matrix all-chat room.
+        Sends the message to the relevant mapped Matrix room, as well as the Matrix all-chat room;
+         see deliver_groupchat_message. Files are copied on self.media_dispatcher.
 
         :param message: The message that was received.
         :return:
@@ -500,118 +1812,424 @@ class BridgeBot:
         logger.info('XMPP MUC received {} : {}'.format(message['from'].full, message['body']))
 
         if message['type'] == 'groupchat':
-            from_jid = message['from'].bare
-            from_name = message['mucnick']
+            if not self.defer_to_media(message['from'].bare, self.deliver_groupchat_message, message):
+                self.deliver_groupchat_message(message)
 
-            if self.groupchat_mute_own_nick and from_name == self.xmpp_groupchat_nick:
-                return
+    def deliver_groupchat_message(self, message: Dict):
+        """
+        Copy the file shared by a groupchat message (if any), then send the message to the group
+         chat's Matrix room, as well as the Matrix all-chat room, unless it has already been
+         bridged (see self.muc_history).
+
+        :param message: The message that was received.
+        """
+        from_jid = message['from'].bare
+        from_name = message['mucnick']
 
-            room = self.get_room_for_topic(self.groupchat_flag + from_jid)
-            room.send_text(from_name + ': ' + message['body'])
+        if self.groupchat_mute_own_nick and from_name == self.xmpp_groupchat_nick:
+            return
 
-            if self.groupchat_send_messages_to_all_chat:
-                self.special_rooms['all_chat'].send_text(
-                    'Room {}, from {}: {}'.format(from_jid, from_name, message['body']))
+        # Rooms replay their recent history when we (re)join them
+        key = groupchat_message_key(message)
+        if self.muc_history.is_duplicate(from_jid, key):
+            logger.debug('Skipping already-bridged message in {}'.format(from_jid))
+            return
+
+        media = self.copy_media_to_matrix(message)
+        body = media['filename'] if media is not None else message['body']
+
+        room = self.get_room_for_topic(self.rooms.topic(from_jid, GROUPCHAT_ROOM))
+        if media is not None:
+            self.send_event(room, media_event(media, from_name + ': ' + body))
+        else:
+            self.send_text(room, from_name + ': ' + body)
+
+        if self.groupchat_send_messages_to_all_chat:
+            self.send_to_all_chat(from_jid, 'Room {}, from {}: {}'.format(from_jid, from_name, body), media=media)
+
+        stamp = delay_stamp(message) or time.time()
+        self.muc_history.add(from_jid, key, stamp)
+        self.checkpoints.update(from_jid, stamp, stanza_id(message.xml, from_jid))
 
     def create_groupchat_room(self, room_jid: str):
-        room = self.create_mapped_room(topic=self.groupchat_flag + room_jid)
-        if room_jid not in self.groupchat_jids:
-            self.groupchat_jids.append(room_jid)
-        for user_id in self.users_to_invite:
-            room.invite_user(user_id)
+        room = self.create_mapped_room(topic=self.rooms.topic(room_jid, GROUPCHAT_ROOM))
+        self.state.add_groupchat(room_jid)
+        self.invite_users(room)
 
     def xmpp_presence_available(self, presence: Dict):
         """
         Handle a presence of type "available".
 
-        Sends a notice to the control channel.
+        Queues a notice for the control channel; see self.presence .
 
         :param presence: The presence that was received.
         """
         logger.debug('XMPP received {} : (available)'.format(presence['from'].full))
 
-        jid = presence['from'].bare
-        if jid not in self.xmpp.jid_nick_map.keys():
-            logger.error('xmpp_presence_available: JID {} NOT IN ROSTER!?'.format(jid))
-            self.xmpp.get_roster(block=True)
-
-        send_presence = self.jid_actions.get(jid, self.default_actions)['send_presences_to_control']
-        if send_presence:
-            name = self.xmpp.jid_nick_map.get(jid, jid)
-            self.special_rooms['control'].send_notice('{} available ({})'.format(name, jid))
+        if not self.hold_for_roster(presence['from'].bare, self.report_presence, presence, 'available'):
+            self.report_presence(presence, 'available')
 
     def xmpp_presence_unavailable(self, presence):
         """
         Handle a presence of type "unavailable".
 
-        Sends a notice to the control channel.
+        Queues a notice for the control channel; see self.presence .
 
         :param presence: The presence that was received.
         """
         logger.debug('XMPP received {} : (unavailable)'.format(presence['from'].full))
 
-        jid = presence['from'].bare
-        if jid not in self.xmpp.jid_nick_map.keys():
-            logger.error('xmpp_presence_unavailable: JID {} NOT IN ROSTER!?'.format(jid))
-            self.xmpp.get_roster(block=True)
+        if not self.hold_for_roster(presence['from'].bare, self.report_presence, presence, 'unavailable'):
+            self.report_presence(presence, 'unavailable')
+
+    def report_presence(self, presence: Dict, state: str):
+        """
+        Queue a presence change for the control channel's digest, if the JID's actions ask for it.
 
-        send_presence = self.jid_actions.get(jid, self.default_actions)['send_presences_to_control']
+        :param presence: The presence that was received.
+        :param state: 'available' or 'unavailable'
+        """
+        jid = presence['from'].bare
+        send_presence = self.jid_policy.allows(jid, SEND_PRESENCES_TO_CONTROL)
         if send_presence:
             name = self.xmpp.jid_nick_map.get(jid, jid)
-            self.special_rooms['control'].send_notice('{} unavailable ({})'.format(name, jid))
+            self.presence.update(jid, name, state)
+
+    def is_known_jid(self, jid: str) -> bool:
+        """
+        :param jid: Bare JID
+        :return: True if the JID is in the roster, or is a group chat (whose occupants never are).
+        """
+        return jid in self.xmpp.jid_nick_map or self.rooms.by_jid(jid, GROUPCHAT_ROOM) is not None
 
-    def xmpp_roster_update(self, _event):
+    def hold_for_roster(self, jid: str, handler, *args) -> bool:
         """
-        Handle an XMPP roster update.
+        If `jid` isn't in the roster, hold an event from it until the roster has been refreshed,
+         rather than waiting for the roster here; see self.unknown_jids .
 
-        Maps all existing Matrix rooms, creates a new mapped room for each JID in the roster
-        which doesn't have one yet, and invites the users specified in the config in to all the rooms.
+        A held event keeps its journal entry (if any) open until it has been handled.
 
-        :param _event: The received roster update event (unused).
+        :param jid: Bare JID the event came from
+        :param handler: Handler to run once the roster has been refreshed
+        :param args: Arguments for the handler
+        :return: True if the event was held; False if the caller should handle it now.
         """
-        logger.debug('######### ROSTER UPDATE ###########')
+        entry = getattr(self.journal_context, 'entry', None)
+        if not self.unknown_jids.hold(jid, self.run_journaled, entry, handler, *args):
+            return False
+        if entry is not None:
+            entry.hold()
+        return True
+
+    def held_stranger_event(self, jid: str, run, entry: JournalEntry or None, handler, *args):
+        """
+        Handle an event held by hold_for_roster from a JID which is still not in the roster once
+         it has been refreshed. Presences are reported as usual; messages are bridged to the
+         all-chat room only (see deliver_xmpp_message), since the JID has no room of its own.
+
+        :param jid: Bare JID the event came from
+        :param run: self.run_journaled
+        :param entry: Journal entry for the event, or None
+        :param handler: Handler the event was held for
+        :param args: Arguments for the handler
+        """
+        if handler not in (self.bridge_xmpp_message, self.report_presence):
+            logger.warning('Dropping {} event held from {}, which is not in the roster'.format(
+                getattr(handler, '__name__', handler), jid))
+            if entry is not None:
+                entry.release()
+            return
+        run(entry, handler, *args)
+
+    def send_presence_digest(self, message: str):
+        """
+        Send a digest of presence changes to the control room.
 
-        rjids = [jid for jid in self.xmpp.roster]
-        if len(rjids) > 1:
-            raise Exception('Not sure what to do with more than one roster...')
+        :param message: Digest from self.presence
+        """
+        self.send_notice(self.special_room('control'), message)
+
+    def xmpp_roster_update(self, event):
+        """
+        Handle an XMPP roster result or push.
 
-        roster0 = self.xmpp.roster[rjids[0]]
-        self.xmpp.roster_dict = {jid: roster0[jid] for jid in roster0}
-        roster = self.xmpp.roster_dict
+        Only the changes relative to the roster we already have are applied (see apply_roster_diff),
+         so a push for one contact only touches that contact's room. A full roster (e.g. requested
+         by the refresh command) also makes sure every contact has a room (see resync_roster_rooms). The changes and the new
+         roster version are then stored, so the next login only asks the server for what has
+         changed since (XEP-0237).
 
-        self.map_rooms_by_topic()
+        :param event: The received roster result or push
+        """
+        logger.debug('######### ROSTER UPDATE ###########')
+        start = time.monotonic()
+
+        diff = diff_roster(self.roster_items, event, self.roster_version)
+        if diff.full:
+            self.map_rooms_by_topic()
+        self.apply_roster_diff(diff)
+        if diff.full:
+            # Unchanged contacts may still be missing their rooms (e.g. after one was deleted and
+            #  the refresh command asked for the whole roster), so check every contact.
+            self.resync_roster_rooms()
+
+        # Pushes and "no changes" results don't always carry a version
+        if diff.version is not None or diff.full:
+            self.roster_version = diff.version
+        self.state.update_roster(diff.changed, diff.removed, self.roster_version)
+
+        if event['type'] == 'result':
+            self.unknown_jids.roster_answered()
+
+        self.roster_update_time.observe(time.monotonic() - start)
+        logger.debug('######## Done with roster update ({} changed, {} removed) #######'.format(
+            len(diff.changed), len(diff.removed)))
+
+    def apply_roster_diff(self, diff: RosterDiff):
+        """
+        Update the JID maps from a roster diff, and create or rename the rooms of the contacts
+         which were added or renamed. Contacts whose rooms are already set up for their name are
+         left alone, as are the rooms of removed contacts.
 
-        # Create new rooms where none exist
-        for jid, info in roster.items():
+        :param diff: Changes to the roster
+        """
+        new_rooms = 0
+        for jid, item in diff.changed.items():
+            previous = self.roster_items.get(jid)
+            self.roster_items[jid] = item
             if '@' not in jid:
                 logger.warning('Skipping fake jid in roster: ' + jid)
                 continue
 
-            name = info['name']
-            self.xmpp.jid_nick_map[jid] = name
+            self.xmpp.roster_dict[jid] = item.name
+            self.xmpp.jid_nick_map[jid] = item.name
+            if previous is not None and previous.name == item.name:
+                # Only the subscription changed
+                continue
+            if self.ensure_roster_room(jid, item.name):
+                new_rooms += 1
+
+        for jid in diff.removed:
+            self.roster_items.pop(jid, None)
+            self.xmpp.roster_dict.pop(jid, None)
+            self.xmpp.jid_nick_map.pop(jid, None)
+            logger.info('{} was removed from the roster'.format(jid))
 
-            # Check if we need to create a room
-            if self.jid_actions.get(jid, self.default_actions)['send_messages_to_jid_rooms']:
-                self.create_mapped_room(topic=jid, name=name)
+        if new_rooms > 0:
+            self.report_provisioning('Creating {} new rooms'.format(new_rooms))
 
+    def ensure_roster_room(self, jid: str, name: str) -> bool:
+        """
+        Make sure a roster contact has a room with the right name (if its actions call for one),
+         and invite the users specified in the config to it.
+
+        New rooms are created in the background by self.provisioner; JIDs which have inbound events
+         waiting to be handled get their rooms first.
+
+        :param jid: Contact's JID
+        :param name: Contact's name from the roster
+        :return: True if a new room was queued to be created.
+        """
+        if not self.jid_policy.allows(jid, SEND_MESSAGES_TO_JID_ROOMS):
+            return False
+
+        entry = self.rooms.by_topic(jid)
+        if entry is not None and entry.room_id not in self.matrix.get_rooms():
+            # We're no longer in the room (e.g. it was deleted or we were kicked), so replace it
+            logger.info('Room {} for {} is gone, creating a new one'.format(entry.room_id, jid))
+            self.rooms.remove(jid)
+            self.state.remove_room(jid)
+            self.membership.forget(entry.room_id)
+
+        if self.rooms.by_topic(jid) is not None or self.rooms.by_jid(jid, GROUPCHAT_ROOM) is not None:
+            room = self.create_mapped_room(topic=jid, name=name)
+            if room is not None:
+                self.invite_users(room)
+            return False
+
+        new_room = not self.provisioner.is_pending(jid)
+        self.provisioner.request(jid, self.mapped_room_name(jid, name),
+                                 priority=self.dispatcher.queue_depth(jid))
+        return new_room
+
+    def resync_roster_rooms(self):
+        """
+        Make sure every contact in the roster has a room, and everyone who should be invited to
+         each room has been (e.g. after jid_groups or users_to_invite changed).
+        """
+        new_rooms = 0
+        for jid, item in list(self.roster_items.items()):
+            if '@' in jid and self.ensure_roster_room(jid, item.name):
+                new_rooms += 1
+        if new_rooms > 0:
+            self.report_provisioning('Creating {} new rooms'.format(new_rooms))
+        self.invite_users_to_all_rooms()
+
+    def invite_users_to_all_rooms(self):
+        """
+        Invite the users specified in the config to every room (see invite_users).
+        """
         logger.debug('Sending invitations..')
-        # Invite to all rooms
-        for room in self.matrix.get_rooms().values():
-            users_in_room = room.get_joined_members()
-            for user_id in self.users_to_invite:
-                if user_id not in users_in_room:
-                    room.invite_user(user_id)
+        rooms = self.matrix.get_rooms()
+        self.membership.prune(rooms.keys())
+        for room in list(rooms.values()):
+            self.invite_users(room)
+
+    def xmpp_session_start(self, _event):
+        """
+        Handle the start of an XMPP session, both the first one and after reconnecting:
+         (re)join all group chats.
+
+        :param _event: The session_start event (unused).
+        """
+        self.xmpp_connected = True
+        logger.debug('Rejoining group chats')
+        for room_jid in self.rooms.jids(GROUPCHAT_ROOM):
+            self.join_groupchat(room_jid)
+        self.start_catch_up()
+
+    def join_groupchat(self, room_jid: str):
+        """
+        Join (or rejoin) a group chat, asking for the history sent since we last bridged a message
+         from it (up to groupchat_history: maxstanzas messages), or no history for a new group chat.
 
-        logger.debug('######## Done with roster update #######')
+        Joining only sends a presence, so all the group chats are joined at once; the history
+         which comes back is checked against self.muc_history .
+
+        :param room_jid: MUC to join
+        """
+        last_bridged = self.muc_history.last_bridged(room_jid)
+        since = last_bridged - HISTORY_SLACK if last_bridged else None
+        if self.catch_up is not None and self.catch_up_options.get('groupchats', False):
+            # Caught up from the room's archive instead
+            since = None
+        join_muc(self.xmpp, room_jid, self.xmpp_groupchat_nick,
+                 maxstanzas=self.groupchat_history.get('maxstanzas', 50),
+                 since=since)
+
+    def start_catch_up(self):
+        """
+        Catch up every conversation which has bridged a message before, from the server's message
+         archive (XEP-0313), in the background; see catch_up_conversation.
+        """
+        if self.catch_up is None:
+            return
+        for jid in self.checkpoints.jids():
+            is_groupchat = self.rooms.by_jid(jid, GROUPCHAT_ROOM) is not None
+            if is_groupchat and not self.catch_up_options.get('groupchats', False):
+                continue
+            self.catch_up.submit(jid, self.catch_up_conversation, jid, is_groupchat)
+
+    def catch_up_conversation(self, jid: str, is_groupchat: bool):
+        """
+        Bridge the messages in a conversation's archive which arrived after its checkpoint (e.g.
+         while the bridge was down, or delivered to one of our other resources).
+
+        The archive is paged through as it is bridged, and the checkpoint moves along with it, so
+         an interrupted catch-up resumes where it stopped.
+
+        :param jid: Bare JID of the contact or group chat
+        :param is_groupchat: True if `jid` is a group chat
+        """
+        checkpoint = self.checkpoints.get(jid)
+        if checkpoint is None:
+            return
+        if checkpoint.archive_id is None:
+            checkpoint = Checkpoint(checkpoint.stamp - HISTORY_SLACK, None)
+
+        own_jid = self.xmpp.boundjid.bare
+        imported = 0
+        self.checkpoints.begin(jid)
+        try:
+            while True:
+                archive = iterate_archive(self.xmpp.send_query, self.xmpp.mam, own_jid,
+                                          muc_jid=jid if is_groupchat else None,
+                                          with_jid=None if is_groupchat else jid,
+                                          checkpoint=checkpoint,
+                                          page_size=self.catch_up_options.get('page_size', 50))
+                try:
+                    for archived in archive:
+                        self.import_archived(jid, is_groupchat, archived, own_jid)
+                        self.checkpoints.update(jid, archived.stamp, archived.archive_id, catching_up=True)
+                        imported += 1
+                    break
+                except self.transient_errors as e:
+                    iq = getattr(e, 'iq', None)
+                    if checkpoint.archive_id is None or iq is None or iq['error']['condition'] != 'item-not-found':
+                        raise
+                    # The archive no longer has the message we stopped at, so fall back to its time
+                    checkpoint = self.checkpoints.get(jid) or checkpoint
+                    checkpoint = Checkpoint(checkpoint.stamp - HISTORY_SLACK, None)
+        except self.transient_errors as e:
+            logger.warning('Catching up {} stopped after {} messages ({}), will resume on reconnect'.format(
+                jid, imported, e))
+        finally:
+            self.checkpoints.end(jid)
+
+        if imported:
+            logger.info('Caught up {} archived messages for {}'.format(imported, jid))
+
+    def import_archived(self, jid: str, is_groupchat: bool, archived: ArchivedMessage, own_jid: str):
+        """
+        Pass an archived message to the inbound dispatcher, as if it had just been received.
+         Messages which were already bridged are skipped by the journal (or, for group chats,
+         self.muc_history).
+
+        :param jid: Conversation the message belongs to
+        :param is_groupchat: True if `jid` is a group chat
+        :param archived: Message from the archive
+        :param own_jid: Our own bare JID
+        """
+        xml = archived.xml
+        if xml.find('{jabber:client}body') is None:
+            return
+        if not is_groupchat and xml.get('from', '').split('/')[0] == own_jid:
+            # Sent by one of our other resources
+            return
+
+        # Keep the original time and archive ID with the message, for the checkpoints and dedup
+        if xml.find('{{{}}}delay'.format(DELAY_NS)) is None:
+            ElementTree.SubElement(xml, '{{{}}}delay'.format(DELAY_NS), stamp=format_stamp(archived.stamp))
+        if stanza_id(xml, jid if is_groupchat else own_jid) is None:
+            ElementTree.SubElement(xml, '{{{}}}stanza-id'.format(STANZA_ID_NS),
+                                   by=jid if is_groupchat else own_jid, id=archived.archive_id)
+        if is_groupchat:
+            xml.set('type', 'groupchat')
+
+        self.dispatcher.wait_for_capacity()
+        self.dispatch_event(self.xmpp_stanzas.Message(self.xmpp, xml=xml), received=time.time())
+
+    def xmpp_disconnected(self, event):
+        """
+        Handle losing (or failing to establish) the XMPP connection.
+
+        The XMPP client normally reconnects by itself; self.xmpp_supervisor makes sure it does.
+
+        :param event: The disconnected or connection_failed event.
+        """
+        self.xmpp_connected = False
+        self.xmpp_supervisor.failed(Exception('XMPP connection lost ({})'.format(event)))
 
     def xmpp_unrecognized_event(self, event):
         logger.error('Unrecognized event: {} || {}'.format(type(event), event))
 
 
 def main():
+    with open(CONFIG_FILE, 'r') as conf_file:
+        engine = yaml.safe_load(conf_file).get('engine', 'threads')
+
+    if engine == 'asyncio':
+        from mxpp import aio
+        aio.main(CONFIG_FILE)
+        return
+    elif engine != 'threads':
+        raise Exception('Unknown engine {}, expected "threads" or "asyncio"'.format(engine))
+
     while True:
         try:
             bot = BridgeBot()
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, bot.request_reload)
             bot.handle_inbound_xmpp()
         except Exception as e:
             logger.error('Fatal Exception: {}'.format(e))
@@ -0,0 +1,249 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+from xml.etree import ElementTree
+
+from mxpp.muc import DELAY_NS, parse_stamp
+
+logger = logging.getLogger(__name__)
+
+MAM_NS = 'urn:xmpp:mam:2'
+FORWARD_NS = 'urn:xmpp:forward:0'
+RSM_NS = 'http://jabber.org/protocol/rsm'
+DATA_NS = 'jabber:x:data'
+CLIENT_NS = 'jabber:client'
+
+# Matches MAM result messages, which have no <body/> of their own (so never fire the 'message'
+#  event); clients register a handler for them with this path.
+RESULT_XPATH = '{{{}}}message/{{{}}}result'.format(CLIENT_NS, MAM_NS)
+
+# Seconds to wait for each page of results
+QUERY_TIMEOUT = 60
+
+# One message from an archive: its archive ID (usable as an RSM `after`), when it was
+#  originally sent, and the archived <message/> element itself.
+ArchivedMessage = NamedTuple('ArchivedMessage', [('archive_id', str),
+                                                 ('stamp', float),
+                                                 ('xml', ElementTree.Element)])
+
+# How far a conversation has been bridged: the time of the last bridged message, and its
+#  archive ID if known (resuming from the ID is exact, resuming from the time may overlap).
+Checkpoint = NamedTuple('Checkpoint', [('stamp', float), ('archive_id', str)])
+
+
+class MamCollector:
+    """
+    Collects the result messages of open MAM queries (XEP-0313), which arrive as separate
+     <message/> stanzas before the query's <iq/> result.
+    """
+    queries = None      # type: Dict[str, Tuple[str, List[ArchivedMessage]]]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = {}
+
+    def open(self, queryid: str, archive_jid: str):
+        """
+        :param queryid: ID of the query about to be sent
+        :param archive_jid: Bare JID whose archive is being queried; results from anyone else are dropped.
+        """
+        with self.lock:
+            self.queries[queryid] = (archive_jid, [])
+
+    def close(self, queryid: str) -> List[ArchivedMessage]:
+        """
+        :return: The results collected for the query, in the order they arrived.
+        """
+        with self.lock:
+            _archive_jid, results = self.queries.pop(queryid, (None, []))
+            return results
+
+    @staticmethod
+    def is_result(message) -> bool:
+        """
+        :param message: Inbound <message/> stanza
+        :return: True if the message is a MAM result, so shouldn't be handled as a message in its own right.
+        """
+        return message.xml.find('{{{}}}result'.format(MAM_NS)) is not None
+
+    def deliver(self, message) -> bool:
+        """
+        :param message: Inbound <message/> stanza
+        :return: True if the message was a MAM result (whether or not it was for an open query),
+            so shouldn't be handled as a message in its own right.
+        """
+        result = message.xml.find('{{{}}}result'.format(MAM_NS))
+        if result is None:
+            return False
+
+        with self.lock:
+            archive_jid, results = self.queries.get(result.get('queryid'), (None, None))
+        if results is None:
+            logger.debug('Dropping MAM result for unknown query {}'.format(result.get('queryid')))
+            return True
+        if message['from'].bare not in ('', archive_jid):
+            logger.warning('Dropping MAM result from {}, expected {}'.format(message['from'].bare, archive_jid))
+            return True
+
+        forwarded = result.find('{{{}}}forwarded'.format(FORWARD_NS))
+        inner = forwarded.find('{{{}}}message'.format(CLIENT_NS)) if forwarded is not None else None
+        if inner is None:
+            logger.warning('Dropping malformed MAM result {}'.format(result.get('id')))
+            return True
+        delay = forwarded.find('{{{}}}delay'.format(DELAY_NS))
+        stamp = parse_stamp(delay.get('stamp')) if delay is not None else None
+
+        with self.lock:
+            results.append(ArchivedMessage(result.get('id'), stamp or time.time(), inner))
+        return True
+
+
+def build_query(queryid: str, with_jid: str=None, start: float=None, after: str=None,
+                page_size: int=50) -> ElementTree.Element:
+    """
+    :return: MAM <query/> element for one page of results
+    """
+    query = ElementTree.Element('{{{}}}query'.format(MAM_NS), queryid=queryid)
+
+    form = ElementTree.SubElement(query, '{{{}}}x'.format(DATA_NS), type='submit')
+    fields = [('FORM_TYPE', MAM_NS)]
+    if with_jid is not None:
+        fields.append(('with', with_jid))
+    if start is not None:
+        fields.append(('start', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start))))
+    for var, value in fields:
+        field = ElementTree.SubElement(form, '{{{}}}field'.format(DATA_NS), var=var)
+        if var == 'FORM_TYPE':
+            field.set('type', 'hidden')
+        ElementTree.SubElement(field, '{{{}}}value'.format(DATA_NS)).text = value
+
+    rsm = ElementTree.SubElement(query, '{{{}}}set'.format(RSM_NS))
+    ElementTree.SubElement(rsm, '{{{}}}max'.format(RSM_NS)).text = str(page_size)
+    if after is not None:
+        ElementTree.SubElement(rsm, '{{{}}}after'.format(RSM_NS)).text = after
+    return query
+
+
+def iterate_archive(send_query: Callable[[ElementTree.Element, str or None], object],
+                    collector: MamCollector,
+                    own_jid: str,
+                    muc_jid: str=None,
+                    with_jid: str=None,
+                    checkpoint: Checkpoint=None,
+                    page_size: int=50) -> Iterator[ArchivedMessage]:
+    """
+    Page through an archive, oldest first, yielding each message as its page arrives.
+     Only one page is held in memory at a time.
+
+    :param send_query: Sends a <query/> in an <iq type="set"/> (to the given JID, or our own
+        account if None) and returns the <iq/> result, raising on errors and timeouts.
+    :param collector: Collector which receives the client's MAM result messages
+    :param own_jid: Our own bare JID
+    :param muc_jid: MUC whose archive to query, or None to query our own
+    :param with_jid: Only fetch messages exchanged with this JID
+    :param checkpoint: Only fetch messages after this point
+    :param page_size: Number of messages to request per page
+    """
+    start = checkpoint.stamp if checkpoint is not None and not checkpoint.archive_id else None
+    after = checkpoint.archive_id if checkpoint is not None else None
+
+    while True:
+        queryid = uuid.uuid4().hex
+        collector.open(queryid, muc_jid or own_jid)
+        try:
+            response = send_query(build_query(queryid, with_jid, start, after, page_size), muc_jid)
+        finally:
+            results = collector.close(queryid)
+
+        for result in results:
+            yield result
+
+        fin = response.xml.find('{{{}}}fin'.format(MAM_NS))
+        if fin is None or fin.get('complete') in ('true', '1') or not results:
+            return
+        after = fin.findtext('{{{0}}}set/{{{0}}}last'.format(RSM_NS)) or results[-1].archive_id
+
+
+class CheckpointStore:
+    """
+    Keeps each conversation's Checkpoint in memory, saving changes through `save` at most once
+     every `save_interval` seconds, and on flush().
+
+    While a conversation is being caught up, only the catch-up moves its checkpoint, so that an
+     interrupted catch-up resumes where it stopped rather than after newer live messages.
+    """
+    checkpoints = None      # type: Dict[str, Checkpoint]
+
+    def __init__(self,
+                 stored: Dict[str, Checkpoint],
+                 save: Callable[[str, Checkpoint], None],
+                 remove: Callable[[str], None],
+                 save_interval: float=5.0):
+        """
+        :param stored: Checkpoints saved by a previous run
+        :param save: Called with (jid, checkpoint) to save a checkpoint
+        :param remove: Called with a jid to delete its saved checkpoint
+        :param save_interval: Minimum number of seconds between saves
+        """
+        self.save = save
+        self.remove = remove
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.checkpoints = dict(stored)
+        self.catching_up = set()
+        self.dirty = set()
+        self.last_save = time.monotonic()
+
+    def get(self, jid: str) -> Checkpoint or None:
+        with self.lock:
+            return self.checkpoints.get(jid)
+
+    def jids(self) -> List[str]:
+        with self.lock:
+            return list(self.checkpoints.keys())
+
+    def begin(self, jid: str):
+        with self.lock:
+            self.catching_up.add(jid)
+
+    def end(self, jid: str):
+        with self.lock:
+            self.catching_up.discard(jid)
+
+    def update(self, jid: str, stamp: float, archive_id: str=None, catching_up: bool=False):
+        """
+        Record that a message has been bridged.
+
+        :param jid: Conversation (bare JID or MUC)
+        :param stamp: When the message was sent
+        :param archive_id: Archive ID of the message, if known
+        :param catching_up: True if called by the catch-up, False for live messages
+        """
+        with self.lock:
+            if jid in self.catching_up and not catching_up:
+                return
+            current = self.checkpoints.get(jid)
+            if current is not None and stamp < current.stamp and not catching_up:
+                return
+            self.checkpoints[jid] = Checkpoint(stamp, archive_id)
+            self.dirty.add(jid)
+            save_now = time.monotonic() - self.last_save >= self.save_interval
+
+        if save_now:
+            self.flush()
+
+    def forget(self, jid: str):
+        with self.lock:
+            self.checkpoints.pop(jid, None)
+            self.dirty.discard(jid)
+        self.remove(jid)
+
+    def flush(self):
+        with self.lock:
+            changed = [(jid, self.checkpoints[jid]) for jid in self.dirty]
+            self.dirty.clear()
+            self.last_save = time.monotonic()
+        for jid, checkpoint in changed:
+            self.save(jid, checkpoint)
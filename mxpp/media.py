@@ -0,0 +1,382 @@
+import ipaddress
+import logging
+import socket
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterator, List, Tuple
+from urllib.parse import quote, unquote, urljoin, urlsplit
+from xml.etree import ElementTree
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from matrix_client.api import MatrixHttpApi
+
+logger = logging.getLogger(__name__)
+
+OOB_NS = 'jabber:x:oob'
+UPLOAD_NS = 'urn:xmpp:http:upload:0'
+MEDIA_API_PATH = '/_matrix/media/r0'
+
+# Bytes read from the source per chunk
+CHUNK_SIZE = 64 * 1024
+# Seconds to wait for either end of a transfer to send or accept more data
+TRANSFER_TIMEOUT = 60
+# Redirects followed when fetching a file shared over XMPP (each hop is checked, see check_source_url)
+MAX_REDIRECTS = 3
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Headers an HTTP upload service may ask us to send with the upload (XEP-0363 section 5)
+SLOT_HEADERS = ('Authorization', 'Cookie', 'Expires')
+
+MSGTYPES = (('image/', 'm.image'), ('video/', 'm.video'), ('audio/', 'm.audio'))
+MEDIA_MSGTYPES = ('m.image', 'm.video', 'm.audio', 'm.file')
+
+
+class MediaError(Exception):
+    """
+    A file couldn't be bridged (too large, no size given, rejected by either end, ...).
+    """
+
+
+def oob_url(message) -> str or None:
+    """
+    :param message: XMPP message
+    :return: URL of the file the message shares (XEP-0066), if the message is only a file
+        (its body is empty or the URL itself, as sent by clients using HTTP upload), else None.
+    """
+    url = message.xml.findtext('{{{0}}}x/{{{0}}}url'.format(OOB_NS))
+    if not url:
+        return None
+    body = (message['body'] or '').strip()
+    if body and body != url.strip():
+        return None
+    return url.strip()
+
+
+def check_source_url(url: str, allowed_domains: List[str]=None):
+    """
+    Make sure a URL shared by an XMPP contact is safe for the bridge to fetch: it must be https,
+     on one of `allowed_domains` (if given), and its host must only resolve to public addresses,
+     so contacts can't make the bridge fetch from (and post into Matrix) hosts on its own network.
+
+    The host is resolved again when the file is fetched, so this can't stop a DNS server which
+     answers differently the second time; restrict `allowed_domains` where that matters.
+
+    :param url: URL of the file
+    :param allowed_domains: Domains (and their subdomains) files may be fetched from, or None for any
+    :raises MediaError: if the URL mustn't be fetched
+    """
+    parts = urlsplit(url)
+    if parts.scheme != 'https':
+        raise MediaError('Refusing to fetch {}: not https'.format(url))
+    host = (parts.hostname or '').rstrip('.').lower()
+    if not host:
+        raise MediaError('Refusing to fetch {}: no host'.format(url))
+    if allowed_domains and not any(host == domain or host.endswith('.' + domain) for domain in allowed_domains):
+        raise MediaError('Refusing to fetch {}: {} is not an allowed domain'.format(url, host))
+
+    try:
+        addresses = socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise MediaError('Could not resolve {} ({})'.format(host, e))
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%', 1)[0])
+        if not ip.is_global or ip.is_multicast:
+            raise MediaError('Refusing to fetch {}: {} is not a public address'.format(url, ip))
+
+
+def media_event(info: Dict, body: str) -> Dict:
+    """
+    :param info: File uploaded to the Matrix media repository, as returned by MediaBridge.to_matrix
+    :param body: Text to show for the file
+    :return: Content of an m.room.message event for the file
+    """
+    msgtype = 'm.file'
+    for prefix, prefix_msgtype in MSGTYPES:
+        if info['mimetype'].startswith(prefix):
+            msgtype = prefix_msgtype
+    return {
+        'msgtype': msgtype,
+        'body': body,
+        'url': info['url'],
+        'info': {'mimetype': info['mimetype'], 'size': info['size']},
+    }
+
+
+def download_url(base_url: str, mxc_url: str) -> str:
+    """
+    :param base_url: Homeserver base URL
+    :param mxc_url: mxc:// URL of a file in the Matrix media repository
+    :return: HTTP URL the file can be downloaded from
+    """
+    parts = urlsplit(mxc_url)
+    return '{}{}/download/{}/{}'.format(base_url, MEDIA_API_PATH, quote(parts.netloc), quote(parts.path.lstrip('/')))
+
+
+class ChunkReader:
+    """
+    File-like view of a stream of chunks of known total length, which requests can upload with a
+     Content-Length (rather than chunked, which neither Matrix nor HTTP upload services accept)
+     while only holding one chunk in memory.
+    """
+    def __init__(self, chunks: Iterator[bytes], length: int):
+        self.chunks = chunks
+        self.length = length
+        self.sent = 0
+        self.pending = b''
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int=-1) -> bytes:
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                if self.sent != self.length:
+                    raise MediaError('Source ended after {} of {} bytes'.format(self.sent, self.length))
+                return b''
+            self.pending = chunk
+
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        self.sent += len(data)
+        if self.sent > self.length:
+            raise MediaError('Source sent more than the {} bytes it announced'.format(self.length))
+        return data
+
+
+class TransferCache:
+    """
+    Remembers the result of the most recent `max_entries` transfers, keyed by their source, and
+     makes concurrent requests for the same source wait for a single transfer.
+    """
+    results = None      # type: OrderedDict
+    in_flight = None    # type: Dict[Hashable, threading.Event]
+
+    def __init__(self, max_entries: int=1000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.in_flight = {}
+
+    def get(self, key: Hashable, transfer: Callable[[], object]):
+        """
+        :param key: Identifies the source
+        :param transfer: Does the transfer and returns its result, raising on failure
+        :return: The cached result for `key`, or the result of `transfer`.
+            Failures aren't cached, so the next request tries again.
+        """
+        while True:
+            with self.lock:
+                if key in self.results:
+                    self.results.move_to_end(key)
+                    return self.results[key]
+                done = self.in_flight.get(key)
+                if done is None:
+                    done = threading.Event()
+                    self.in_flight[key] = done
+                    break
+            done.wait()
+            with self.lock:
+                if key not in self.results:
+                    raise MediaError('Transfer of {} failed'.format(key))
+
+        try:
+            result = transfer()
+            self.put(key, result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
+
+    def put(self, key: Hashable, result):
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+
+
+class MediaBridge:
+    """
+    Copies files between XMPP HTTP upload (XEP-0363) URLs and the Matrix media repository.
+
+    Files are streamed chunk by chunk from the source straight into the upload at the other end,
+     so they are never held in memory whole. Files larger than `max_size`, and files whose size
+     isn't known up front (both ends need it before the upload starts), aren't copied.
+
+    Each source is only copied once (see TransferCache): the same file sent to a JID room and
+     the all-chat room, or echoed back by the other side, reuses the first upload.
+    """
+    api = None          # type: MatrixHttpApi
+    cache = None        # type: TransferCache
+
+    def __init__(self,
+                 api: MatrixHttpApi,
+                 send_query: Callable,
+                 upload_service: str=None,
+                 max_size: int=50 * 1024 * 1024,
+                 max_transfers: int=4,
+                 cache_size: int=1000,
+                 allowed_domains: List[str]=None):
+        """
+        :param api: API of the Matrix client to upload as. Its base URL, access token and
+            certificate checking are used, but not its HTTP session.
+        :param send_query: Sends an <iq/> query and returns the result, called as
+            send_query(query, to=jid, itype='get'); see ClientXMPP.send_query
+        :param upload_service: JID of the XMPP HTTP upload service, or None to only copy files
+            from XMPP to Matrix
+        :param max_size: Largest file to copy, in bytes
+        :param max_transfers: Number of files which may be copied at once
+        :param cache_size: Number of copied files to remember
+        :param allowed_domains: Domains (and their subdomains) files shared over XMPP may be fetched
+            from, or None for any public host; see check_source_url
+        """
+        self.api = api
+        self.send_query = send_query
+        self.upload_service = upload_service
+        self.max_size = max_size
+        self.slots = threading.BoundedSemaphore(max_transfers)
+        self.cache = TransferCache(cache_size)
+        self.allowed_domains = [domain.lower().strip('.') for domain in allowed_domains or []]
+        self.transferred = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_transfers * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def to_matrix(self, url: str) -> Dict:
+        """
+        Copy a file shared over XMPP into the Matrix media repository.
+
+        :param url: URL of the file
+        :return: {'url': mxc URL, 'mimetype': ..., 'size': ..., 'filename': ...}; raises
+            MediaError or requests.RequestException if the file couldn't be copied.
+        """
+        return self.cache.get(('xmpp', url), lambda: self._copy_to_matrix(url))
+
+    def to_xmpp(self, mxc_url: str, filename: str, mimetype: str=None) -> str:
+        """
+        Copy a file from the Matrix media repository to the XMPP HTTP upload service.
+
+        :param mxc_url: mxc:// URL of the file
+        :param filename: Name to upload the file as
+        :param mimetype: Type of the file, if known
+        :return: URL the file can be downloaded from; raises MediaError, requests.RequestException
+            or the XMPP client's IqError/IqTimeout if the file couldn't be copied.
+        """
+        if self.upload_service is None:
+            raise MediaError('No HTTP upload service configured')
+        return self.cache.get(('matrix', mxc_url), lambda: self._copy_to_xmpp(mxc_url, filename, mimetype))
+
+    def _open(self, url: str, headers: Dict=None, allow_redirects: bool=True) -> requests.Response:
+        response = self.session.get(url, stream=True, headers=headers,
+                                    verify=getattr(self.api, 'validate_cert', True),
+                                    allow_redirects=allow_redirects,
+                                    timeout=TRANSFER_TIMEOUT)
+        expected = (200,) if allow_redirects else (200,) + REDIRECT_CODES
+        if response.status_code not in expected:
+            response.close()
+            raise MediaError('Fetching {} failed ({})'.format(url, response.status_code))
+        return response
+
+    def _open_source(self, url: str) -> requests.Response:
+        """
+        Open a URL shared by an XMPP contact, checking it and every redirect with check_source_url.
+        """
+        for _hop in range(MAX_REDIRECTS + 1):
+            check_source_url(url, self.allowed_domains)
+            response = self._open(url, allow_redirects=False)
+            if response.status_code not in REDIRECT_CODES:
+                return response
+            response.close()
+            location = response.headers.get('Location')
+            if not location:
+                raise MediaError('Redirect from {} without a location'.format(url))
+            url = urljoin(url, location)
+        raise MediaError('Too many redirects fetching {}'.format(url))
+
+    def _checked_size(self, url: str, response: requests.Response) -> int:
+        length = response.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            raise MediaError('{} has no Content-Length'.format(url))
+        size = int(length)
+        if size > self.max_size:
+            raise MediaError('{} is too large ({} bytes, limit {})'.format(url, size, self.max_size))
+        return size
+
+    def _copy_to_matrix(self, url: str) -> Dict:
+        with self.slots:
+            response = self._open_source(url)
+            try:
+                size = self._checked_size(url, response)
+                mimetype = response.headers.get('Content-Type', 'application/octet-stream').split(';')[0].strip()
+                filename = unquote(urlsplit(url).path.rsplit('/', 1)[-1]) or 'file'
+
+                upload = self.session.post(self.api.base_url + MEDIA_API_PATH + '/upload',
+                                           params={'filename': filename},
+                                           data=ChunkReader(response.iter_content(CHUNK_SIZE), size),
+                                           headers={'Content-Type': mimetype,
+                                                    'Authorization': 'Bearer {}'.format(self.api.token)},
+                                           verify=getattr(self.api, 'validate_cert', True),
+                                           timeout=TRANSFER_TIMEOUT)
+            finally:
+                response.close()
+
+        if upload.status_code != 200:
+            raise MediaError('Homeserver rejected upload of {} ({})'.format(url, upload.status_code))
+        info = {'url': upload.json()['content_uri'], 'mimetype': mimetype, 'size': size, 'filename': filename}
+        self.transferred += 1
+        logger.info('Copied {} ({} bytes) to {}'.format(url, size, info['url']))
+
+        # Don't copy it back if the file is echoed to the Matrix side
+        self.cache.put(('matrix', info['url']), url)
+        return info
+
+    def _request_slot(self, filename: str, size: int, mimetype: str) -> Tuple[str, str, Dict[str, str]]:
+        request = ElementTree.Element('{{{}}}request'.format(UPLOAD_NS),
+                                      filename=filename, size=str(size))
+        request.set('content-type', mimetype)
+        result = self.send_query(request, to=self.upload_service, itype='get')
+
+        slot = result.xml.find('{{{}}}slot'.format(UPLOAD_NS))
+        put = slot.find('{{{}}}put'.format(UPLOAD_NS)) if slot is not None else None
+        get = slot.find('{{{}}}get'.format(UPLOAD_NS)) if slot is not None else None
+        if put is None or get is None:
+            raise MediaError('Malformed upload slot from {}'.format(self.upload_service))
+        headers = {header.get('name'): (header.text or '').replace('\n', '')
+                   for header in put.findall('{{{}}}header'.format(UPLOAD_NS))
+                   if header.get('name') in SLOT_HEADERS}
+        return put.get('url'), get.get('url'), headers
+
+    def _copy_to_xmpp(self, mxc_url: str, filename: str, mimetype: str or None) -> str:
+        with self.slots:
+            response = self._open(download_url(self.api.base_url, mxc_url),
+                                  headers={'Authorization': 'Bearer {}'.format(self.api.token)})
+            try:
+                size = self._checked_size(mxc_url, response)
+                mimetype = mimetype or response.headers.get('Content-Type', 'application/octet-stream')
+                put_url, get_url, headers = self._request_slot(filename, size, mimetype)
+                headers['Content-Type'] = mimetype
+
+                upload = self.session.put(put_url,
+                                          data=ChunkReader(response.iter_content(CHUNK_SIZE), size),
+                                          headers=headers,
+                                          timeout=TRANSFER_TIMEOUT)
+            finally:
+                response.close()
+
+        if upload.status_code not in (200, 201):
+            raise MediaError('Upload service rejected {} ({})'.format(mxc_url, upload.status_code))
+        self.transferred += 1
+        logger.info('Copied {} ({} bytes) to {}'.format(mxc_url, size, get_url))
+
+        # Don't copy it back if the file is echoed to the XMPP side
+        self.cache.put(('xmpp', get_url), {'url': mxc_url, 'mimetype': mimetype, 'size': size, 'filename': filename})
+        return get_url
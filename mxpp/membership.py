@@ -0,0 +1,90 @@
+import logging
+import threading
+from typing import Dict, Iterable, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipIndex:
+    """
+    In-memory index of room memberships, {room_id: {user_id: membership}}.
+
+    Each room is seeded once (e.g. from the room's joined members) and then kept up to date
+     from m.room.member events, so membership questions don't need a request per room.
+    """
+    rooms = None    # type: Dict[str, Dict[str, str]]
+
+    def __init__(self):
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def is_seeded(self, room_id: str) -> bool:
+        with self.lock:
+            return room_id in self.rooms
+
+    def seed(self, room_id: str, memberships: Dict[str, str]):
+        """
+        Replace everything known about a room's membership.
+
+        :param room_id: Room to seed
+        :param memberships: {user_id: membership}, e.g. {'@bot:example.com': 'join'}
+        """
+        with self.lock:
+            self.rooms[room_id] = dict(memberships)
+
+    def update(self, room_id: str, user_id: str, membership: str):
+        """
+        Record a membership change. Changes to rooms which haven't been seeded are ignored,
+         since the rest of the room's membership isn't known.
+
+        :param room_id: Room the change happened in
+        :param user_id: User whose membership changed
+        :param membership: New membership, e.g. 'join', 'invite' or 'leave'
+        """
+        with self.lock:
+            members = self.rooms.get(room_id)
+            if members is None:
+                return
+            if membership in ('leave', 'ban'):
+                members.pop(user_id, None)
+            else:
+                members[user_id] = membership
+
+    def forget(self, room_id: str):
+        with self.lock:
+            self.rooms.pop(room_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+
+    def prune(self, room_ids: Iterable[str]):
+        """
+        Forget every room which isn't in room_ids.
+
+        :param room_ids: Rooms to keep
+        """
+        keep = set(room_ids)
+        with self.lock:
+            for room_id in list(self.rooms.keys()):
+                if room_id not in keep:
+                    del self.rooms[room_id]
+
+    def members(self, room_id: str, membership: str='join') -> Set[str]:
+        """
+        :param room_id: Room to check
+        :param membership: Membership to look for
+        :return: Users with the given membership in the room.
+        """
+        with self.lock:
+            return {user_id for user_id, m in self.rooms.get(room_id, {}).items() if m == membership}
+
+    def missing(self, room_id: str, user_ids: Iterable[str]) -> List[str]:
+        """
+        :param room_id: Room to check
+        :param user_ids: Users who should be in the room
+        :return: Those users who have neither joined nor been invited to the room.
+        """
+        with self.lock:
+            members = self.rooms.get(room_id, {})
+            return [user_id for user_id in user_ids if members.get(user_id) not in ('join', 'invite')]
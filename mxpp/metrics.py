@@ -0,0 +1,243 @@
+import bisect
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """
+    Thread-safe histogram with fixed bucket bounds, in the style of a Prometheus histogram.
+    """
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float or None:
+        """
+        Estimate a quantile by interpolating within the bucket it falls in.
+
+        :param q: Quantile to estimate, between 0 and 1
+        :return: Estimated value, or None if nothing has been observed.
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for i, count in enumerate(self.counts):
+                if seen + count >= rank and count > 0:
+                    lower = self.buckets[i - 1] if i > 0 else 0.0
+                    if i == len(self.buckets):
+                        return lower
+                    upper = self.buckets[i]
+                    return lower + (upper - lower) * (rank - seen) / count
+                seen += count
+            return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        with self.lock:
+            lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                     '# TYPE {} histogram'.format(self.name)]
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+            lines.append('{}_sum {}'.format(self.name, self.sum))
+            lines.append('{}_count {}'.format(self.name, self.count))
+            return lines
+
+    def summarize(self) -> str:
+        if self.count == 0:
+            return '{}: no samples'.format(self.name)
+        return '{}: n={} p50={:.3f}s p99={:.3f}s'.format(
+            self.name, self.count, self.quantile(0.5), self.quantile(0.99))
+
+
+class Counter:
+    """
+    Thread-safe counter with a single set of labels per series.
+    """
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}        # type: Dict[Tuple[str, ...], float]
+        self.lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                     '# TYPE {} counter'.format(self.name)]
+            for labels, value in sorted(self.values.items()):
+                label_str = ','.join('{}="{}"'.format(k, v) for k, v in zip(self.label_names, labels))
+                if label_str:
+                    lines.append('{}{{{}}} {}'.format(self.name, label_str, value))
+                else:
+                    lines.append('{} {}'.format(self.name, value))
+            return lines
+
+    def summarize(self, top: int=10) -> str:
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda kv: -kv[1])
+        if not items:
+            return '{}: none'.format(self.name)
+        lines = ['{}:'.format(self.name)]
+        for labels, value in items[:top]:
+            lines.append('  {} {:g}'.format(' '.join(labels), value))
+        if len(items) > top:
+            lines.append('  ({} more)'.format(len(items) - top))
+        return '\n'.join(lines)
+
+
+class Gauge:
+    """
+    Gauge whose value is read from a callback whenever it is rendered.
+    """
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+
+    def value(self) -> float:
+        try:
+            return self.func()
+        except Exception:
+            logger.exception('Failed to read gauge {}'.format(self.name))
+            return float('nan')
+
+    def render(self) -> List[str]:
+        return ['# HELP {} {}'.format(self.name, self.help_text),
+                '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, self.value())]
+
+    def summarize(self) -> str:
+        return '{}: {:g}'.format(self.name, self.value())
+
+
+class Metrics:
+    """
+    Registry of the bridge's metrics.
+    """
+    def __init__(self):
+        self.metrics = []   # type: List[Histogram or Counter or Gauge]
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...]=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...]=()) -> Counter:
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help_text, func))
+
+    def render(self) -> str:
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def summarize(self) -> str:
+        """
+        :return: Human-readable summary of all metrics.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return '\n'.join(metric.summarize() for metric in metrics)
+
+
+ROOM_ID_RE = re.compile(r'^(!|%21)')
+USER_ID_RE = re.compile(r'^(@|%40)')
+API_PREFIX_RE = re.compile(r'^/_matrix/(client|media)/[^/]+')
+
+
+def normalize_endpoint(path: str) -> str:
+    """
+    Reduce a Matrix API path to its endpoint, e.g.
+     /_matrix/client/r0/rooms/!abc:example.com/send/m.room.message/123 -> /rooms/{roomId}/send/{type}/{txnId}
+
+    :param path: Request path, optionally with a query string
+    :return: Path with IDs replaced by placeholders
+    """
+    path = API_PREFIX_RE.sub('', path.split('?', 1)[0])
+    parts = path.split('/')
+    for i, part in enumerate(parts):
+        if ROOM_ID_RE.match(part):
+            parts[i] = '{roomId}'
+        elif USER_ID_RE.match(part):
+            parts[i] = '{userId}'
+        elif i >= 2 and parts[i - 2] == 'send':
+            parts[i - 1] = '{type}'
+            parts[i] = '{txnId}'
+        elif i >= 1 and parts[i - 1] == 'state':
+            parts[i] = '{type}'
+    return '/'.join(parts)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """
+    Serves metrics in the Prometheus text format at http://host:port/metrics .
+    """
+    def __init__(self, metrics: Metrics, host: str='127.0.0.1', port: int=9224):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('Metrics request: ' + format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mxpp-metrics', daemon=True)
+        self.thread.start()
+        logger.info('Serving metrics on http://{}:{}/metrics'.format(host, port))
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,201 @@
+import calendar
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+MUC_NS = 'http://jabber.org/protocol/muc'
+DELAY_NS = 'urn:xmpp:delay'
+STANZA_ID_NS = 'urn:xmpp:sid:0'
+
+# Seconds of extra history to ask for when rejoining, in case our clock is ahead of the server's
+HISTORY_SLACK = 60
+
+STAMP_RE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$')
+
+
+def parse_stamp(stamp: str) -> float or None:
+    """
+    :param stamp: XEP-0082 date-time, e.g. '2002-09-10T23:08:25.123Z'
+    :return: Seconds since the epoch, or None if the stamp can't be parsed.
+    """
+    match = STAMP_RE.match(stamp or '')
+    if match is None:
+        return None
+    year, month, day, hour, minute, second = (int(part) for part in match.groups()[:6])
+    seconds = calendar.timegm((year, month, day, hour, minute, second)) + float(match.group(7) or 0)
+    zone = match.group(8)
+    if zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+        seconds -= offset if zone[0] == '+' else -offset
+    return seconds
+
+
+def format_stamp(seconds: float) -> str:
+    """
+    :param seconds: Seconds since the epoch
+    :return: XEP-0082 date-time in UTC
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def delay_stamp(message) -> float or None:
+    """
+    :param message: MUC message
+    :return: When the message was originally sent, if it is delayed (e.g. room history), else None.
+    """
+    delay = message.xml.find('{{{}}}delay'.format(DELAY_NS))
+    if delay is None:
+        return None
+    return parse_stamp(delay.get('stamp'))
+
+
+def stanza_id(xml: ElementTree.Element, by: str) -> str or None:
+    """
+    :param xml: <message/> element
+    :param by: Bare JID which assigned the ID: a MUC, or our own for one-to-one messages
+    :return: The message's stanza ID (XEP-0359) assigned by `by`, which is also its archive ID.
+    """
+    for element in xml.findall('{{{}}}stanza-id'.format(STANZA_ID_NS)):
+        if element.get('by') == by and element.get('id'):
+            return element.get('id')
+    return None
+
+
+def groupchat_message_key(message) -> str:
+    """
+    Key identifying a MUC message, which stays the same when the room replays it as history.
+
+    Uses the room's stanza ID (XEP-0359) if there is one, otherwise the sender's message ID,
+     otherwise the sender's nick and the body.
+
+    :param message: MUC message
+    :return: Short hash of the identifying parts
+    """
+    room_stanza_id = stanza_id(message.xml, message['from'].bare)
+    if room_stanza_id is not None:
+        identity = 'sid:' + room_stanza_id
+    elif message['id']:
+        identity = 'id:{}:{}'.format(message['mucnick'], message['id'])
+    else:
+        identity = 'body:{}:{}'.format(message['mucnick'], message['body'])
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def join_muc(client, room_jid: str, nick: str, maxstanzas: int=None, since: float=None):
+    """
+    Join a MUC, asking for only the history we might have missed (XEP-0045 section 7.2.15).
+
+    Works like the xep_0045 plugin's joinMUC (and registers the room with the plugin the same way),
+     which can't ask for history since a point in time.
+
+    :param client: XMPP client
+    :param room_jid: MUC to join
+    :param nick: Nick to join as
+    :param maxstanzas: Maximum number of history messages to ask for
+    :param since: Only ask for history sent after this time (seconds since the epoch).
+        If None, no history is requested.
+    """
+    presence = client.make_presence(pto='{}/{}'.format(room_jid, nick))
+    x = ElementTree.Element('{{{}}}x'.format(MUC_NS))
+    history = ElementTree.SubElement(x, '{{{}}}history'.format(MUC_NS))
+    if since is None:
+        history.set('maxchars', '0')
+    else:
+        history.set('since', format_stamp(since))
+        if maxstanzas is not None:
+            history.set('maxstanzas', str(maxstanzas))
+    presence.append(x)
+
+    plugin = client.plugin['xep_0045']
+    plugin.rooms[room_jid] = {}
+    our_nicks = getattr(plugin, 'our_nicks', None)
+    if our_nicks is None:
+        our_nicks = plugin.ourNicks
+    our_nicks[room_jid] = nick
+
+    client.send(presence)
+
+
+class MucHistoryIndex:
+    """
+    Remembers, for each MUC, when the last message was bridged and the keys of the most recently
+     bridged messages (see groupchat_message_key), so history replayed by the room when it is
+     rejoined isn't bridged twice.
+
+    Changes are saved through `save` at most once every `save_interval` seconds, and by flush().
+    """
+    rooms = None    # type: Dict[str, Tuple[float, OrderedDict]]
+
+    def __init__(self,
+                 stored: Dict[str, Tuple[float, List[str]]],
+                 save: Callable[[str, float, List[str]], None],
+                 keys_per_room: int=200,
+                 save_interval: float=1.0):
+        """
+        :param stored: Index saved by a previous run, {room_jid: (last bridged, [keys, oldest first])}
+        :param save: Called with (room_jid, last bridged, keys) to save a room's entry
+        :param keys_per_room: Number of message keys to remember per room
+        :param save_interval: Minimum number of seconds between saves
+        """
+        self.save = save
+        self.keys_per_room = keys_per_room
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.rooms = {room_jid: (last_bridged, OrderedDict.fromkeys(keys))
+                      for room_jid, (last_bridged, keys) in stored.items()}
+        self.dirty = set()
+        self.last_save = time.monotonic()
+
+    def last_bridged(self, room_jid: str) -> float or None:
+        with self.lock:
+            entry = self.rooms.get(room_jid)
+            return entry[0] if entry is not None else None
+
+    def is_duplicate(self, room_jid: str, key: str) -> bool:
+        with self.lock:
+            entry = self.rooms.get(room_jid)
+            return entry is not None and key in entry[1]
+
+    def add(self, room_jid: str, key: str, stamp: float):
+        """
+        Record that a message has been bridged.
+
+        :param room_jid: MUC the message came from
+        :param key: Key of the message
+        :param stamp: When the message was sent
+        """
+        with self.lock:
+            last_bridged, keys = self.rooms.get(room_jid, (0.0, OrderedDict()))
+            keys[key] = None
+            while len(keys) > self.keys_per_room:
+                keys.popitem(last=False)
+            self.rooms[room_jid] = (max(last_bridged, stamp), keys)
+            self.dirty.add(room_jid)
+            save_now = time.monotonic() - self.last_save >= self.save_interval
+
+        if save_now:
+            self.flush()
+
+    def forget(self, room_jid: str):
+        with self.lock:
+            self.rooms.pop(room_jid, None)
+            self.dirty.discard(room_jid)
+
+    def flush(self):
+        """
+        Save the rooms which have changed since the last save.
+        """
+        with self.lock:
+            changed = [(room_jid, self.rooms[room_jid][0], list(self.rooms[room_jid][1]))
+                       for room_jid in self.dirty]
+            self.dirty.clear()
+            self.last_save = time.monotonic()
+        for room_jid, last_bridged, keys in changed:
+            self.save(room_jid, last_bridged, keys)
@@ -0,0 +1,213 @@
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from matrix_client.api import MatrixHttpApi, MATRIX_V2_API_PATH
+from matrix_client.errors import MatrixRequestError
+from mxpp.dispatch import KeyedDispatcher
+from mxpp.provision import retry_after
+from mxpp.supervisor import Backoff
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the homeserver to answer a single send
+SEND_TIMEOUT = 30
+
+
+def text_content(text: str, msgtype: str='m.text') -> Dict:
+    return {'msgtype': msgtype, 'body': text}
+
+
+def html_content(html: str, body: str=None, msgtype: str='m.text') -> Dict:
+    return {
+        'msgtype': msgtype,
+        'body': body if body is not None else html,
+        'format': 'org.matrix.custom.html',
+        'formatted_body': html,
+    }
+
+
+class OutboundSender:
+    """
+    Sends Matrix message events on a pool of worker threads, with its own keep-alive connection
+     pool (separate from the long-polling sync).
+
+    send() returns immediately. Events for the same room are sent in the order they were
+     submitted; different rooms are sent in parallel. Each event gets its transaction ID when
+     it is submitted, so retrying after a rate limit (429), a server error (5xx) or a dropped
+     connection can never post it twice.
+    """
+    api = None                  # type: MatrixHttpApi
+    dispatcher = None           # type: KeyedDispatcher
+    response_callback = None    # type: Callable[[str, str, int], None]
+    sent_callback = None        # type: Callable[[float], None]
+
+    def __init__(self,
+                 api: MatrixHttpApi,
+                 workers: int=4,
+                 max_retries: int=8,
+                 retry_initial: float=1.0,
+                 retry_maximum: float=60.0,
+                 rate_limit_budget: float=3600.0,
+                 response_callback: Callable[[str, str, int], None]=None,
+                 sent_callback: Callable[[float], None]=None):
+        """
+        :param api: API of the Matrix client to send as. Its base URL, access token and
+            certificate checking are used, but not its HTTP session.
+        :param workers: Number of rooms which may be sent to at once (and size of the connection pool)
+        :param max_retries: Number of times to retry an event before giving up on it
+        :param retry_initial: Seconds to wait before the first retry after an error, doubling
+            after each consecutive error up to `retry_maximum`.
+            Rate-limited requests wait as long as the homeserver asks instead.
+        :param retry_maximum: See `retry_initial`
+        :param rate_limit_budget: Total seconds an event may spend waiting out rate limits (429),
+            which don't count towards `max_retries`, before giving up on it
+        :param response_callback: Called with (method, path, status code) for every HTTP response
+        :param sent_callback: Called with the number of seconds between submitting each event
+            and the homeserver accepting it
+        """
+        self.api = api
+        self.max_retries = max_retries
+        self.retry_initial = retry_initial
+        self.retry_maximum = retry_maximum
+        self.rate_limit_budget = rate_limit_budget
+        self.response_callback = response_callback
+        self.sent_callback = sent_callback
+        self.txn_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.failed = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if response_callback is not None:
+            self.session.hooks['response'].append(self._handle_response)
+
+        self.dispatcher = KeyedDispatcher(workers, name='mxpp-outbound')
+
+    def _handle_response(self, response, *_args, **_kwargs):
+        self.response_callback(response.request.method, response.request.path_url, response.status_code)
+
+    def make_txn_id(self) -> str:
+        return 'mxpp{}.{}'.format(int(time.time() * 1000), next(self.txn_ids))
+
+    def send(self, room_id: str, content: Dict, event_type: str='m.room.message',
+             on_done: Callable[[], None]=None, user_id: str=None) -> str:
+        """
+        Queue an event to be sent to a room.
+
+        :param room_id: Room to send to
+        :param content: Event content
+        :param event_type: Event type
+        :param on_done: Called once the homeserver has accepted the event, or permanently rejected
+            it (4xx). Not called for an event which runs out of retries, so that its journal entry
+            stays unacknowledged and it is bridged again on the next startup.
+        :param user_id: Application service user to send as, or None to send as ourselves
+        :return: Transaction ID of the event
+        """
+        txn_id = self.make_txn_id()
+        self.dispatcher.submit(room_id, self._send, room_id, event_type, content, txn_id, time.monotonic(), on_done,
+                               user_id)
+        return txn_id
+
+    def send_text(self, room_id: str, text: str) -> str:
+        return self.send(room_id, text_content(text))
+
+    def send_notice(self, room_id: str, text: str) -> str:
+        return self.send(room_id, text_content(text, 'm.notice'))
+
+    def send_html(self, room_id: str, html: str, body: str=None, msgtype: str='m.text') -> str:
+        return self.send(room_id, html_content(html, body, msgtype))
+
+    def queue_depth(self) -> int:
+        """
+        :return: Number of events waiting to be sent or being sent.
+        """
+        return self.dispatcher.total_depth()
+
+    def shutdown(self, grace: float=10.0):
+        """
+        Wait up to `grace` seconds for queued events to be sent, then drop the rest.
+        """
+        deadline = time.monotonic() + grace
+        while self.queue_depth() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        unsent = self.queue_depth()
+        if unsent:
+            logger.warning('Dropped {} unsent Matrix events on shutdown'.format(unsent))
+        self.dispatcher.shutdown(wait=False)
+        self.session.close()
+
+    def _send(self, room_id: str, event_type: str, content: Dict, txn_id: str, submitted: float,
+              on_done: Callable[[], None] or None, user_id: str or None):
+        path = '/rooms/{}/send/{}/{}'.format(quote(room_id), quote(event_type), quote(txn_id))
+        backoff = Backoff(self.retry_initial, self.retry_maximum)
+        retries = 0
+        rate_limited = 0.0
+
+        while True:
+            try:
+                self._put(path, content, user_id)
+                if self.sent_callback is not None:
+                    self.sent_callback(time.monotonic() - submitted)
+                if on_done is not None:
+                    on_done()
+                return
+            except MatrixRequestError as e:
+                if e.code == 429:
+                    # Waiting as long as the homeserver asks isn't a failed attempt
+                    delay = retry_after(e)
+                    rate_limited += delay
+                    if rate_limited > self.rate_limit_budget:
+                        logger.error('Rate limited for over {:g}s sending to {}; giving up until the next startup'.format(
+                            self.rate_limit_budget, room_id))
+                        self.count_failure()
+                        return
+                    logger.debug('Rate limited sending to {}, retrying in {:.1f}s'.format(room_id, delay))
+                    time.sleep(delay)
+                    continue
+                elif e.code >= 500:
+                    delay = backoff.next()
+                else:
+                    logger.error('Homeserver rejected event for {} ({}), dropping it'.format(room_id, e.code))
+                    self.count_failure()
+                    if on_done is not None:
+                        on_done()
+                    return
+                error = e.code
+            except requests.RequestException as e:
+                delay = backoff.next()
+                error = e
+
+            if retries >= self.max_retries:
+                break
+            retries += 1
+            logger.warning('Failed to send event to {} ({}), retrying in {:.1f}s'.format(room_id, error, delay))
+            time.sleep(delay)
+
+        logger.error('Giving up on event for {} after {} retries; it will be replayed on the next startup'.format(
+            room_id, self.max_retries))
+        self.count_failure()
+
+    def count_failure(self):
+        # Called from every worker thread
+        with self.lock:
+            self.failed += 1
+
+    def _put(self, path: str, content: Dict, user_id: str=None):
+        response = self.session.put(self.api.base_url + MATRIX_V2_API_PATH + path,
+                                    json=content,
+                                    params={'user_id': user_id} if user_id is not None else None,
+                                    headers={'Authorization': 'Bearer {}'.format(self.api.token)},
+                                    verify=getattr(self.api, 'validate_cert', True),
+                                    timeout=SEND_TIMEOUT)
+        if response.status_code < 200 or response.status_code >= 300:
+            raise MatrixRequestError(code=response.status_code, content=response.text)
@@ -0,0 +1,180 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownJidBuffer:
+    """
+    Holds inbound XMPP events from JIDs which aren't in the roster, while the roster is
+     refreshed in the background, instead of blocking a worker on a roster round-trip.
+
+    The first held event starts a roster request `coalesce_delay` seconds later, so a burst of
+     unknown JIDs only causes a single request. Once the roster has been answered (or `timeout`
+     seconds have passed without an answer), each JID's held events are handed back, in order,
+     through `submit`. JIDs which are still unknown at that point are remembered as strangers:
+     their held events are handed to `stranger` instead (by default, logged and dropped), and
+     their later events are handled straight away rather than held again, so handlers must cope
+     with JIDs which aren't in the roster.
+    """
+    held = None         # type: Dict[str, deque]
+    strangers = None    # type: OrderedDict
+    submit = None       # type: Callable
+    stranger = None     # type: Callable
+
+    def __init__(self,
+                 is_known: Callable[[str], bool],
+                 request_roster: Callable[[], None],
+                 submit: Callable,
+                 stranger: Callable=None,
+                 coalesce_delay: float=0.5,
+                 timeout: float=10.0,
+                 max_held: int=1000,
+                 max_strangers: int=10000):
+        """
+        :param is_known: Returns True if a bare JID is in the roster (or otherwise needs no lookup)
+        :param request_roster: Sends a roster request without waiting for the answer
+        :param submit: Called as submit(jid, func, *args) to queue work behind the JID's other events,
+            e.g. KeyedDispatcher.submit
+        :param stranger: Called as stranger(jid, func, *args), instead of func(*args), for each event
+            held from a JID which is still unknown once the roster has been refreshed. If None,
+            those events are logged and dropped.
+        :param coalesce_delay: Seconds to wait for more unknown JIDs before requesting the roster
+        :param timeout: Seconds to wait for the roster before handling the held events anyway
+        :param max_held: Maximum number of events to hold at once; beyond this, events are handled
+            straight away.
+        :param max_strangers: Number of strangers to remember. The least recent are forgotten first.
+        """
+        self.is_known = is_known
+        self.request_roster = request_roster
+        self.submit = submit
+        self.stranger = stranger if stranger is not None else self.drop
+        self.coalesce_delay = coalesce_delay
+        self.timeout = timeout
+        self.max_held = max_held
+        self.max_strangers = max_strangers
+
+        self.held = {}
+        self.draining = set()           # type: Set[str]
+        self.num_held = 0
+        self.strangers = OrderedDict()  # type: Dict[str, None]
+        self.lock = threading.Lock()
+        self.timer = None               # type: threading.Timer
+        self.requested = False
+
+    def hold(self, jid: str, func: Callable, *args) -> bool:
+        """
+        Hold func(*args) until the roster has been refreshed, if `jid` is unknown or already has
+         events held.
+
+        :param jid: Bare JID the event came from
+        :param func: Handler to run once the roster has been refreshed
+        :param args: Arguments for the handler
+        :return: True if the event was held; False if the caller should handle it now.
+        """
+        with self.lock:
+            queue = self.held.get(jid)
+            if queue is None:
+                if jid in self.strangers or self.is_known(jid):
+                    return False
+                if self.num_held >= self.max_held:
+                    logger.warning('Too many events waiting for the roster, not holding event from {}'.format(jid))
+                    return False
+                queue = deque()
+                self.held[jid] = queue
+                logger.info('{} is not in the roster, holding its events until the roster is refreshed'.format(jid))
+
+            queue.append((func, args))
+            self.num_held += 1
+            if jid not in self.draining and self.timer is None:
+                self.timer = threading.Timer(self.coalesce_delay, self._request)
+                self.timer.daemon = True
+                self.timer.start()
+            return True
+
+    def held_count(self) -> int:
+        with self.lock:
+            return self.num_held
+
+    def roster_answered(self):
+        """
+        Hand back all held events. Call once the roster has been received and applied.
+        """
+        with self.lock:
+            if not self.requested:
+                # Not our request; ours will still be answered separately
+                return
+            self._release()
+
+    def _request(self):
+        with self.lock:
+            self.requested = True
+            self.timer = threading.Timer(self.timeout, self._timed_out)
+            self.timer.daemon = True
+            self.timer.start()
+        logger.debug('Requesting the roster for {} unknown JIDs'.format(len(self.held)))
+        try:
+            self.request_roster()
+        except Exception:
+            logger.exception('Roster request failed')
+
+    def _timed_out(self):
+        with self.lock:
+            if not self.requested:
+                return
+            logger.warning('No answer to roster request after {}s, handling held events anyway'.format(
+                self.timeout))
+            self._release()
+
+    def _release(self):
+        # Called with self.lock held
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.requested = False
+
+        for jid in list(self.held.keys()):
+            if jid in self.draining:
+                continue
+            known = self.is_known(jid)
+            if not known:
+                logger.info('{} is still not in the roster, treating it as a stranger'.format(jid))
+                self.strangers[jid] = None
+                self.strangers.move_to_end(jid)
+                while len(self.strangers) > self.max_strangers:
+                    self.strangers.popitem(last=False)
+            # The JID keeps its queue (so new events still line up behind the held ones)
+            #  until _drain has emptied it
+            self.draining.add(jid)
+            self.submit(jid, self._drain, jid, known)
+
+    def _drain(self, jid: str, known: bool):
+        with self.lock:
+            queue = self.held[jid]
+            func, args = queue.popleft()
+            self.num_held -= 1
+            more = len(queue) > 0
+            if not more:
+                del self.held[jid]
+                self.draining.discard(jid)
+
+        try:
+            if known:
+                func(*args)
+            else:
+                self.stranger(jid, func, *args)
+        finally:
+            if more:
+                self.submit(jid, self._drain, jid, known)
+
+    @staticmethod
+    def drop(jid: str, func: Callable, *args):
+        logger.warning('Dropping event held from {}, which is not in the roster'.format(jid))
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = None
@@ -0,0 +1,160 @@
+import fnmatch
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Pattern, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Per-JID options which can be set by jid_groups, and their flag bits
+SEND_MESSAGES_TO_ALL_CHAT = 1 << 0
+SEND_MESSAGES_TO_JID_ROOMS = 1 << 1
+SEND_PRESENCES_TO_CONTROL = 1 << 2
+BATCH_MESSAGES_TO_ALL_CHAT = 1 << 3
+
+ACTION_FLAGS = OrderedDict([
+    ('send_messages_to_all_chat', SEND_MESSAGES_TO_ALL_CHAT),
+    ('send_messages_to_jid_rooms', SEND_MESSAGES_TO_JID_ROOMS),
+    ('send_presences_to_control', SEND_PRESENCES_TO_CONTROL),
+    ('batch_messages_to_all_chat', BATCH_MESSAGES_TO_ALL_CHAT),
+])
+
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+# What a rule does to a JID's flags: (bits it sets or clears, their new values)
+Rule = Tuple[int, int]
+
+
+def compile_options(options: Dict[str, bool]) -> Rule:
+    """
+    :param options: Per-JID options from a jid_groups entry (or the top level of the config)
+    :return: The options as a Rule. Unknown options are logged and ignored.
+    """
+    mask = 0
+    value = 0
+    for option, enabled in options.items():
+        flag = ACTION_FLAGS.get(option)
+        if flag is None:
+            logger.warning('Ignoring unknown jid_groups option {}'.format(option))
+            continue
+        mask |= flag
+        if enabled:
+            value |= flag
+    return mask, value
+
+
+def apply_rule(flags: int, rule: Rule) -> int:
+    mask, value = rule
+    return (flags & ~mask) | value
+
+
+def combine_rules(first: Rule, then: Rule) -> Rule:
+    """
+    :return: A rule with the same effect as applying `first` and then `then`.
+    """
+    return first[0] | then[0], apply_rule(first[1], then)
+
+
+class JidPolicy:
+    """
+    The jid_groups section of the config, compiled into an index of flag bits (see ACTION_FLAGS).
+
+    Each entry in a group's `jids` is one of:
+     - an exact bare JID, e.g. 'friend@example.com'
+     - a domain, written '@example.org', matching every JID at that domain or its subdomains
+     - a glob pattern, e.g. '*@muc.*.org' or 'bot-?@example.com'
+
+    A JID starts with the default options and has every matching group applied in turn, from the
+     least to the most specific rule: globs, then domains (shortest first), then exact JIDs.
+     Among rules of the same kind, later groups override earlier ones, as they always have for
+     exact JIDs.
+
+    Lookups are cached; the index is never changed after it has been built (reloading the
+     config builds a new one).
+    """
+    exact = None        # type: Dict[str, Rule]
+    domains = None      # type: Dict[str, Rule]
+    globs = None        # type: List[Tuple[Pattern, Rule]]
+    cache = None        # type: OrderedDict
+
+    def __init__(self, defaults: Dict[str, bool], groups: List[Dict], cache_size: int=4096):
+        """
+        :param defaults: Options for JIDs which no group matches
+        :param groups: The config's jid_groups
+        :param cache_size: Number of JIDs whose flags are remembered
+        """
+        self.defaults = apply_rule(0, compile_options(defaults))
+        self.exact = {}
+        self.domains = {}
+        self.globs = []
+        for group in groups:
+            options = dict(group)
+            jids = options.pop('jids', None) or []
+            rule = compile_options(options)
+            for entry in jids:
+                self.add(str(entry).strip().lower(), rule)
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        logger.debug('Compiled jid_groups: {} JIDs, {} domains, {} patterns'.format(
+            len(self.exact), len(self.domains), len(self.globs)))
+
+    def add(self, entry: str, rule: Rule):
+        if GLOB_CHARS.search(entry):
+            self.globs.append((re.compile(fnmatch.translate(entry)), rule))
+        elif entry.startswith('@'):
+            domain = entry[1:]
+            self.domains[domain] = combine_rules(self.domains.get(domain, (0, 0)), rule)
+        else:
+            self.exact[entry] = combine_rules(self.exact.get(entry, (0, 0)), rule)
+
+    def flags(self, jid: str) -> int:
+        """
+        :param jid: Bare JID (or MUC JID)
+        :return: The JID's options, as flag bits
+        """
+        with self.lock:
+            flags = self.cache.get(jid)
+            if flags is not None:
+                self.cache.move_to_end(jid)
+                return flags
+
+        flags = self.resolve(jid)
+        with self.lock:
+            self.cache[jid] = flags
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return flags
+
+    def resolve(self, jid: str) -> int:
+        """
+        Work out a JID's flags from the index, without the cache.
+        """
+        jid = jid.lower()
+        flags = self.defaults
+
+        for pattern, rule in self.globs:
+            if pattern.match(jid):
+                flags = apply_rule(flags, rule)
+
+        if self.domains:
+            labels = jid.rsplit('@', 1)[-1].split('.')
+            for i in range(len(labels) - 1, -1, -1):
+                rule = self.domains.get('.'.join(labels[i:]))
+                if rule is not None:
+                    flags = apply_rule(flags, rule)
+
+        rule = self.exact.get(jid)
+        if rule is not None:
+            flags = apply_rule(flags, rule)
+        return flags
+
+    def allows(self, jid: str, flag: int) -> bool:
+        """
+        :param jid: Bare JID (or MUC JID)
+        :param flag: One of the option flags, e.g. SEND_MESSAGES_TO_ALL_CHAT
+        :return: True if the option is enabled for the JID
+        """
+        return bool(self.flags(jid) & flag)
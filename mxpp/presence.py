@@ -0,0 +1,128 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceAggregator:
+    """
+    Collapses presence changes into periodic digest messages.
+
+    Remembers the last reported state of each JID, drops changes which don't change that state,
+     and reports all the changes which happened within `window` seconds as a single message.
+    """
+    known = None        # type: OrderedDict
+    pending = None      # type: OrderedDict
+    emit = None         # type: Callable[[str], None]
+
+    def __init__(self,
+                 emit: Callable[[str], None],
+                 window: float=5.0,
+                 max_pending: int=500,
+                 max_tracked: int=10000,
+                 max_listed: int=50):
+        """
+        :param emit: Called with each digest message.
+        :param window: Number of seconds to collect changes for before emitting a digest.
+            If 0, every change is emitted right away.
+        :param max_pending: Emit a digest early if this many changes are waiting.
+        :param max_tracked: Number of JIDs to remember the last state of. The least recently
+            changed JIDs are forgotten first.
+        :param max_listed: Maximum number of JIDs to name per state in a single digest.
+        """
+        self.emit = emit
+        self.window = window
+        self.max_pending = max_pending
+        self.max_tracked = max_tracked
+        self.max_listed = max_listed
+
+        self.known = OrderedDict()      # type: Dict[str, str]
+        self.pending = OrderedDict()    # type: Dict[str, Tuple[str, str]]
+        self.lock = threading.Lock()
+        self.timer = None               # type: threading.Timer
+
+    def update(self, jid: str, name: str, state: str):
+        """
+        Record a presence change.
+
+        :param jid: Bare JID whose presence changed
+        :param name: Display name for the JID
+        :param state: New presence, e.g. 'available' or 'unavailable'
+        """
+        flush_now = False
+        with self.lock:
+            if jid in self.pending:
+                if self.known.get(jid) == state:
+                    # Changed and changed back before we reported it
+                    del self.pending[jid]
+                    return
+            elif self.known.get(jid) == state:
+                return
+
+            self.pending[jid] = (name, state)
+            self.pending.move_to_end(jid)
+
+            if self.window <= 0 or len(self.pending) >= self.max_pending:
+                flush_now = True
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """
+        Emit a digest of all pending changes, if there are any.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            pending = self.pending
+            self.pending = OrderedDict()
+            for jid, (_name, state) in pending.items():
+                self.known[jid] = state
+                self.known.move_to_end(jid)
+            while len(self.known) > self.max_tracked:
+                self.known.popitem(last=False)
+
+        if not pending:
+            return
+
+        try:
+            self.emit(self.format_digest(pending))
+        except Exception:
+            logger.exception('Failed to send presence digest')
+
+    def shutdown(self):
+        """
+        Emit any pending changes and stop the timer.
+        """
+        self.flush()
+
+    def format_digest(self, changes: Dict[str, Tuple[str, str]]) -> str:
+        """
+        :param changes: {jid: (name, state)}
+        :return: Human-readable summary of the changes.
+        """
+        if len(changes) == 1:
+            jid, (name, state) = next(iter(changes.items()))
+            return '{} {} ({})'.format(name, state, jid)
+
+        by_state = OrderedDict()
+        for jid, (name, state) in changes.items():
+            by_state.setdefault(state, []).append('{} ({})'.format(name, jid))
+
+        header = ', '.join('{} {}'.format(len(entries), state) for state, entries in by_state.items())
+        lines = [header + ':']
+        for state, entries in by_state.items():
+            listed = ', '.join(entries[:self.max_listed])
+            if len(entries) > self.max_listed:
+                listed += ' and {} more'.format(len(entries) - self.max_listed)
+            lines.append('{}: {}'.format(state, listed))
+        return '\n'.join(lines)
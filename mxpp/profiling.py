@@ -0,0 +1,239 @@
+"""
+On-demand diagnostics for the running bridge, started from the control room: a sampling
+ profiler, tracemalloc memory snapshots and thread dumps.
+
+Nothing here runs (or hooks into the interpreter) until a diagnostic is requested, and each one
+ only runs for a bounded window, so the bridge pays nothing for it while idle.
+"""
+import logging
+import os
+import re
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+DURATION_RE = re.compile(r'^(\d+(?:\.\d*)?)\s*(ms|s|m)?$')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, None: 1}
+
+# Frames of stack traces kept for each allocation while tracing memory
+TRACE_FRAMES = 10
+# Deepest stack recorded per sample
+MAX_STACK_DEPTH = 128
+# Standard library modules a thread is almost always waiting in (for a lock, a socket, ...) when
+#  they are at the top of its stack; samples there are counted as idle rather than as hot spots.
+IDLE_MODULES = ('threading.py', 'queue.py', 'selectors.py', 'socket.py', 'ssl.py', 'socketserver.py',
+                'base_events.py')
+
+STDLIB_DIR = os.path.normcase(sysconfig.get_paths()['stdlib'])
+
+
+class ProfilerBusy(Exception):
+    """
+    Another diagnostic is already running.
+    """
+
+
+def parse_duration(text: str) -> float:
+    """
+    :param text: Duration such as '30s', '2m', '500ms' or '30' (seconds)
+    :return: Duration in seconds; raises ValueError if `text` isn't a duration.
+    """
+    match = DURATION_RE.match(text.strip().lower())
+    if match is None:
+        raise ValueError('Not a duration: {}'.format(text))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def is_stdlib(frame) -> bool:
+    return os.path.normcase(frame.f_code.co_filename).startswith(STDLIB_DIR)
+
+
+def blocking_site(frame) -> str:
+    """
+    :param frame: Innermost frame of a thread
+    :return: Where the thread is: the innermost frame, and the innermost frame outside the standard
+        library which led to it (e.g. the bridge code waiting on a queue).
+    """
+    site = '{} ({}:{})'.format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+    caller = frame
+    while caller is not None and is_stdlib(caller):
+        caller = caller.f_back
+    if caller is not None and caller is not frame:
+        site += ' <- {} ({}:{})'.format(caller.f_code.co_name, os.path.basename(caller.f_code.co_filename),
+                                        caller.f_lineno)
+    return site
+
+
+class Profiler:
+    """
+    Runs one diagnostic at a time against the live process, writes its full result to a file
+     in `directory` and returns a short summary of the top `top` entries.
+    """
+    def __init__(self,
+                 directory: str='mxpp_profiles',
+                 max_duration: float=300,
+                 top: int=15,
+                 interval: float=0.005):
+        """
+        :param directory: Where results are written
+        :param max_duration: Longest profile or memory snapshot window, in seconds
+        :param top: Number of entries in each summary
+        :param interval: Seconds between stack samples while profiling
+        """
+        self.directory = directory
+        self.max_duration = max_duration
+        self.top = top
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+    def run(self, name: str, *args) -> str:
+        """
+        Run one of the diagnostics ('profile', 'memory_snapshot' or 'thread_dump'), unless
+         another one is already running (see ProfilerBusy).
+
+        :return: Summary of the result
+        """
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy('Another profile is already running')
+        try:
+            return getattr(self, name)(*args)
+        finally:
+            self.lock.release()
+
+    def output_path(self, kind: str, extension: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '{}-{}.{}'.format(kind, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+    def clamp(self, duration: float) -> float:
+        return max(0.0, min(duration, self.max_duration))
+
+    def profile(self, duration: float) -> str:
+        """
+        Sample the stacks of every thread for `duration` seconds, and write them to a file in the
+         collapsed format read by flamegraph.pl and speedscope.
+
+        :return: Summary of the hottest functions, by samples spent in the function itself
+            (excluding threads waiting in the standard library, see IDLE_MODULES) and including
+            its callees.
+        """
+        duration = self.clamp(duration)
+        own_thread = threading.get_ident()
+        stacks = Counter()        # type: Dict[Tuple[str, ...], int]
+        own = Counter()           # type: Dict[str, int]
+        cumulative = Counter()    # type: Dict[str, int]
+        samples = 0
+        idle = 0
+
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                samples += 1
+                if os.path.basename(frame.f_code.co_filename) in IDLE_MODULES:
+                    idle += 1
+                    continue
+
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.reverse()
+                stacks[tuple(labels)] += 1
+                own[labels[-1]] += 1
+                cumulative.update(set(labels))
+            time.sleep(self.interval)
+
+        path = self.output_path('profile', 'collapsed')
+        with open(path, 'w') as output:
+            for stack, count in stacks.most_common():
+                output.write('{} {}\n'.format(';'.join(stack), count))
+
+        busy = samples - idle
+        lines = ['Profiled for {:g}s: {} samples, {} busy, written to {}'.format(duration, samples, busy, path)]
+        if busy:
+            lines.append('Hottest functions (own / including callees):')
+            for label, count in own.most_common(self.top):
+                lines.append('  {:5.1f}% {:5.1f}%  {}'.format(100 * count / busy, 100 * cumulative[label] / busy, label))
+        logger.info(lines[0])
+        return '\n'.join(lines)
+
+    def memory_snapshot(self, duration: float) -> str:
+        """
+        Trace memory allocations for `duration` seconds (or, if tracemalloc was already tracing,
+         e.g. through PYTHONTRACEMALLOC, since it started), and dump a snapshot of the allocations
+         which are still alive. The dump can be loaded with tracemalloc.Snapshot.load .
+
+        :return: Summary of the largest allocation sites
+        """
+        duration = self.clamp(duration)
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(TRACE_FRAMES)
+        try:
+            time.sleep(duration)
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        path = self.output_path('memsnapshot', 'tracemalloc')
+        snapshot.dump(path)
+
+        stats = snapshot.statistics('lineno')
+        lines = ['Traced allocations {}: {} KiB alive (peak {} KiB), written to {}'.format(
+            'since tracing started' if was_tracing else 'over {:g}s'.format(duration),
+            current // 1024, peak // 1024, path)]
+        if stats:
+            lines.append('Largest allocation sites:')
+            for stat in stats[:self.top]:
+                frame = stat.traceback[0]
+                lines.append('  {:8.1f} KiB {:7} blocks  {}:{}'.format(
+                    stat.size / 1024, stat.count, os.path.basename(frame.filename), frame.lineno))
+        logger.info(lines[0])
+        return '\n'.join(lines)
+
+    def thread_dump(self) -> str:
+        """
+        Write the stack of every thread to a file.
+
+        :return: Summary of where each thread is (threads at the same place are counted together)
+        """
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        sites = Counter()     # type: Dict[Tuple[str, str], int]
+        path = self.output_path('threads', 'txt')
+        with open(path, 'w') as output:
+            for thread_id, frame in sorted(sys._current_frames().items()):
+                thread = threads.get(thread_id)
+                name = thread.name if thread is not None else str(thread_id)
+                output.write('Thread {} ({}{}):\n'.format(
+                    name, thread_id, ', daemon' if thread is not None and thread.daemon else ''))
+                output.write(''.join(traceback.format_stack(frame)))
+                output.write('\n')
+                # Number the threads of a pool under their pool's name
+                sites[(re.sub(r'[-_]?\d+$', '', name), blocking_site(frame))] += 1
+
+        lines = ['{} threads, written to {}'.format(sum(sites.values()), path)]
+        for (name, site), count in sites.most_common(self.top):
+            lines.append('  {}x {}: {}'.format(count, name, site))
+        if len(sites) > self.top:
+            lines.append('  ... and {} more'.format(len(sites) - self.top))
+        return '\n'.join(lines)
@@ -0,0 +1,291 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+from matrix_client.room import Room as MatrixRoom
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens refill at `rate` per second, up to `burst`. A server-requested backoff
+     (e.g. a 429 response's retry_after_ms) empties the bucket and blocks all callers
+     until it has passed.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.blocked_until:
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = self.blocked_until - now
+            time.sleep(delay)
+
+    def hold(self, seconds: float):
+        """
+        Empty the bucket and refuse tokens for the given number of seconds.
+
+        :param seconds: How long to back off for.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0.0
+            self.last_refill = self.blocked_until
+
+
+def retry_after(error: MatrixRequestError, default: float=5.0) -> float:
+    """
+    :param error: Error returned by the homeserver with code 429
+    :param default: Delay to use if the server didn't specify one
+    :return: Number of seconds the homeserver asked us to wait.
+    """
+    try:
+        return json.loads(error.content)['retry_after_ms'] / 1000
+    except (ValueError, KeyError, TypeError):
+        return default
+
+
+class ProvisionJob:
+    topic = None        # type: str
+    name = None         # type: str or None
+    priority = 0        # type: int
+    room = None         # type: MatrixRoom or None
+    started = False     # type: bool
+
+    def __init__(self, topic: str, name: str or None, priority: int):
+        self.topic = topic
+        self.name = name
+        self.priority = priority
+        self.done = threading.Event()
+
+
+class RoomProvisioner:
+    """
+    Creates Matrix rooms on a bounded pool of worker threads, rate-limited by a token bucket.
+
+    Each room is created with a single createRoom request which sets its name and topic
+     and invites the requested users. Rooms that someone is waiting for (e.g. because a
+     message arrived for their JID) are created first.
+    """
+    matrix = None               # type: MatrixClient
+    users_to_invite = None      # type: List[str]
+    jobs = None                 # type: Dict[str, ProvisionJob]
+    on_created = None           # type: Callable[[str, MatrixRoom], None]
+    report = None               # type: Callable[[str], None]
+    wait_timeout = None         # type: float
+
+    def __init__(self,
+                 matrix: MatrixClient,
+                 users_to_invite: List[str],
+                 on_created: Callable[[str, MatrixRoom], None],
+                 report: Callable[[str], None]=None,
+                 concurrency: int=2,
+                 rate: float=1.0,
+                 burst: int=5,
+                 progress_interval: int=25,
+                 wait_timeout: float=60.0):
+        """
+        :param matrix: Client to create rooms with
+        :param users_to_invite: Users to invite to every created room
+        :param on_created: Called with (topic, room) once a room has been created,
+            before anyone waiting on it is woken up.
+        :param report: Called with human-readable progress messages.
+        :param concurrency: Number of rooms which may be created at once.
+        :param rate: Sustained number of room creations per second.
+        :param burst: Number of room creations allowed back-to-back.
+        :param progress_interval: Report progress every time this many rooms are done.
+        :param wait_timeout: Default number of seconds wait_for waits for a room.
+        """
+        self.matrix = matrix
+        self.users_to_invite = users_to_invite
+        self.on_created = on_created
+        self.report = report
+        self.progress_interval = progress_interval
+        self.wait_timeout = wait_timeout
+        self.bucket = TokenBucket(rate, burst)
+
+        self.jobs = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.batch_total = 0
+        self.batch_done = 0
+        self.batch_failed = 0
+        self.batch_start = None
+
+        self.workers = []
+        for i in range(concurrency):
+            worker = threading.Thread(target=self._work, name='mxpp-provision-{}'.format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def create_room(self, topic: str, name: str=None) -> MatrixRoom:
+        """
+        Create a room right away (subject to the rate limit), retrying when rate-limited.
+
+        :param topic: Topic for the new room
+        :param name: (Optional) Name for the new room
+        :return: The new room
+        """
+        content = {
+            'topic': topic,
+            'invite': list(self.users_to_invite),
+            'initial_state': [],
+        }
+        if name is not None:
+            content['name'] = name
+
+        while True:
+            self.bucket.acquire()
+            try:
+                response = self.matrix.api._send('POST', '/createRoom', content)
+                break
+            except MatrixRequestError as e:
+                if e.code != 429:
+                    raise
+                delay = retry_after(e)
+                logger.warning('Rate limited while creating room {}, retrying in {}s'.format(topic, delay))
+                self.bucket.hold(delay)
+
+        room = self.matrix._mkroom(response['room_id'])
+        room.topic = topic
+        room.name = name
+        return room
+
+    def request(self, topic: str, name: str=None, priority: int=0) -> ProvisionJob:
+        """
+        Queue a room to be created. If the room is already queued, its priority is raised instead.
+
+        :param topic: Topic for the new room
+        :param name: (Optional) Name for the new room
+        :param priority: Rooms with higher priority are created first.
+        :return: Job which will be marked done once the room exists (or creation failed).
+        """
+        with self.condition:
+            job = self.jobs.get(topic)
+            if job is not None:
+                self._bump(job, priority)
+                return job
+
+            job = ProvisionJob(topic, name, priority)
+            self.jobs[topic] = job
+            heapq.heappush(self.heap, (-priority, next(self.counter), job))
+
+            if self.batch_start is None:
+                self.batch_start = time.monotonic()
+            self.batch_total += 1
+            self.condition.notify()
+            return job
+
+    def is_pending(self, topic: str) -> bool:
+        with self.condition:
+            return topic in self.jobs
+
+    def wait_for(self, topic: str, timeout: float=None) -> MatrixRoom or None:
+        """
+        Move a queued room to the front of the queue and wait for it to be created.
+
+        :param topic: Topic of the queued room
+        :param timeout: Maximum number of seconds to wait
+        :return: The created room, or None if it isn't queued, creation failed, or we timed out.
+        """
+        with self.condition:
+            job = self.jobs.get(topic)
+            if job is None:
+                return None
+            self._bump(job, job.priority + 1000)
+        job.done.wait(timeout)
+        return job.room
+
+    def pending_count(self) -> int:
+        with self.condition:
+            return len(self.jobs)
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def _bump(self, job: ProvisionJob, priority: int):
+        # Must be called with self.condition held. Stale heap entries are skipped by the workers.
+        if priority > job.priority:
+            job.priority = priority
+            heapq.heappush(self.heap, (-priority, next(self.counter), job))
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.running and not self.heap:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                neg_priority, _, job = heapq.heappop(self.heap)
+                if job.started or -neg_priority != job.priority:
+                    continue
+                job.started = True
+
+            try:
+                room = self.create_room(job.topic, job.name)
+                self.on_created(job.topic, room)
+                job.room = room
+                logger.info('Provisioned room with topic {} and id {}'.format(job.topic, room.room_id))
+            except Exception:
+                logger.exception('Failed to provision room with topic {}'.format(job.topic))
+
+            with self.condition:
+                del self.jobs[job.topic]
+                self.batch_done += 1
+                if job.room is None:
+                    self.batch_failed += 1
+                message = self._progress_message()
+            job.done.set()
+
+            if message is not None and self.report is not None:
+                try:
+                    self.report(message)
+                except Exception:
+                    logger.exception('Failed to report provisioning progress')
+
+    def _progress_message(self) -> str or None:
+        # Must be called with self.condition held.
+        if not self.jobs:
+            message = 'Created {} of {} rooms in {:.0f}s ({} failed)'.format(
+                self.batch_done - self.batch_failed, self.batch_total,
+                time.monotonic() - self.batch_start, self.batch_failed)
+            self.batch_total = self.batch_done = self.batch_failed = 0
+            self.batch_start = None
+            return message
+
+        if self.batch_done % self.progress_interval == 0:
+            return 'Creating rooms: {} of {} done ({} failed)'.format(
+                self.batch_done, self.batch_total, self.batch_failed)
+        return None
@@ -0,0 +1,154 @@
+"""
+Opt-in recording of the traffic reaching the bridge, for replaying offline (see mxpp.bench.replay).
+
+The recording is a file of JSON lines. The first line is a header, {"v": 1, "start": epoch
+ seconds, "anon": true or false}, and each following line is one event:
+    t       Seconds since the recording started
+    s       Source: 'x' for XMPP, 'm' for Matrix
+    e       Event: 'message', 'presence' or 'roster' (XMPP), or the Matrix event type
+    y       XMPP message, presence or iq type
+    f       Sender's bare JID (for XMPP), or the JID of the room's contact or MUC (for Matrix)
+    k       Kind of Matrix room (see mxpp.rooms), or the topic of a special room
+    nick    Sender's nickname, for MUC messages
+    o       1 if the bridge sent the event itself (the bridge's own nickname in a MUC, or one of
+            the bridge's Matrix users)
+    n       Payload size in bytes (message body)
+    i       Items of a roster push, [[jid, subscription], ...]; or
+    c       Number of items in a full roster
+
+Message bodies are never recorded. When anonymising, JIDs and nicknames are replaced by keyed
+ hashes, which are consistent within a recording (and across recordings made with the same salt)
+ but can't be turned back into the JIDs.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+RECORDING_VERSION = 1
+
+# XMPP events recorded. Group chat messages are also 'message' events, so 'groupchat_message'
+#  isn't recorded separately.
+XMPP_EVENTS = ('message', 'presence_available', 'presence_unavailable', 'roster_update')
+
+
+class TrafficRecorder:
+    """
+    Writes events to a recording file. Safe to call from any thread; lines are buffered and
+     flushed every `flush_interval` seconds and on close.
+    """
+    def __init__(self,
+                 path: str,
+                 anonymise: bool=True,
+                 salt: str=None,
+                 own_nick: str=None,
+                 flush_interval: float=1.0):
+        """
+        :param path: File to append the recording to
+        :param anonymise: Replace JIDs and nicknames with hashes
+        :param salt: Key for the hashes, or None for a random one (so recordings can't be
+            correlated with each other)
+        :param own_nick: The bridge's nickname in group chats
+        :param flush_interval: Seconds between flushes to disk
+        """
+        self.path = path
+        self.anonymise = anonymise
+        self.salt = salt.encode('utf-8') if salt is not None else os.urandom(16)
+        self.own_nick = own_nick
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pseudonyms = {}    # type: Dict[str, str]
+        self.recorded = 0
+
+        self.file = open(path, 'a', encoding='utf-8')
+        self.start = time.monotonic()
+        self.last_flush = self.start
+        self.write({'v': RECORDING_VERSION, 'start': time.time(), 'anon': anonymise})
+        logger.info('Recording traffic to {}'.format(path))
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    def write(self, record: Dict):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line)
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+
+    def pseudonym(self, text: str) -> str:
+        """
+        :return: `text` itself, or its hash if anonymising
+        """
+        if not self.anonymise or not text:
+            return text
+        pseudonym = self.pseudonyms.get(text)
+        if pseudonym is None:
+            pseudonym = hmac.new(self.salt, text.encode('utf-8'), hashlib.sha1).hexdigest()[:12]
+            self.pseudonyms[text] = pseudonym
+        return pseudonym
+
+    def event(self, source: str, event: str, **fields):
+        record = {'t': round(time.monotonic() - self.start, 4), 's': source, 'e': event}
+        record.update((k, v) for k, v in fields.items() if v is not None)
+        self.write(record)
+        self.recorded += 1
+
+    def record_xmpp(self, name: str, stanza):
+        """
+        Record an XMPP event; usable as an event handler, with `name` bound to the event's name.
+
+        :param name: One of XMPP_EVENTS
+        :param stanza: The event's stanza
+        """
+        if name == 'message':
+            mtype = stanza['type']
+            fields = {'y': mtype,
+                      'f': self.pseudonym(stanza['from'].bare),
+                      'n': len((stanza['body'] or '').encode('utf-8'))}
+            if mtype == 'groupchat':
+                nick = stanza['from'].resource
+                if nick and nick == self.own_nick:
+                    fields['o'] = 1
+                else:
+                    fields['nick'] = self.pseudonym(nick)
+            self.event('x', 'message', **fields)
+
+        elif name in ('presence_available', 'presence_unavailable'):
+            self.event('x', 'presence', y=name[len('presence_'):], f=self.pseudonym(stanza['from'].bare))
+
+        elif name == 'roster_update':
+            items = stanza['roster']['items']
+            if stanza['type'] == 'set':
+                self.event('x', 'roster', y='set',
+                           i=[[self.pseudonym(str(jid)), item.get('subscription')] for jid, item in items.items()])
+            else:
+                self.event('x', 'roster', y=stanza['type'], c=len(items))
+
+    def record_matrix(self, event: Dict, kind: str or None, jid: str or None, own: bool):
+        """
+        Record a Matrix room event.
+
+        :param event: The event, as passed to global listeners
+        :param kind: Kind of the room, the topic of a special room, or None for an unknown room
+        :param jid: JID of the room's contact or MUC, if any
+        :param own: True if the bridge sent the event itself
+        """
+        body = event.get('content', {}).get('body')
+        self.event('m', event.get('type'),
+                   k=kind,
+                   f=self.pseudonym(jid),
+                   o=1 if own else None,
+                   n=len(body.encode('utf-8')) if isinstance(body, str) else None)
@@ -0,0 +1,132 @@
+import logging
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Kinds of room
+DIRECT_ROOM = 'direct'          # Chat with a single XMPP contact; the topic is the contact's bare JID
+GROUPCHAT_ROOM = 'groupchat'    # Group chat (MUC); the topic is the groupchat flag followed by the MUC's JID
+SPECIAL_ROOM = 'special'        # Control room, all-chat room, ...; the topic is the special room's name
+
+RoomEntry = NamedTuple('RoomEntry', [('topic', str),
+                                     ('room_id', str),
+                                     ('kind', str),
+                                     ('jid', str)])
+
+
+class RoomRegistry:
+    """
+    Every room the bot manages, indexed by topic, room ID and (kind, JID).
+
+    A room's kind and JID are worked out from its topic once, when it is added, so looking a
+     room up in either direction never parses topics or scans a list.
+    """
+    by_topic_index = None       # type: Dict[str, RoomEntry]
+    by_room_id_index = None     # type: Dict[str, RoomEntry]
+    by_jid_index = None         # type: Dict[Tuple[str, str], RoomEntry]
+
+    def __init__(self, groupchat_flag: str, special_topics: Iterable[str]):
+        """
+        :param groupchat_flag: Prefix of the topics of group chat rooms
+        :param special_topics: Topics of the special rooms (e.g. 'control')
+        """
+        self.groupchat_flag = groupchat_flag
+        self.special_topics = frozenset(special_topics)
+        self.lock = threading.Lock()
+        self.by_topic_index = {}
+        self.by_room_id_index = {}
+        self.by_jid_index = {}
+
+    def parse(self, topic: str) -> Tuple[str, str or None]:
+        """
+        :param topic: Room topic
+        :return: (kind, JID) of a room with that topic; the JID is None for special rooms.
+        """
+        if topic in self.special_topics:
+            return SPECIAL_ROOM, None
+        if topic.startswith(self.groupchat_flag):
+            return GROUPCHAT_ROOM, topic[len(self.groupchat_flag):]
+        return DIRECT_ROOM, topic
+
+    def topic(self, jid: str, kind: str=DIRECT_ROOM) -> str:
+        """
+        :return: Topic of the room for a JID (the inverse of parse)
+        """
+        if kind == GROUPCHAT_ROOM:
+            return self.groupchat_flag + jid
+        return jid
+
+    def add(self, topic: str, room_id: str) -> RoomEntry:
+        """
+        Register a room, replacing any room which had the same topic (and any other topic the
+         room had).
+
+        :param topic: Topic of the room
+        :param room_id: ID of the room
+        :return: The room's entry
+        """
+        kind, jid = self.parse(topic)
+        entry = RoomEntry(topic, room_id, kind, jid)
+        with self.lock:
+            self._remove(self.by_topic_index.get(topic))
+            self._remove(self.by_room_id_index.get(room_id))
+            self.by_topic_index[topic] = entry
+            self.by_room_id_index[room_id] = entry
+            if jid is not None:
+                self.by_jid_index[(kind, jid)] = entry
+        return entry
+
+    def remove(self, topic: str) -> RoomEntry or None:
+        """
+        :param topic: Topic of the room to forget
+        :return: The room's entry, or None if no room had that topic.
+        """
+        with self.lock:
+            entry = self.by_topic_index.get(topic)
+            self._remove(entry)
+        return entry
+
+    def _remove(self, entry: RoomEntry or None):
+        if entry is None:
+            return
+        del self.by_topic_index[entry.topic]
+        del self.by_room_id_index[entry.room_id]
+        if entry.jid is not None:
+            del self.by_jid_index[(entry.kind, entry.jid)]
+
+    def by_topic(self, topic: str) -> RoomEntry or None:
+        with self.lock:
+            return self.by_topic_index.get(topic)
+
+    def by_room_id(self, room_id: str) -> RoomEntry or None:
+        with self.lock:
+            return self.by_room_id_index.get(room_id)
+
+    def by_jid(self, jid: str, kind: str=DIRECT_ROOM) -> RoomEntry or None:
+        with self.lock:
+            return self.by_jid_index.get((kind, jid))
+
+    def entries(self, kind: str=None) -> List[RoomEntry]:
+        """
+        :param kind: Kind of room to list, or None for every room
+        :return: Entries of the registered rooms
+        """
+        with self.lock:
+            return [entry for entry in self.by_topic_index.values() if kind is None or entry.kind == kind]
+
+    def jids(self, kind: str=DIRECT_ROOM) -> List[str]:
+        """
+        :return: JIDs of the registered rooms of a kind
+        """
+        return [entry.jid for entry in self.entries(kind)]
+
+    def room_ids(self) -> Set[str]:
+        with self.lock:
+            return set(self.by_room_id_index.keys())
+
+    def count(self, kind: str=None) -> int:
+        with self.lock:
+            if kind is None:
+                return len(self.by_topic_index)
+            return sum(1 for entry in self.by_topic_index.values() if entry.kind == kind)
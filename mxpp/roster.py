@@ -0,0 +1,69 @@
+import logging
+from typing import Dict, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+RosterItem = NamedTuple('RosterItem', [('name', str), ('subscription', str)])
+
+# Changes to the roster carried by one roster result or push.
+#  `changed` holds new and modified items, `removed` the JIDs which have left the roster,
+#  `version` the roster version after the change (XEP-0237) or None if the server didn't send one,
+#  and `full` whether the stanza was a complete roster rather than a push.
+RosterDiff = NamedTuple('RosterDiff', [('changed', Dict[str, RosterItem]),
+                                       ('removed', List[str]),
+                                       ('version', str),
+                                       ('full', bool)])
+
+
+def diff_roster(known: Dict[str, RosterItem], iq, known_version: str=None) -> RosterDiff:
+    """
+    Work out what a roster stanza changes, relative to the roster we already have.
+
+    A roster result is a complete roster, so anything missing from it has been removed;
+     the exception is an empty result when we asked for changes since `known_version`,
+     which means there are no changes (they arrive as pushes instead).
+    A roster push only lists the items which changed, with subscription 'remove' for removals.
+
+    :param known: Roster we already have, {jid: RosterItem}
+    :param iq: Roster result or push (jabber:iq:roster)
+    :param known_version: Version of `known`, if any
+    :return: The changes
+    """
+    items = {str(jid): item for jid, item in iq['roster']['items'].items()}
+    version = iq['roster']['ver'] or None
+    full = iq['type'] == 'result' and bool(items or version or not known_version)
+
+    changed = {}
+    removed = []
+    for jid, item in items.items():
+        if item['subscription'] == 'remove':
+            if jid in known:
+                removed.append(jid)
+            continue
+        new_item = RosterItem(item['name'], item['subscription'])
+        if known.get(jid) != new_item:
+            changed[jid] = new_item
+
+    if full:
+        removed += [jid for jid in known if jid not in items]
+
+    return RosterDiff(changed, removed, version, full)
+
+
+def preload_roster(client_roster, items: Dict[str, RosterItem], version: str or None):
+    """
+    Fill in an XMPP client's roster from storage, so that its roster requests only ask the
+     server for changes since `version`.
+
+    :param client_roster: The client's roster node (client.client_roster)
+    :param items: Stored roster, {jid: RosterItem}
+    :param version: Stored roster version, or None to ask for the whole roster
+    """
+    for jid, item in items.items():
+        client_roster.add(jid,
+                          name=item.name,
+                          afrom=item.subscription in ('from', 'both'),
+                          ato=item.subscription in ('to', 'both'))
+    client_roster.version = version or ''
+    if items:
+        logger.debug('Loaded {} stored roster items (version {})'.format(len(items), version))
@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+from mxpp.spill import SpillBuffer
+
+# Classes of inbound XMPP events, most urgent first
+CHAT = 0
+GROUPCHAT = 1
+PRESENCE = 2
+ROSTER = 3
+CLASS_NAMES = ('chat', 'groupchat', 'presence', 'roster')
+
+
+class ClassScheduler:
+    """
+    Decides which class of work to serve next: strictly by priority (lowest class number first),
+     except that a class which has been passed over `max_skips` times in a row is served next,
+     so low-priority work can't be starved.
+
+    Not thread-safe; callers hold their own lock.
+    """
+    def __init__(self, num_classes: int, max_skips: int=16):
+        self.max_skips = max_skips
+        self.skips = [0] * num_classes
+
+    def pick(self, waiting: Sequence[bool]) -> int or None:
+        """
+        :param waiting: For each class, whether it has work waiting
+        :return: The class to serve, or None if there's nothing waiting.
+        """
+        candidates = [cls for cls, has_work in enumerate(waiting) if has_work]
+        if not candidates:
+            return None
+
+        starved = [cls for cls in candidates if self.skips[cls] >= self.max_skips]
+        chosen = starved[0] if starved else candidates[0]
+
+        for cls in range(len(self.skips)):
+            if cls == chosen or not waiting[cls]:
+                self.skips[cls] = 0
+            else:
+                self.skips[cls] += 1
+        return chosen
+
+
+QueuedEvent = NamedTuple('QueuedEvent', [('event', object), ('cls', int), ('received', float)])
+
+
+class ClassedBuffer:
+    """
+    Multi-class version of SpillBuffer (and a drop-in replacement for it): one SpillBuffer
+     per class, served by a ClassScheduler. pop() returns QueuedEvents, which record each
+     item's class and when it was pushed (time.time()).
+    """
+    buffers = None      # type: List[SpillBuffer]
+
+    def __init__(self,
+                 path: str,
+                 classify: Callable[[object], int],
+                 serialize: Callable[[object], str],
+                 deserialize: Callable[[str], object],
+                 memory_budget: int=16 * 1024 * 1024,
+                 num_classes: int=len(CLASS_NAMES),
+                 max_skips: int=16):
+        """
+        :param path: Prefix for the spill files; class N spills to `path`.N
+        :param classify: Returns the class of an item
+        :param serialize: See SpillBuffer
+        :param deserialize: See SpillBuffer
+        :param memory_budget: Total memory budget, shared equally between the classes
+        :param num_classes: Number of classes
+        :param max_skips: See ClassScheduler
+        """
+        self.classify = classify
+        self.lock = threading.Lock()
+        self.scheduler = ClassScheduler(num_classes, max_skips)
+        self.high_water_items = 0
+
+        def serialize_timed(timed_item: Tuple[float, object]) -> str:
+            received, item = timed_item
+            return json.dumps([received, serialize(item)])
+
+        def deserialize_timed(data: str) -> Tuple[float, object]:
+            received, item_data = json.loads(data)
+            return received, deserialize(item_data)
+
+        self.buffers = [SpillBuffer('{}.{}'.format(path, cls), serialize_timed, deserialize_timed,
+                                    memory_budget=memory_budget // num_classes)
+                        for cls in range(num_classes)]
+
+    def __len__(self) -> int:
+        return sum(len(buffer) for buffer in self.buffers)
+
+    def push(self, item):
+        if item is None:
+            self.buffers[0].push(None)
+            return
+        self.buffers[self.classify(item)].push((time.time(), item))
+        self.high_water_items = max(self.high_water_items, len(self))
+
+    def pop(self) -> Tuple[bool, QueuedEvent or None]:
+        """
+        :return: (True, QueuedEvent for the next item, or None for a wake-up), or (False, None)
+            if the buffer is empty.
+        """
+        with self.lock:
+            cls = self.scheduler.pick([len(buffer) > 0 for buffer in self.buffers])
+            if cls is None:
+                return False, None
+            found, timed_item = self.buffers[cls].pop()
+
+        if not found or timed_item is None:
+            return found, None
+        received, item = timed_item
+        return True, QueuedEvent(item, cls, received)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: Totals of SpillBuffer.stats() across classes, plus the number of items
+            waiting in each class (e.g. 'waiting_chat').
+        """
+        stats = {}
+        for cls, buffer in enumerate(self.buffers):
+            buffer_stats = buffer.stats()
+            for key, value in buffer_stats.items():
+                stats[key] = stats.get(key, 0) + value
+            stats['waiting_' + CLASS_NAMES[cls]] = buffer_stats['in_memory'] + buffer_stats['on_disk']
+        stats['high_water_items'] = self.high_water_items
+        return stats
+
+    def close(self):
+        for buffer in self.buffers:
+            buffer.close()
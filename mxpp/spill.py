@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SpillBuffer:
+    """
+    Thread-safe FIFO buffer which keeps up to `memory_budget` bytes of items in memory and
+     spills the rest to a file.
+
+    Once anything has been spilled, new items also go to the file until it has been drained,
+     so items always come out in the order they went in. None is always kept in memory
+     (it is used to wake up consumers) and doesn't count towards the budget.
+
+    Items still buffered when the buffer is closed are saved to the file, and are the first
+     items returned the next time a buffer is opened with the same file.
+    """
+    path = None         # type: str
+
+    def __init__(self,
+                 path: str,
+                 serialize: Callable[[object], str],
+                 deserialize: Callable[[str], object],
+                 memory_budget: int=16 * 1024 * 1024):
+        """
+        :param path: File to spill items to. Created if it doesn't exist.
+        :param serialize: Converts an item to a string; its length is also used as the item's size.
+        :param deserialize: Converts a string from `serialize` back to an item.
+        :param memory_budget: Maximum total size (in characters) of the items kept in memory.
+        """
+        self.path = path
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.memory_budget = memory_budget
+
+        self.lock = threading.Lock()
+        self.memory = deque()       # type: deque
+        self.memory_bytes = 0
+        self.on_disk = 0
+
+        self.spilled_total = 0
+        self.high_water_items = 0
+        self.high_water_bytes = 0
+        self.high_water_on_disk = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.writer = open(path, 'a+', encoding='utf-8')
+        self.reader = open(path, 'r', encoding='utf-8')
+        self.on_disk = sum(1 for _line in self.reader)
+        self.reader.seek(0)
+        if self.on_disk:
+            logger.info('Loaded {} queued items from {}'.format(self.on_disk, path))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.memory) + self.on_disk
+
+    def push(self, item):
+        if item is None:
+            with self.lock:
+                self.memory.append((None, 0))
+            return
+
+        data = self.serialize(item)
+        size = len(data)
+        with self.lock:
+            if self.writer.closed:
+                logger.debug('Dropping item pushed after the buffer was closed')
+                return
+            if self.on_disk == 0 and self.memory_bytes + size <= self.memory_budget:
+                self.memory.append((item, size))
+                self.memory_bytes += size
+            else:
+                self.writer.write(json.dumps(data) + '\n')
+                self.writer.flush()
+                self.on_disk += 1
+                self.spilled_total += 1
+                if self.on_disk > self.high_water_on_disk:
+                    self.high_water_on_disk = self.on_disk
+                    if self.on_disk == 1 or self.on_disk % 1000 == 0:
+                        logger.warning('Inbound queue is over its memory budget, {} items spilled to disk'.format(
+                            self.on_disk))
+
+            self.high_water_items = max(self.high_water_items, len(self.memory) + self.on_disk)
+            self.high_water_bytes = max(self.high_water_bytes, self.memory_bytes)
+
+    def pop(self) -> Tuple[bool, object]:
+        """
+        :return: (True, oldest item), or (False, None) if the buffer is empty.
+        """
+        with self.lock:
+            if self.memory:
+                item, size = self.memory.popleft()
+                self.memory_bytes -= size
+                return True, item
+
+            while self.on_disk > 0:
+                line = self.reader.readline()
+                self.on_disk -= 1
+                if self.on_disk == 0:
+                    # Drained; start the file over
+                    self.writer.truncate(0)
+                    self.reader.seek(0)
+                try:
+                    data = json.loads(line)
+                    break
+                except ValueError:
+                    # Torn write from a crash
+                    logger.warning('Skipping damaged item in {}'.format(self.path))
+            else:
+                return False, None
+
+        return True, self.deserialize(data)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'in_memory': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'on_disk': self.on_disk,
+                'spilled_total': self.spilled_total,
+                'high_water_items': self.high_water_items,
+                'high_water_bytes': self.high_water_bytes,
+                'high_water_on_disk': self.high_water_on_disk,
+            }
+
+    def close(self):
+        """
+        Save any remaining items to the file, for the next buffer opened with it.
+        """
+        with self.lock:
+            lines = [json.dumps(self.serialize(item)) + '\n' for item, _size in self.memory if item is not None]
+            lines += self.reader.readlines()
+            self.memory.clear()
+            self.memory_bytes = 0
+            self.on_disk = 0
+            self.reader.close()
+            self.writer.close()
+
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as tmp_file:
+                tmp_file.writelines(lines)
+            os.replace(self.path + '.tmp', self.path)
+        if lines:
+            logger.info('Saved {} queued items to {}'.format(len(lines), self.path))
+
+
+class SpillQueue:
+    """
+    queue.Queue-style blocking queue backed by a SpillBuffer.
+    """
+    buffer = None       # type: SpillBuffer
+
+    def __init__(self, buffer: SpillBuffer):
+        self.buffer = buffer
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        self.buffer.push(item)
+        with self.condition:
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while True:
+                found, item = self.buffer.pop()
+                if found:
+                    return item
+                self.condition.wait()
+
+    def qsize(self) -> int:
+        return len(self.buffer)
+
+    def stats(self) -> Dict[str, int]:
+        return self.buffer.stats()
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,208 @@
+import logging
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+from mxpp.mam import Checkpoint
+from mxpp.roster import RosterItem
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS room_map (
+    topic   TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS groupchats (
+    jid TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS special_rooms (
+    kind    TEXT PRIMARY KEY,
+    room_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS room_names (
+    room_id TEXT PRIMARY KEY,
+    name    TEXT
+);
+CREATE TABLE IF NOT EXISTS roster (
+    jid          TEXT PRIMARY KEY,
+    name         TEXT,
+    subscription TEXT
+);
+CREATE TABLE IF NOT EXISTS muc_history (
+    jid          TEXT PRIMARY KEY,
+    last_bridged REAL,
+    keys         TEXT
+);
+CREATE TABLE IF NOT EXISTS mam_checkpoints (
+    jid        TEXT PRIMARY KEY,
+    stamp      REAL,
+    archive_id TEXT
+);
+CREATE TABLE IF NOT EXISTS virtual_users (
+    jid         TEXT PRIMARY KEY,
+    displayname TEXT
+);
+CREATE TABLE IF NOT EXISTS kv (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class StateStore:
+    """
+    On-disk (SQLite) store for the bot's room bookkeeping.
+
+    Every setter writes through to disk immediately, so the store always reflects the
+     in-memory maps and can be used to skip the per-room topic crawl on restart.
+    """
+    path = None     # type: str
+
+    def __init__(self, path: str):
+        """
+        :param path: Path to the SQLite database file. Created if it doesn't exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+        logger.debug('Opened state store at {}'.format(path))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _execute(self, query: str, args: tuple=()):
+        with self.lock, self.db:
+            self.db.execute(query, args)
+
+    def _fetchall(self, query: str, args: tuple=()) -> List[tuple]:
+        with self.lock:
+            return self.db.execute(query, args).fetchall()
+
+    def get_room_map(self) -> Dict[str, str]:
+        """
+        :return: Stored {topic: room_id} map for mapped (JID and groupchat) rooms.
+        """
+        return dict(self._fetchall('SELECT topic, room_id FROM room_map'))
+
+    def set_room(self, topic: str, room_id: str):
+        self._execute('INSERT OR REPLACE INTO room_map (topic, room_id) VALUES (?, ?)',
+                      (topic, room_id))
+
+    def remove_room(self, topic: str):
+        self._execute('DELETE FROM room_map WHERE topic = ?', (topic,))
+
+    def remove_room_id(self, room_id: str):
+        self._execute('DELETE FROM room_map WHERE room_id = ?', (room_id,))
+        self._execute('DELETE FROM room_names WHERE room_id = ?', (room_id,))
+
+    def get_room_names(self) -> Dict[str, str]:
+        """
+        :return: Stored {room_id: name} map, for restoring room names without a full sync.
+        """
+        return dict(self._fetchall('SELECT room_id, name FROM room_names'))
+
+    def set_room_name(self, room_id: str, name: str or None):
+        self._execute('INSERT OR REPLACE INTO room_names (room_id, name) VALUES (?, ?)', (room_id, name))
+
+    def get_groupchat_jids(self) -> List[str]:
+        return [row[0] for row in self._fetchall('SELECT jid FROM groupchats')]
+
+    def add_groupchat(self, jid: str):
+        self._execute('INSERT OR IGNORE INTO groupchats (jid) VALUES (?)', (jid,))
+
+    def remove_groupchat(self, jid: str):
+        self._execute('DELETE FROM groupchats WHERE jid = ?', (jid,))
+        self._execute('DELETE FROM muc_history WHERE jid = ?', (jid,))
+
+    def get_muc_history(self) -> Dict[str, Tuple[float, List[str]]]:
+        """
+        :return: Stored {MUC jid: (time the last message was bridged, [recent message keys])};
+            see MucHistoryIndex.
+        """
+        return {jid: (last_bridged, keys.split())
+                for jid, last_bridged, keys in self._fetchall('SELECT jid, last_bridged, keys FROM muc_history')}
+
+    def set_muc_history(self, jid: str, last_bridged: float, keys: List[str]):
+        self._execute('INSERT OR REPLACE INTO muc_history (jid, last_bridged, keys) VALUES (?, ?, ?)',
+                      (jid, last_bridged, ' '.join(keys)))
+
+    def get_special_rooms(self) -> Dict[str, str]:
+        """
+        :return: Stored {special room kind (e.g. 'control'): room_id} map.
+        """
+        return dict(self._fetchall('SELECT kind, room_id FROM special_rooms'))
+
+    def set_special_room(self, kind: str, room_id: str):
+        self._execute('INSERT OR REPLACE INTO special_rooms (kind, room_id) VALUES (?, ?)',
+                      (kind, room_id))
+
+    def get_roster(self) -> Dict[str, RosterItem]:
+        """
+        :return: Stored XMPP roster, {jid: RosterItem}; see roster_version.
+        """
+        return {jid: RosterItem(name, subscription)
+                for jid, name, subscription in self._fetchall('SELECT jid, name, subscription FROM roster')}
+
+    def update_roster(self, changed: Dict[str, RosterItem], removed: List[str], version: str or None):
+        """
+        Apply changes to the stored roster, together with its new version, in one transaction.
+
+        :param changed: New and modified items
+        :param removed: JIDs which have left the roster
+        :param version: New roster version, or None if the server didn't send one
+        """
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO roster (jid, name, subscription) VALUES (?, ?, ?)',
+                                [(jid, item.name, item.subscription) for jid, item in changed.items()])
+            self.db.executemany('DELETE FROM roster WHERE jid = ?', [(jid,) for jid in removed])
+            self.db.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', ('roster_version', version))
+
+    def get_checkpoints(self) -> Dict[str, Checkpoint]:
+        """
+        :return: Stored {jid: Checkpoint} map of how far each conversation has been bridged,
+            for catching up from the message archive.
+        """
+        return {jid: Checkpoint(stamp, archive_id)
+                for jid, stamp, archive_id in self._fetchall('SELECT jid, stamp, archive_id FROM mam_checkpoints')}
+
+    def set_checkpoint(self, jid: str, checkpoint: Checkpoint):
+        self._execute('INSERT OR REPLACE INTO mam_checkpoints (jid, stamp, archive_id) VALUES (?, ?, ?)',
+                      (jid, checkpoint.stamp, checkpoint.archive_id))
+
+    def remove_checkpoint(self, jid: str):
+        self._execute('DELETE FROM mam_checkpoints WHERE jid = ?', (jid,))
+
+    def get_virtual_users(self) -> Dict[str, str]:
+        """
+        :return: {jid: display name} of the application service users registered so far
+        """
+        return dict(self._fetchall('SELECT jid, displayname FROM virtual_users'))
+
+    def set_virtual_user(self, jid: str, displayname: str):
+        self._execute('INSERT OR REPLACE INTO virtual_users (jid, displayname) VALUES (?, ?)', (jid, displayname))
+
+    def get_value(self, key: str, default: str=None) -> str or None:
+        rows = self._fetchall('SELECT value FROM kv WHERE key = ?', (key,))
+        if not rows:
+            return default
+        return rows[0][0]
+
+    def set_value(self, key: str, value: str or None):
+        self._execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def sync_token(self) -> str or None:
+        return self.get_value('sync_token')
+
+    @sync_token.setter
+    def sync_token(self, token: str or None):
+        self.set_value('sync_token', token)
+
+    @property
+    def roster_version(self) -> str or None:
+        return self.get_value('roster_version')
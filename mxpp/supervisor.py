@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff:
+    """
+    Exponential backoff which starts over once things have been stable for `reset_after` seconds.
+    """
+    def __init__(self, initial: float=1.0, maximum: float=300.0, factor: float=2.0, reset_after: float=120.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.reset_after = reset_after
+        self.delay = initial
+        self.last_failure = None    # type: float or None
+
+    def next(self) -> float:
+        """
+        Record a failure.
+
+        :return: Number of seconds to wait before trying again.
+        """
+        now = time.monotonic()
+        if self.last_failure is not None and now - self.last_failure > self.reset_after:
+            self.reset()
+        self.last_failure = now
+
+        delay = self.delay
+        self.delay = min(self.maximum, self.delay * self.factor)
+        return delay
+
+    def reset(self):
+        self.delay = self.initial
+
+
+class ComponentSupervisor:
+    """
+    Restarts a single component (e.g. the Matrix listener) after it fails, waiting longer
+     after each consecutive failure. Failures reported while a restart is pending are merged
+     into that restart.
+    """
+    name = None         # type: str
+    restart = None      # type: Callable[[Exception], None]
+
+    def __init__(self, name: str, restart: Callable[[Exception], None], backoff: Backoff=None):
+        """
+        :param name: Name of the component, for logging
+        :param restart: Called (on a separate thread) with the failure, to restart the component.
+            If it raises, the restart is retried after another backoff.
+        :param backoff: Backoff policy; defaults to Backoff()
+        """
+        self.name = name
+        self.restart = restart
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.lock = threading.Lock()
+        self.restarting = False
+        self.stopped = threading.Event()
+        self.restarts = 0
+
+    def failed(self, error: Exception):
+        """
+        Report that the component has failed, scheduling a restart unless one is already pending.
+
+        :param error: The failure
+        """
+        with self.lock:
+            if self.restarting or self.stopped.is_set():
+                return
+            self.restarting = True
+
+        thread = threading.Thread(target=self._restart, args=(error,),
+                                  name='mxpp-restart-{}'.format(self.name), daemon=True)
+        thread.start()
+
+    def stop(self):
+        """
+        Stop restarting the component (e.g. because the bot is shutting down).
+        """
+        self.stopped.set()
+
+    def _restart(self, error: Exception):
+        try:
+            while True:
+                delay = self.backoff.next()
+                logger.warning('{} failed ({}), restarting in {:.0f}s'.format(self.name, error, delay))
+                if self.stopped.wait(delay):
+                    return
+                try:
+                    self.restart(error)
+                    self.restarts += 1
+                    logger.info('{} restarted'.format(self.name))
+                    return
+                except Exception as e:
+                    error = e
+        finally:
+            with self.lock:
+                self.restarting = False
@@ -0,0 +1,92 @@
+import http.client
+import json
+import unittest
+
+from mxpp.appservice import TransactionServer, escape_localpart, unescape_localpart
+
+
+class LocalpartTest(unittest.TestCase):
+    def test_round_trip(self):
+        for jid in ('alice@example.com', 'Bob_Smith@Example.com', 'zoë/résumé@example.com', '=_='):
+            escaped = escape_localpart(jid)
+            self.assertRegex(escaped, r'^[a-z0-9._=/-]*$')
+            self.assertEqual(unescape_localpart(escaped), jid)
+        self.assertEqual(escape_localpart('A_b@c'), '_a__b=40c')
+
+    def test_invalid(self):
+        for localpart in ('=4', '=zz', 'a_', '=ff'):
+            self.assertIsNone(unescape_localpart(localpart), localpart)
+
+
+class TransactionServerTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.errors = []
+        self.fail_next = False
+        self.server = TransactionServer(self.handle_events, 'hs-secret',
+                                        query_user=lambda user_id: user_id == '@xmpp_a:example.com',
+                                        exception_handler=self.errors.append, port=0)
+        self.server.start()
+        self.addCleanup(self.server.shutdown)
+
+    def handle_events(self, events):
+        if self.fail_next:
+            self.fail_next = False
+            raise RuntimeError('boom')
+        self.batches.append(events)
+
+    def request(self, method: str, path: str, body: dict=None, token: str or None='hs-secret'):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        self.addCleanup(connection.close)
+        headers = {'Content-Type': 'application/json'}
+        if token is not None:
+            headers['Authorization'] = 'Bearer ' + token
+        connection.request(method, path, json.dumps(body or {}), headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+
+    def put_transaction(self, txn_id: str, events, **kwargs):
+        return self.request('PUT', '/_matrix/app/v1/transactions/' + txn_id, {'events': events}, **kwargs)
+
+    def test_transactions_are_handled_once(self):
+        self.assertEqual(self.put_transaction('t1', [{'type': 'a'}, {'type': 'b'}])[0], 200)
+        self.assertEqual(self.put_transaction('t1', [{'type': 'a'}, {'type': 'b'}])[0], 200)
+        self.assertEqual(self.put_transaction('t2', [{'type': 'c'}])[0], 200)
+        self.assertEqual(self.batches, [[{'type': 'a'}, {'type': 'b'}], [{'type': 'c'}]])
+        self.assertEqual((self.server.transactions, self.server.events, self.server.duplicates), (2, 3, 1))
+
+    def test_failed_transaction_is_handled_when_retried(self):
+        self.fail_next = True
+        self.assertEqual(self.put_transaction('t1', [{'type': 'a'}])[0], 500)
+        self.assertEqual([type(e) for e in self.errors], [RuntimeError])
+        self.assertEqual(self.put_transaction('t1', [{'type': 'a'}])[0], 200)
+        self.assertEqual(self.batches, [[{'type': 'a'}]])
+
+    def test_remembered_transactions_are_bounded(self):
+        self.server.remember = 1
+        self.put_transaction('t1', [])
+        self.put_transaction('t2', [])
+        self.put_transaction('t1', [])
+        self.assertEqual(len(self.batches), 3)
+
+    def test_bad_token_is_forbidden(self):
+        status, content = self.put_transaction('t1', [{'type': 'a'}], token='wrong')
+        self.assertEqual((status, content['errcode']), (403, 'M_FORBIDDEN'))
+        status, content = self.put_transaction('t1', [{'type': 'a'}], token=None)
+        self.assertEqual((status, content['errcode']), (401, 'M_UNAUTHORIZED'))
+        self.assertEqual(self.batches, [])
+
+    def test_token_in_query(self):
+        status, _content = self.request('PUT', '/_matrix/app/v1/transactions/t1?access_token=hs-secret',
+                                        {'events': []}, token=None)
+        self.assertEqual(status, 200)
+
+    def test_user_query_and_ping(self):
+        self.assertEqual(self.request('GET', '/_matrix/app/v1/users/%40xmpp_a%3Aexample.com')[0], 200)
+        self.assertEqual(self.request('GET', '/_matrix/app/v1/users/%40xmpp_b%3Aexample.com')[0], 404)
+        self.assertEqual(self.request('GET', '/_matrix/app/v1/rooms/%23alias%3Aexample.com')[0], 404)
+        self.assertEqual(self.request('POST', '/_matrix/app/v1/ping')[0], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import threading
+import unittest
+
+from mxpp.batch import RoomBatcher
+
+ROOM = object()
+
+
+class RoomBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.done = []
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.batcher.shutdown()
+
+    def create(self, **kwargs) -> RoomBatcher:
+        self.batcher = RoomBatcher(lambda: ROOM, self.send_event, **kwargs)
+        return self.batcher
+
+    def send_event(self, room, content, on_done):
+        self.assertIs(room, ROOM)
+        self.sent.append(content)
+        on_done()
+        self.event.set()
+
+    def test_single_line_is_sent_as_is(self):
+        batcher = self.create(max_delay=3600)
+        batcher.add('hello', notice=True, on_done=lambda: self.done.append(1))
+        batcher.flush()
+        self.assertEqual(self.sent, [{'msgtype': 'm.notice', 'body': 'hello'}])
+        self.assertEqual(self.done, [1])
+
+    def test_lines_are_sent_as_one_list(self):
+        batcher = self.create(max_delay=3600)
+        batcher.add('a <b>', on_done=lambda: self.done.append('a'))
+        batcher.add('two\nlines', notice=True)
+        batcher.add('c', on_done=lambda: self.done.append('c'))
+        self.assertEqual(self.sent, [])
+        batcher.flush()
+        self.assertEqual(self.sent, [{
+            'msgtype': 'm.text',
+            'body': 'a <b>\ntwo\nlines\nc',
+            'format': 'org.matrix.custom.html',
+            'formatted_body': '<ul><li>a &lt;b&gt;</li><li><em>two<br/>lines</em></li><li>c</li></ul>',
+        }])
+        self.assertEqual(self.done, ['a', 'c'])
+
+    def test_all_notices_stay_a_notice(self):
+        batcher = self.create(max_delay=3600)
+        batcher.add('a', notice=True)
+        batcher.add('b', notice=True)
+        batcher.flush()
+        self.assertEqual(self.sent[0]['msgtype'], 'm.notice')
+
+    def test_sent_after_delay(self):
+        batcher = self.create(max_delay=0.05)
+        batcher.add('a')
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(self.sent, [{'msgtype': 'm.text', 'body': 'a'}])
+
+    def test_sent_when_full(self):
+        batcher = self.create(max_delay=3600, max_lines=2)
+        batcher.add('a')
+        batcher.add('b')
+        batcher.add('c')
+        self.assertEqual([content['body'] for content in self.sent], ['a\nb'])
+
+    def test_sent_when_too_large(self):
+        batcher = self.create(max_delay=3600, max_bytes=4)
+        batcher.add('ab')
+        batcher.add('cd')
+        self.assertEqual([content['body'] for content in self.sent], ['ab\ncd'])
+
+    def test_empty_flush_sends_nothing(self):
+        self.create().flush()
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from matrix_client.errors import MatrixRequestError
+
+from mxpp.client_matrix import ClientMatrix
+
+
+class FakeApi:
+    """
+    Stand-in for MatrixHttpApi, answering logins, filter uploads and syncs
+    """
+    def __init__(self, sync_error: MatrixRequestError=None):
+        self.token = None
+        self.sync_error = sync_error
+        self.syncs = []
+        self.filters = []
+
+    def login(self, login_type: str, **kwargs):
+        return {'user_id': '@bot:example.com', 'access_token': 'token', 'home_server': 'example.com'}
+
+    def _send(self, method: str, path: str, content: dict=None):
+        assert (method, path) == ('POST', '/user/%40bot%3Aexample.com/filter')
+        self.filters.append(content)
+        return {'filter_id': 'f1'}
+
+    def sync(self, since: str, timeout_ms: int, filter: str=None):
+        self.syncs.append((since, filter))
+        if since is not None and self.sync_error is not None:
+            raise self.sync_error
+        rooms = {}
+        if since is None:
+            rooms['join'] = {'!new:example.com': {'timeline': {'prev_batch': 'p', 'events': []}}}
+        return {'next_batch': 'next-{}'.format(len(self.syncs)), 'rooms': rooms}
+
+
+class LoginAndSyncTest(unittest.TestCase):
+    def create(self, api: FakeApi) -> ClientMatrix:
+        self.tokens = []
+        client = ClientMatrix('https://matrix.example.com', sync_callback=self.tokens.append)
+        client.api = api
+        return client
+
+    def test_resumes_from_stored_token(self):
+        api = FakeApi()
+        client = self.create(api)
+        client.login_and_sync('bot', 'password', sync_filter={'room': {}}, since='stored',
+                              known_rooms=['!a:example.com', '!b:example.com'])
+        self.assertEqual(api.syncs, [('stored', 'f1')])
+        self.assertEqual(api.filters, [{'room': {}}])
+        self.assertEqual(set(client.rooms), {'!a:example.com', '!b:example.com'})
+        self.assertEqual(self.tokens, ['next-1'])
+        self.assertEqual(api.token, 'token')
+
+    def test_initial_sync_without_token(self):
+        api = FakeApi()
+        client = self.create(api)
+        client.login_and_sync('bot', 'password', since=None, known_rooms=['!a:example.com'])
+        self.assertEqual(api.syncs[0][0], None)
+        self.assertEqual(set(client.rooms), {'!new:example.com'})
+
+    def test_initial_sync_without_known_rooms(self):
+        api = FakeApi()
+        client = self.create(api)
+        client.login_and_sync('bot', 'password', since='stored')
+        self.assertEqual([since for since, _filter in api.syncs], [None])
+
+    def test_falls_back_when_token_is_rejected(self):
+        api = FakeApi(sync_error=MatrixRequestError(400, 'bad token'))
+        client = self.create(api)
+        client.login_and_sync('bot', 'password', since='stale', known_rooms=['!a:example.com'])
+        self.assertEqual([since for since, _filter in api.syncs], ['stale', None])
+        self.assertEqual(set(client.rooms), {'!new:example.com'})
+        self.assertEqual(self.tokens, ['next-2'])
+
+    def test_server_errors_are_raised(self):
+        api = FakeApi(sync_error=MatrixRequestError(502, 'bad gateway'))
+        client = self.create(api)
+        with self.assertRaises(MatrixRequestError):
+            client.login_and_sync('bot', 'password', since='stored', known_rooms=['!a:example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+
+from mxpp.dispatch import KeyedDispatcher
+
+
+class KeyedDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatchers = []
+
+    def tearDown(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.shutdown()
+
+    def create(self, *args, **kwargs) -> KeyedDispatcher:
+        dispatcher = KeyedDispatcher(*args, **kwargs)
+        self.dispatchers.append(dispatcher)
+        return dispatcher
+
+    def wait_idle(self, dispatcher: KeyedDispatcher):
+        deadline = time.monotonic() + 5
+        while dispatcher.total_depth() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(dispatcher.total_depth(), 0)
+
+    def test_same_key_in_order_and_never_concurrent(self):
+        dispatcher = self.create(4)
+        seen = []
+        running = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def work(key, i):
+            with lock:
+                if key in running:
+                    overlaps.append(key)
+                running.add(key)
+            time.sleep(0.001)
+            with lock:
+                running.discard(key)
+                seen.append((key, i))
+
+        for i in range(20):
+            for key in 'abc':
+                dispatcher.submit(key, work, key, i)
+        self.wait_idle(dispatcher)
+
+        self.assertEqual(overlaps, [])
+        for key in 'abc':
+            self.assertEqual([i for k, i in seen if k == key], list(range(20)))
+
+    def test_different_keys_run_in_parallel(self):
+        dispatcher = self.create(2)
+        barrier = threading.Barrier(2, timeout=5)
+        dispatcher.submit('a', barrier.wait)
+        dispatcher.submit('b', barrier.wait)
+        self.wait_idle(dispatcher)
+        self.assertFalse(barrier.broken)
+
+    def test_priority(self):
+        dispatcher = self.create(1, num_classes=2)
+        gate = threading.Event()
+        order = []
+        dispatcher.submit('gate', gate.wait)
+        dispatcher.submit('low', order.append, 'low', priority=1)
+        dispatcher.submit('high', order.append, 'high', priority=0)
+        gate.set()
+        self.wait_idle(dispatcher)
+        self.assertEqual(order, ['high', 'low'])
+
+    def test_capacity(self):
+        dispatcher = self.create(1, max_queued=2)
+        gate = threading.Event()
+        dispatcher.submit('a', gate.wait)
+        self.assertTrue(dispatcher.has_capacity())
+        dispatcher.submit('a', gate.wait)
+        self.assertFalse(dispatcher.has_capacity())
+        self.assertFalse(dispatcher.wait_for_capacity(timeout=0.01))
+        self.assertEqual(dispatcher.queue_depth('a'), 2)
+        gate.set()
+        self.assertTrue(dispatcher.wait_for_capacity(timeout=5))
+
+    def test_exception_handler(self):
+        errors = []
+        dispatcher = self.create(1, exception_handler=errors.append)
+        done = []
+
+        def fail():
+            raise ValueError('boom')
+
+        dispatcher.submit('a', fail)
+        dispatcher.submit('a', done.append, 1)
+        self.wait_idle(dispatcher)
+        self.assertEqual([type(e) for e in errors], [ValueError])
+        self.assertEqual(done, [1])
+
+    def test_submit_after_shutdown(self):
+        dispatcher = self.create(1)
+        dispatcher.shutdown()
+        with self.assertRaises(RuntimeError):
+            dispatcher.submit('a', print)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mxpp.journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            if not journal.file.closed:
+                journal.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs) -> Journal:
+        journal = Journal(self.directory, **kwargs)
+        self.journals.append(journal)
+        return journal
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('segment-'))
+
+    def test_rotation_and_segment_deletion(self):
+        journal = self.open(segment_size=200)
+        entries = [journal.record('xmpp', {'body': 'x' * 50}, 'key{}'.format(i)) for i in range(10)]
+        self.assertGreater(len(self.segments()), 2)
+
+        for entry in entries[:-1]:
+            entry.release()
+        # The last entry keeps its own segment (and the current one) alive
+        self.assertLessEqual(len(self.segments()), 2)
+
+        entries[-1].release()
+        self.assertEqual(self.segments(), ['segment-{:08d}.log'.format(journal.segment)])
+        self.assertEqual(journal.pending_count(), 0)
+
+    def test_hold_delays_ack(self):
+        journal = self.open()
+        entry = journal.record('matrix', {}, 'event')
+        entry.hold()
+        entry.release()
+        self.assertEqual(journal.pending_count(), 1)
+        entry.release()
+        self.assertEqual(journal.pending_count(), 0)
+
+    def test_dedup_via_acked_keys(self):
+        journal = self.open(dedup_size=2)
+        journal.record('xmpp', {}, 'a').release()
+        self.assertIsNone(journal.record('xmpp', {}, 'a'))
+        self.assertTrue(journal.is_duplicate('a'))
+
+        journal.record('xmpp', {}, 'b').release()
+        journal.record('xmpp', {}, 'c').release()
+        # Only the last dedup_size keys are remembered
+        self.assertFalse(journal.is_duplicate('a'))
+        self.assertIsNotNone(journal.record('xmpp', {}, 'a'))
+
+    def test_pending_key_is_duplicate(self):
+        journal = self.open()
+        entry = journal.record('xmpp', {}, 'a')
+        self.assertIsNone(journal.record('xmpp', {}, 'a'))
+        self.assertIs(journal.find('a'), entry)
+        self.assertIsNotNone(journal.record('xmpp', {}, None))
+
+    def test_restart_after_unclean_close(self):
+        journal = self.open()
+        journal.record('xmpp', {'n': 1}, 'one').release()
+        journal.record('xmpp', {'n': 2}, 'two')
+        journal.file.write('{"op": "add", "id": 9, "ki')     # Torn write
+        journal.file.flush()
+        # Simulate a crash: stop the fsync thread without writing anything more
+        journal.closed.set()
+        journal.fsync_thread.join()
+        journal.file.close()
+
+        restarted = self.open()
+        replayed = []
+        restarted.replay_pending(replayed.append)
+        self.assertEqual([entry.data for entry in replayed], [{'n': 2}])
+        self.assertTrue(restarted.is_duplicate('one'))
+        self.assertIs(restarted.find('two'), replayed[0])
+        self.assertFalse(replayed[0].claim())
+
+        replayed[0].release()
+        self.assertEqual(restarted.pending_count(), 0)
+        self.assertIsNone(restarted.record('xmpp', {}, 'two'))
+
+    def test_replay_max_attempts(self):
+        journal = self.open()
+        journal.record('xmpp', {}, 'poison')
+        journal.close()
+
+        for _attempt in range(3):
+            journal = self.open()
+            replayed = []
+            journal.replay_pending(replayed.append, max_attempts=3)
+            self.assertEqual(len(replayed), 1)
+            journal.close()
+
+        journal = self.open()
+        replayed = []
+        journal.replay_pending(replayed.append, max_attempts=3)
+        self.assertEqual(replayed, [])
+        self.assertEqual(journal.pending_count(), 0)
+        self.assertTrue(journal.is_duplicate('poison'))
+
+    def test_claim_once(self):
+        journal = self.open()
+        entry = journal.record('xmpp', {}, 'a')
+        self.assertTrue(entry.claim())
+        self.assertFalse(entry.claim())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import unittest
+from collections import namedtuple
+from xml.etree import ElementTree
+
+from mxpp.mam import (CLIENT_NS, DATA_NS, FORWARD_NS, MAM_NS, RSM_NS, Checkpoint, CheckpointStore,
+                      MamCollector, build_query, iterate_archive)
+from mxpp.muc import DELAY_NS
+
+Jid = namedtuple('Jid', ['bare'])
+
+
+class FakeStanza:
+    """
+    Stand-in for a sleekxmpp stanza, as far as mxpp.mam looks at it
+    """
+    def __init__(self, xml: ElementTree.Element, from_jid: str=''):
+        self.xml = xml
+        self.from_jid = from_jid
+
+    def __getitem__(self, key):
+        assert key == 'from'
+        return Jid(self.from_jid)
+
+
+def result_message(queryid: str, archive_id: str, body: str, stamp: str='2020-01-02T03:04:05Z',
+                   from_jid: str='me@example.com') -> FakeStanza:
+    message = ElementTree.Element('{{{}}}message'.format(CLIENT_NS))
+    result = ElementTree.SubElement(message, '{{{}}}result'.format(MAM_NS), queryid=queryid, id=archive_id)
+    forwarded = ElementTree.SubElement(result, '{{{}}}forwarded'.format(FORWARD_NS))
+    ElementTree.SubElement(forwarded, '{{{}}}delay'.format(DELAY_NS), stamp=stamp)
+    inner = ElementTree.SubElement(forwarded, '{{{}}}message'.format(CLIENT_NS))
+    ElementTree.SubElement(inner, '{{{}}}body'.format(CLIENT_NS)).text = body
+    return FakeStanza(message, from_jid)
+
+
+def fin_iq(complete: bool, last: str=None) -> FakeStanza:
+    iq = ElementTree.Element('{{{}}}iq'.format(CLIENT_NS))
+    fin = ElementTree.SubElement(iq, '{{{}}}fin'.format(MAM_NS), complete='true' if complete else 'false')
+    rsm = ElementTree.SubElement(fin, '{{{}}}set'.format(RSM_NS))
+    if last is not None:
+        ElementTree.SubElement(rsm, '{{{}}}last'.format(RSM_NS)).text = last
+    return FakeStanza(iq)
+
+
+class FakeArchive:
+    """
+    Answers MAM queries from a list of (archive ID, body), `page_size` at a time, delivering
+     each page's results to a MamCollector before returning the <fin/>.
+    """
+    def __init__(self, collector: MamCollector, messages, last_ids: dict=None):
+        self.collector = collector
+        self.messages = messages
+        self.last_ids = last_ids or {}
+        self.queries = []
+
+    def send_query(self, query: ElementTree.Element, to: str or None):
+        self.queries.append(query)
+        page_size = int(query.findtext('{{{0}}}set/{{{0}}}max'.format(RSM_NS)))
+        after = query.findtext('{{{0}}}set/{{{0}}}after'.format(RSM_NS))
+        ids = [archive_id for archive_id, _body in self.messages]
+        start = ids.index(after) + 1 if after is not None else 0
+        page = self.messages[start:start + page_size]
+        for archive_id, body in page:
+            self.collector.deliver(result_message(query.get('queryid'), archive_id, body))
+        complete = start + page_size >= len(self.messages)
+        last = page[-1][0] if page else None
+        return fin_iq(complete, self.last_ids.get(last, last))
+
+
+class MamCollectorTest(unittest.TestCase):
+    def test_collects_results_of_open_query(self):
+        collector = MamCollector()
+        collector.open('q1', 'me@example.com')
+        self.assertTrue(collector.deliver(result_message('q1', 'a1', 'hello')))
+        results = collector.close('q1')
+        self.assertEqual([(r.archive_id, r.xml.findtext('{{{}}}body'.format(CLIENT_NS))) for r in results],
+                         [('a1', 'hello')])
+        self.assertEqual(results[0].stamp, 1577934245)
+        self.assertEqual(collector.close('q1'), [])
+
+    def test_drops_unknown_query_and_wrong_sender(self):
+        collector = MamCollector()
+        collector.open('q1', 'me@example.com')
+        self.assertTrue(collector.deliver(result_message('other', 'a1', 'x')))
+        self.assertTrue(collector.deliver(result_message('q1', 'a2', 'x', from_jid='evil@example.com')))
+        self.assertEqual(collector.close('q1'), [])
+
+    def test_ignores_ordinary_messages(self):
+        collector = MamCollector()
+        message = ElementTree.Element('{{{}}}message'.format(CLIENT_NS))
+        ElementTree.SubElement(message, '{{{}}}body'.format(CLIENT_NS)).text = 'hi'
+        self.assertFalse(collector.deliver(FakeStanza(message)))
+        self.assertFalse(MamCollector.is_result(FakeStanza(message)))
+        self.assertTrue(MamCollector.is_result(result_message('q', 'a', 'x')))
+
+
+class BuildQueryTest(unittest.TestCase):
+    def fields(self, query):
+        return {field.get('var'): field.findtext('{{{}}}value'.format(DATA_NS))
+                for field in query.iter('{{{}}}field'.format(DATA_NS))}
+
+    def test_query(self):
+        query = build_query('q1', with_jid='friend@example.com', start=0, after='a9', page_size=20)
+        self.assertEqual(query.get('queryid'), 'q1')
+        self.assertEqual(self.fields(query), {'FORM_TYPE': MAM_NS, 'with': 'friend@example.com',
+                                              'start': '1970-01-01T00:00:00Z'})
+        self.assertEqual(query.findtext('{{{0}}}set/{{{0}}}max'.format(RSM_NS)), '20')
+        self.assertEqual(query.findtext('{{{0}}}set/{{{0}}}after'.format(RSM_NS)), 'a9')
+
+    def test_minimal_query(self):
+        query = build_query('q1')
+        self.assertEqual(self.fields(query), {'FORM_TYPE': MAM_NS})
+        self.assertIsNone(query.find('{{{0}}}set/{{{0}}}after'.format(RSM_NS)))
+
+
+class IterateArchiveTest(unittest.TestCase):
+    def test_pages_until_complete(self):
+        collector = MamCollector()
+        archive = FakeArchive(collector, [('a{}'.format(i), str(i)) for i in range(5)])
+        results = list(iterate_archive(archive.send_query, collector, 'me@example.com', page_size=2))
+        self.assertEqual([r.archive_id for r in results], ['a0', 'a1', 'a2', 'a3', 'a4'])
+        self.assertEqual(len(archive.queries), 3)
+
+    def test_after_is_taken_from_last(self):
+        collector = MamCollector()
+        archive = FakeArchive(collector, [('a0', '0'), ('a1', '1'), ('a2', '2')], last_ids={'a1': 'a0'})
+        results = list(iterate_archive(archive.send_query, collector, 'me@example.com', page_size=2))
+        afters = [q.findtext('{{{0}}}set/{{{0}}}after'.format(RSM_NS)) for q in archive.queries]
+        # The server's <last/> (a0) is used over the last result's ID (a1)
+        self.assertEqual(afters[:2], [None, 'a0'])
+        self.assertEqual(results[0].archive_id, 'a0')
+
+    def test_resumes_from_checkpoint(self):
+        collector = MamCollector()
+        archive = FakeArchive(collector, [('a0', '0'), ('a1', '1'), ('a2', '2')])
+        results = list(iterate_archive(archive.send_query, collector, 'me@example.com',
+                                       checkpoint=Checkpoint(100.0, 'a0'), page_size=10))
+        self.assertEqual([r.archive_id for r in results], ['a1', 'a2'])
+        self.assertEqual(len(archive.queries), 1)
+
+    def test_stops_on_empty_page(self):
+        collector = MamCollector()
+        archive = FakeArchive(collector, [])
+        archive.send_query = lambda query, to: fin_iq(complete=False)
+        self.assertEqual(list(iterate_archive(archive.send_query, collector, 'me@example.com')), [])
+
+
+class CheckpointStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = []
+        self.removed = []
+
+    def create(self, stored=None, save_interval: float=3600) -> CheckpointStore:
+        return CheckpointStore(stored or {}, lambda jid, cp: self.saved.append((jid, cp)), self.removed.append,
+                               save_interval=save_interval)
+
+    def test_live_updates_only_move_forward(self):
+        store = self.create({'a@example.com': Checkpoint(10.0, 'x')})
+        store.update('a@example.com', 5.0)
+        self.assertEqual(store.get('a@example.com'), Checkpoint(10.0, 'x'))
+        store.update('a@example.com', 20.0, 'y')
+        self.assertEqual(store.get('a@example.com'), Checkpoint(20.0, 'y'))
+
+    def test_catch_up_owns_checkpoint(self):
+        store = self.create({'a@example.com': Checkpoint(10.0, 'x')})
+        store.begin('a@example.com')
+        store.update('a@example.com', 50.0, 'live')
+        self.assertEqual(store.get('a@example.com'), Checkpoint(10.0, 'x'))
+        store.update('a@example.com', 11.0, 'archived', catching_up=True)
+        self.assertEqual(store.get('a@example.com'), Checkpoint(11.0, 'archived'))
+        store.end('a@example.com')
+        store.update('a@example.com', 50.0, 'live')
+        self.assertEqual(store.get('a@example.com'), Checkpoint(50.0, 'live'))
+
+    def test_saves_are_throttled(self):
+        store = self.create()
+        store.update('a@example.com', 1.0)
+        store.update('a@example.com', 2.0)
+        store.update('b@example.com', 3.0)
+        self.assertEqual(self.saved, [])
+        store.flush()
+        self.assertEqual(sorted(self.saved), [('a@example.com', Checkpoint(2.0, None)),
+                                              ('b@example.com', Checkpoint(3.0, None))])
+        store.flush()
+        self.assertEqual(len(self.saved), 2)
+
+    def test_saves_once_interval_has_passed(self):
+        store = self.create(save_interval=0)
+        store.update('a@example.com', 1.0)
+        self.assertEqual(self.saved, [('a@example.com', Checkpoint(1.0, None))])
+
+    def test_forget(self):
+        store = self.create({'a@example.com': Checkpoint(1.0, None)})
+        store.forget('a@example.com')
+        self.assertIsNone(store.get('a@example.com'))
+        self.assertEqual(self.removed, ['a@example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from mxpp.media import ChunkReader, MediaBridge, MediaError, TransferCache, check_source_url
+
+# What each test host resolves to
+ADDRESSES = {
+    'files.example.com': ['93.184.216.34'],
+    'upload.example.com': ['93.184.216.35'],
+    'localhost': ['127.0.0.1', '::1'],
+    'internal.example.com': ['10.1.2.3'],
+    'metadata.example.com': ['169.254.169.254'],
+    'v6-local.example.com': ['fe80::1%eth0'],
+    'mixed.example.com': ['93.184.216.34', '192.168.0.1'],
+}
+
+
+def fake_getaddrinfo(host, port, *_args, **_kwargs):
+    if host not in ADDRESSES:
+        raise socket.gaierror('unknown host {}'.format(host))
+    return [(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM, 6, '', (ip, port))
+            for ip in ADDRESSES[host]]
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict=None, chunks=()):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, _chunk_size):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeApi:
+    base_url = 'https://matrix.example.com'
+    token = 'token'
+
+
+@mock.patch('socket.getaddrinfo', fake_getaddrinfo)
+class CheckSourceUrlTest(unittest.TestCase):
+    def test_public_https_is_allowed(self):
+        check_source_url('https://files.example.com/a.png')
+        check_source_url('https://files.example.com:8443/a.png', ['example.com'])
+
+    def test_refuses_non_https(self):
+        for url in ('http://files.example.com/a.png', 'ftp://files.example.com/a', 'file:///etc/passwd'):
+            with self.assertRaises(MediaError, msg=url):
+                check_source_url(url)
+
+    def test_refuses_private_loopback_and_link_local(self):
+        for host in ('localhost', 'internal.example.com', 'metadata.example.com', 'v6-local.example.com',
+                     'mixed.example.com', '127.0.0.1', '[::1]', '10.0.0.1', '169.254.169.254'):
+            with self.assertRaises(MediaError, msg=host):
+                check_source_url('https://{}/a.png'.format(host))
+
+    def test_refuses_unresolvable_host(self):
+        with self.assertRaises(MediaError):
+            check_source_url('https://nowhere.example.com/a.png')
+
+    def test_allowed_domains(self):
+        check_source_url('https://upload.example.com/a.png', ['upload.example.com'])
+        with self.assertRaises(MediaError):
+            check_source_url('https://files.example.com/a.png', ['upload.example.com'])
+        with self.assertRaises(MediaError):
+            check_source_url('https://evilupload.example.com/a.png', ['upload.example.com'])
+
+
+@mock.patch('socket.getaddrinfo', fake_getaddrinfo)
+class OpenSourceTest(unittest.TestCase):
+    def bridge(self, responses: dict) -> MediaBridge:
+        bridge = MediaBridge(FakeApi(), send_query=None)
+        self.fetched = []
+
+        def fake_open(url, headers=None, allow_redirects=True):
+            self.assertFalse(allow_redirects)
+            self.fetched.append(url)
+            return responses[url]
+
+        bridge._open = fake_open
+        self.addCleanup(bridge.close)
+        return bridge
+
+    def test_follows_public_redirect(self):
+        final = FakeResponse(200)
+        bridge = self.bridge({
+            'https://files.example.com/a': FakeResponse(302, {'Location': '/b'}),
+            'https://files.example.com/b': FakeResponse(301, {'Location': 'https://upload.example.com/c'}),
+            'https://upload.example.com/c': final,
+        })
+        self.assertIs(bridge._open_source('https://files.example.com/a'), final)
+
+    def test_refuses_redirect_to_private_address(self):
+        for location in ('https://internal.example.com/x', 'https://127.0.0.1/x', 'http://files.example.com/x',
+                         'https://metadata.example.com/latest/meta-data/'):
+            redirect = FakeResponse(302, {'Location': location})
+            bridge = self.bridge({'https://files.example.com/a': redirect})
+            with self.assertRaises(MediaError, msg=location):
+                bridge._open_source('https://files.example.com/a')
+            self.assertEqual(self.fetched, ['https://files.example.com/a'])
+            self.assertTrue(redirect.closed)
+
+    def test_too_many_redirects(self):
+        bridge = self.bridge({'https://files.example.com/a': FakeResponse(302, {'Location': '/a'})})
+        with self.assertRaises(MediaError):
+            bridge._open_source('https://files.example.com/a')
+
+    def test_size_limit(self):
+        bridge = MediaBridge(FakeApi(), send_query=None, max_size=10)
+        self.addCleanup(bridge.close)
+        self.assertEqual(bridge._checked_size('u', FakeResponse(200, {'Content-Length': '10'})), 10)
+        with self.assertRaises(MediaError):
+            bridge._checked_size('u', FakeResponse(200, {'Content-Length': '11'}))
+        with self.assertRaises(MediaError):
+            bridge._checked_size('u', FakeResponse(200))
+
+
+class ChunkReaderTest(unittest.TestCase):
+    def read_all(self, reader: ChunkReader) -> bytes:
+        data = b''
+        while True:
+            chunk = reader.read(3)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_reads_announced_length(self):
+        reader = ChunkReader(iter([b'hello', b' ', b'world']), 11)
+        self.assertEqual(len(reader), 11)
+        self.assertEqual(self.read_all(reader), b'hello world')
+
+    def test_aborts_when_source_sends_too_much(self):
+        reader = ChunkReader(iter([b'x' * 8, b'x' * 8]), 10)
+        with self.assertRaises(MediaError):
+            self.read_all(reader)
+
+    def test_aborts_when_source_ends_early(self):
+        reader = ChunkReader(iter([b'short']), 10)
+        with self.assertRaises(MediaError):
+            self.read_all(reader)
+
+
+class TransferCacheTest(unittest.TestCase):
+    def test_concurrent_requests_share_one_transfer(self):
+        cache = TransferCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def transfer():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.get('k', transfer)))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=lambda: results.append(cache.get('k', transfer)))
+        second.start()
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual((results, len(calls)), (['result', 'result'], 1))
+
+    def test_failures_are_not_cached(self):
+        cache = TransferCache()
+
+        def fail():
+            raise MediaError('nope')
+
+        with self.assertRaises(MediaError):
+            cache.get('k', fail)
+        self.assertEqual(cache.get('k', lambda: 'ok'), 'ok')
+
+    def test_bounded(self):
+        cache = TransferCache(max_entries=2)
+        for key in 'abc':
+            cache.put(key, key)
+        self.assertEqual(list(cache.results), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+from mxpp.membership import MembershipIndex
+
+
+class MembershipIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = MembershipIndex()
+        self.index.seed('!a', {'@bot:example.com': 'join', '@me:example.com': 'invite'})
+
+    def test_seed_and_members(self):
+        self.assertTrue(self.index.is_seeded('!a'))
+        self.assertFalse(self.index.is_seeded('!b'))
+        self.assertEqual(self.index.members('!a'), {'@bot:example.com'})
+        self.assertEqual(self.index.members('!a', 'invite'), {'@me:example.com'})
+        self.assertEqual(self.index.members('!b'), set())
+
+    def test_updates(self):
+        self.index.update('!a', '@me:example.com', 'join')
+        self.index.update('!a', '@bot:example.com', 'leave')
+        self.assertEqual(self.index.members('!a'), {'@me:example.com'})
+        self.index.update('!a', '@me:example.com', 'ban')
+        self.assertEqual(self.index.members('!a'), set())
+
+    def test_updates_to_unseeded_rooms_are_ignored(self):
+        self.index.update('!b', '@me:example.com', 'join')
+        self.assertFalse(self.index.is_seeded('!b'))
+        self.assertEqual(self.index.members('!b'), set())
+
+    def test_missing(self):
+        users = ['@me:example.com', '@bot:example.com', '@other:example.com']
+        self.assertEqual(self.index.missing('!a', users), ['@other:example.com'])
+        self.index.update('!a', '@me:example.com', 'leave')
+        self.assertEqual(self.index.missing('!a', users), ['@me:example.com', '@other:example.com'])
+        self.assertEqual(self.index.missing('!b', users), users)
+
+    def test_forget_prune_and_clear(self):
+        self.index.seed('!b', {})
+        self.index.seed('!c', {})
+        self.index.forget('!a')
+        self.assertFalse(self.index.is_seeded('!a'))
+        self.index.prune(['!c'])
+        self.assertEqual((self.index.is_seeded('!b'), self.index.is_seeded('!c')), (False, True))
+        self.index.clear()
+        self.assertFalse(self.index.is_seeded('!c'))
+
+    def test_seed_copies(self):
+        memberships = {'@bot:example.com': 'join'}
+        self.index.seed('!b', memberships)
+        memberships['@me:example.com'] = 'join'
+        self.assertEqual(self.index.members('!b'), {'@bot:example.com'})
+
+
+if __name__ == '__main__':
+    unittest.main()
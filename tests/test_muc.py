@@ -0,0 +1,163 @@
+import unittest
+from collections import namedtuple
+from xml.etree import ElementTree
+
+from mxpp.muc import (DELAY_NS, MUC_NS, STANZA_ID_NS, MucHistoryIndex, delay_stamp, format_stamp,
+                      groupchat_message_key, join_muc, parse_stamp)
+
+Jid = namedtuple('Jid', ['bare'])
+
+ROOM = 'room@muc.example.com'
+
+
+class FakeMessage:
+    """
+    Stand-in for a sleekxmpp MUC message, as far as mxpp.muc looks at it
+    """
+    def __init__(self, nick: str, body: str, message_id: str='', room_stanza_id: str=None, stamp: str=None):
+        self.xml = ElementTree.Element('{jabber:client}message')
+        if room_stanza_id is not None:
+            ElementTree.SubElement(self.xml, '{{{}}}stanza-id'.format(STANZA_ID_NS), by=ROOM, id=room_stanza_id)
+        if stamp is not None:
+            ElementTree.SubElement(self.xml, '{{{}}}delay'.format(DELAY_NS), stamp=stamp)
+        self.items = {'from': Jid(ROOM), 'mucnick': nick, 'body': body, 'id': message_id}
+
+    def __getitem__(self, key):
+        return self.items[key]
+
+
+class FakePresence(list):
+    def __init__(self, pto: str):
+        super().__init__()
+        self.pto = pto
+
+
+class FakePlugin:
+    def __init__(self):
+        self.rooms = {}
+        self.our_nicks = {}
+
+
+class FakeClient:
+    def __init__(self):
+        self.plugin = {'xep_0045': FakePlugin()}
+        self.sent = []
+
+    def make_presence(self, pto: str) -> FakePresence:
+        return FakePresence(pto)
+
+    def send(self, presence: FakePresence):
+        self.sent.append(presence)
+
+
+class StampTest(unittest.TestCase):
+    def test_parse_stamp(self):
+        self.assertEqual(parse_stamp('2020-01-02T03:04:05Z'), 1577934245)
+        self.assertEqual(parse_stamp('2020-01-02T03:04:05.5Z'), 1577934245.5)
+        self.assertEqual(parse_stamp('2020-01-02T05:04:05+02:00'), 1577934245)
+        self.assertEqual(parse_stamp('2020-01-01T22:34:05-04:30'), 1577934245)
+        self.assertIsNone(parse_stamp('yesterday'))
+        self.assertIsNone(parse_stamp(None))
+        self.assertEqual(format_stamp(1577934245), '2020-01-02T03:04:05Z')
+
+    def test_delay_stamp(self):
+        self.assertIsNone(delay_stamp(FakeMessage('nick', 'live')))
+        self.assertEqual(delay_stamp(FakeMessage('nick', 'old', stamp='2020-01-02T03:04:05Z')), 1577934245)
+
+
+class GroupchatMessageKeyTest(unittest.TestCase):
+    def test_history_replay_has_same_key(self):
+        for live, replayed in [
+                (FakeMessage('nick', 'hi', 'm1', room_stanza_id='s1'),
+                 FakeMessage('nick', 'hi', 'm1', room_stanza_id='s1', stamp='2020-01-02T03:04:05Z')),
+                (FakeMessage('nick', 'hi', 'm1'), FakeMessage('nick', 'hi', 'm1', stamp='2020-01-02T03:04:05Z')),
+                (FakeMessage('nick', 'hi'), FakeMessage('nick', 'hi', stamp='2020-01-02T03:04:05Z'))]:
+            self.assertEqual(groupchat_message_key(live), groupchat_message_key(replayed))
+
+    def test_different_messages_have_different_keys(self):
+        keys = {groupchat_message_key(message) for message in [
+            FakeMessage('nick', 'hi', 'm1', room_stanza_id='s1'),
+            FakeMessage('nick', 'hi', 'm1', room_stanza_id='s2'),
+            FakeMessage('nick', 'hi', 'm1'),
+            FakeMessage('other', 'hi', 'm1'),
+            FakeMessage('nick', 'hi'),
+            FakeMessage('nick', 'hello')]}
+        self.assertEqual(len(keys), 6)
+
+
+class MucHistoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = {}
+
+    def create(self, **kwargs) -> MucHistoryIndex:
+        return MucHistoryIndex({room_jid: entry for room_jid, entry in self.saved.items()},
+                               lambda room_jid, last, keys: self.saved.__setitem__(room_jid, (last, keys)),
+                               **kwargs)
+
+    def test_rejoin_skips_already_bridged_history(self):
+        index = self.create(save_interval=3600)
+        bridged = [FakeMessage('nick', 'msg {}'.format(i), 'm{}'.format(i)) for i in range(3)]
+        for i, message in enumerate(bridged):
+            index.add(ROOM, groupchat_message_key(message), 100.0 + i)
+        index.flush()
+
+        # After a restart, the room replays its history, plus a message we never saw
+        index = self.create()
+        self.assertEqual(index.last_bridged(ROOM), 102.0)
+        history = [FakeMessage('nick', 'msg {}'.format(i), 'm{}'.format(i), stamp=format_stamp(100 + i))
+                   for i in range(4)]
+        new = [message['body'] for message in history
+               if not index.is_duplicate(ROOM, groupchat_message_key(message))]
+        self.assertEqual(new, ['msg 3'])
+
+    def test_keys_are_bounded(self):
+        index = self.create(keys_per_room=2)
+        for key in 'abc':
+            index.add(ROOM, key, 1.0)
+        self.assertFalse(index.is_duplicate(ROOM, 'a'))
+        self.assertTrue(index.is_duplicate(ROOM, 'c'))
+
+    def test_last_bridged_only_moves_forward(self):
+        index = self.create()
+        index.add(ROOM, 'a', 10.0)
+        index.add(ROOM, 'b', 5.0)
+        self.assertEqual(index.last_bridged(ROOM), 10.0)
+        self.assertIsNone(index.last_bridged('other@muc.example.com'))
+
+    def test_saves_are_throttled(self):
+        index = self.create(save_interval=3600)
+        index.add(ROOM, 'a', 1.0)
+        self.assertEqual(self.saved, {})
+        index.flush()
+        self.assertEqual(self.saved, {ROOM: (1.0, ['a'])})
+
+    def test_forget(self):
+        index = self.create(save_interval=3600)
+        index.add(ROOM, 'a', 1.0)
+        index.forget(ROOM)
+        index.flush()
+        self.assertFalse(index.is_duplicate(ROOM, 'a'))
+        self.assertEqual(self.saved, {})
+
+
+class JoinMucTest(unittest.TestCase):
+    def history(self, client: FakeClient) -> ElementTree.Element:
+        presence = client.sent[-1]
+        self.assertEqual(presence.pto, ROOM + '/bot')
+        return presence[0].find('{{{}}}history'.format(MUC_NS))
+
+    def test_history_since_last_bridged(self):
+        client = FakeClient()
+        join_muc(client, ROOM, 'bot', maxstanzas=50, since=1577934245)
+        self.assertEqual(self.history(client).attrib, {'since': '2020-01-02T03:04:05Z', 'maxstanzas': '50'})
+        self.assertEqual(client.plugin['xep_0045'].our_nicks, {ROOM: 'bot'})
+        self.assertIn(ROOM, client.plugin['xep_0045'].rooms)
+
+    def test_no_history_for_new_rooms(self):
+        client = FakeClient()
+        join_muc(client, ROOM, 'bot', maxstanzas=50)
+        self.assertEqual(self.history(client).attrib, {'maxchars': '0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import threading
+import unittest
+
+import requests
+
+from matrix_client.errors import MatrixRequestError
+from mxpp.outbound import OutboundSender
+
+
+class FakeApi:
+    base_url = 'http://localhost'
+    token = 'token'
+
+
+class ScriptedSender(OutboundSender):
+    """
+    OutboundSender whose requests get the scripted responses (a status code, or an exception to
+     raise) in turn; 200 once the script runs out.
+    """
+    def __init__(self, script, **kwargs):
+        OutboundSender.__init__(self, FakeApi(), workers=1, retry_initial=0, retry_maximum=0, **kwargs)
+        self.script = list(script)
+        self.puts = 0
+
+    def _put(self, path, content, user_id=None):
+        self.puts += 1
+        response = self.script.pop(0) if self.script else 200
+        if isinstance(response, Exception):
+            raise response
+        if response != 200:
+            raise MatrixRequestError(code=response, content='{"retry_after_ms": 1}')
+
+
+class OutboundSenderTest(unittest.TestCase):
+    def send(self, sender: OutboundSender) -> bool:
+        """
+        :return: True if on_done was called
+        """
+        done = threading.Event()
+        sender.send('!room:example.com', {'body': 'hi'}, on_done=done.set)
+        sender.shutdown(grace=5)
+        return done.is_set()
+
+    def test_retries_server_errors(self):
+        sender = ScriptedSender([500, requests.ConnectionError(), 502], max_retries=3)
+        self.assertTrue(self.send(sender))
+        self.assertEqual((sender.puts, sender.failed), (4, 0))
+
+    def test_permanent_rejection_is_done(self):
+        sender = ScriptedSender([403], max_retries=3)
+        self.assertTrue(self.send(sender))
+        self.assertEqual((sender.puts, sender.failed), (1, 1))
+
+    def test_out_of_retries_is_not_done(self):
+        sender = ScriptedSender([500] * 10, max_retries=2)
+        # The journal entry must stay unacknowledged, to be replayed on the next start
+        self.assertFalse(self.send(sender))
+        self.assertEqual((sender.puts, sender.failed), (3, 1))
+
+    def test_rate_limits_do_not_use_up_retries(self):
+        sender = ScriptedSender([429] * 20 + [500], max_retries=1)
+        self.assertTrue(self.send(sender))
+        self.assertEqual((sender.puts, sender.failed), (22, 0))
+
+    def test_rate_limit_budget(self):
+        # Each 429 asks for 1ms
+        sender = ScriptedSender([429] * 20, max_retries=1, rate_limit_budget=0.0105)
+        self.assertFalse(self.send(sender))
+        self.assertEqual((sender.puts, sender.failed), (11, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
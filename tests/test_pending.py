@@ -0,0 +1,102 @@
+import threading
+import unittest
+
+from mxpp.dispatch import KeyedDispatcher
+from mxpp.pending import UnknownJidBuffer
+
+
+class UnknownJidBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.known = set()
+        self.requests = threading.Semaphore(0)
+        self.dispatcher = KeyedDispatcher(2)
+        self.handled = []
+        self.strangers = []
+        self.done = threading.Condition()
+
+    def tearDown(self):
+        self.buffer.close()
+        self.dispatcher.shutdown()
+
+    def create(self, **kwargs) -> UnknownJidBuffer:
+        self.buffer = UnknownJidBuffer(lambda jid: jid in self.known,
+                                       self.requests.release,
+                                       self.dispatcher.submit,
+                                       stranger=self.stranger,
+                                       **kwargs)
+        return self.buffer
+
+    def handle(self, jid, value):
+        with self.done:
+            self.handled.append((jid, value))
+            self.done.notify_all()
+
+    def stranger(self, jid, func, *args):
+        with self.done:
+            self.strangers.append((jid, args))
+            self.done.notify_all()
+
+    def wait_for(self, count: int):
+        with self.done:
+            self.assertTrue(self.done.wait_for(lambda: len(self.handled) + len(self.strangers) >= count, 5))
+
+    def test_known_jids_are_not_held(self):
+        buffer = self.create()
+        self.known.add('a@example.com')
+        self.assertFalse(buffer.hold('a@example.com', self.handle, 'a@example.com', 1))
+        self.assertEqual(buffer.held_count(), 0)
+
+    def test_release_on_roster_answer(self):
+        buffer = self.create(coalesce_delay=0.01, timeout=5)
+        for i in range(3):
+            self.assertTrue(buffer.hold('a@example.com', self.handle, 'a@example.com', i))
+        self.assertTrue(buffer.hold('b@example.com', self.handle, 'b@example.com', 0))
+        self.assertEqual(buffer.held_count(), 4)
+
+        # One roster request for the whole burst
+        self.assertTrue(self.requests.acquire(timeout=5))
+        self.known.update(['a@example.com', 'b@example.com'])
+        buffer.roster_answered()
+        self.wait_for(4)
+
+        self.assertEqual([v for jid, v in self.handled if jid == 'a@example.com'], [0, 1, 2])
+        self.assertEqual(self.strangers, [])
+        self.assertEqual(buffer.held_count(), 0)
+        self.assertFalse(self.requests.acquire(timeout=0.05))
+
+    def test_strangers_are_not_handled(self):
+        buffer = self.create(coalesce_delay=0.01, timeout=5)
+        buffer.hold('a@example.com', self.handle, 'a@example.com', 1)
+        buffer.hold('s@example.com', self.handle, 's@example.com', 2)
+        self.assertTrue(self.requests.acquire(timeout=5))
+        self.known.add('a@example.com')
+        buffer.roster_answered()
+        self.wait_for(2)
+
+        self.assertEqual(self.handled, [('a@example.com', 1)])
+        self.assertEqual(self.strangers, [('s@example.com', ('s@example.com', 2))])
+        # Later events from the stranger are left to the caller, without another roster request
+        self.assertFalse(buffer.hold('s@example.com', self.handle, 's@example.com', 3))
+        self.assertFalse(self.requests.acquire(timeout=0.05))
+
+    def test_timeout(self):
+        buffer = self.create(coalesce_delay=0.01, timeout=0.05)
+        buffer.hold('s@example.com', self.handle, 's@example.com', 1)
+        self.wait_for(1)
+        self.assertEqual(self.strangers, [('s@example.com', ('s@example.com', 1))])
+
+    def test_roster_answer_to_other_request_is_ignored(self):
+        buffer = self.create(coalesce_delay=5)
+        buffer.hold('a@example.com', self.handle, 'a@example.com', 1)
+        self.known.add('a@example.com')
+        buffer.roster_answered()
+        self.assertEqual(buffer.held_count(), 1)
+
+    def test_max_held(self):
+        buffer = self.create(coalesce_delay=5, max_held=1)
+        self.assertTrue(buffer.hold('a@example.com', self.handle, 'a@example.com', 1))
+        self.assertFalse(buffer.hold('b@example.com', self.handle, 'b@example.com', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from mxpp.policy import (JidPolicy, SEND_MESSAGES_TO_ALL_CHAT, SEND_MESSAGES_TO_JID_ROOMS,
+                         SEND_PRESENCES_TO_CONTROL, BATCH_MESSAGES_TO_ALL_CHAT)
+
+DEFAULTS = {
+    'send_messages_to_all_chat': True,
+    'send_messages_to_jid_rooms': True,
+    'send_presences_to_control': True,
+    'batch_messages_to_all_chat': False,
+}
+
+
+class JidPolicyTest(unittest.TestCase):
+    def test_defaults(self):
+        policy = JidPolicy(DEFAULTS, [])
+        self.assertEqual(policy.flags('anyone@example.com'),
+                         SEND_MESSAGES_TO_ALL_CHAT | SEND_MESSAGES_TO_JID_ROOMS | SEND_PRESENCES_TO_CONTROL)
+        self.assertFalse(policy.allows('anyone@example.com', BATCH_MESSAGES_TO_ALL_CHAT))
+
+    def test_exact_jid_is_case_insensitive(self):
+        policy = JidPolicy(DEFAULTS, [{'jids': ['Friend@Example.com'], 'send_presences_to_control': False}])
+        self.assertFalse(policy.allows('friend@example.com', SEND_PRESENCES_TO_CONTROL))
+        self.assertFalse(policy.allows('FRIEND@example.COM', SEND_PRESENCES_TO_CONTROL))
+        self.assertTrue(policy.allows('friend@example.com', SEND_MESSAGES_TO_ALL_CHAT))
+
+    def test_domain_matches_subdomains(self):
+        policy = JidPolicy(DEFAULTS, [{'jids': ['@spam.example.net'], 'send_messages_to_all_chat': False}])
+        self.assertFalse(policy.allows('bot@spam.example.net', SEND_MESSAGES_TO_ALL_CHAT))
+        self.assertFalse(policy.allows('bot@a.spam.example.net', SEND_MESSAGES_TO_ALL_CHAT))
+        self.assertTrue(policy.allows('bot@example.net', SEND_MESSAGES_TO_ALL_CHAT))
+        self.assertTrue(policy.allows('bot@notspam.example.net', SEND_MESSAGES_TO_ALL_CHAT))
+
+    def test_precedence(self):
+        policy = JidPolicy(DEFAULTS, [
+            {'jids': ['friend@example.org'], 'send_messages_to_jid_rooms': True},
+            {'jids': ['@example.org'], 'send_messages_to_jid_rooms': False},
+            {'jids': ['@sub.example.org'], 'send_messages_to_jid_rooms': True},
+            {'jids': ['*@*example.org'], 'send_messages_to_jid_rooms': False, 'batch_messages_to_all_chat': True},
+        ])
+        # Exact beats domain beats glob, whatever the order of the groups
+        self.assertTrue(policy.allows('friend@example.org', SEND_MESSAGES_TO_JID_ROOMS))
+        self.assertFalse(policy.allows('other@example.org', SEND_MESSAGES_TO_JID_ROOMS))
+        # Longer domains beat shorter ones
+        self.assertTrue(policy.allows('other@sub.example.org', SEND_MESSAGES_TO_JID_ROOMS))
+        # Options a more specific rule doesn't set are left as the glob set them
+        self.assertTrue(policy.allows('friend@example.org', BATCH_MESSAGES_TO_ALL_CHAT))
+
+    def test_later_groups_win(self):
+        policy = JidPolicy(DEFAULTS, [
+            {'jids': ['a@example.com'], 'send_messages_to_all_chat': False},
+            {'jids': ['a@example.com'], 'send_messages_to_all_chat': True},
+        ])
+        self.assertTrue(policy.allows('a@example.com', SEND_MESSAGES_TO_ALL_CHAT))
+
+    def test_glob(self):
+        policy = JidPolicy(DEFAULTS, [{'jids': ['bot-?@example.com'], 'send_presences_to_control': False}])
+        self.assertFalse(policy.allows('bot-1@example.com', SEND_PRESENCES_TO_CONTROL))
+        self.assertTrue(policy.allows('bot-12@example.com', SEND_PRESENCES_TO_CONTROL))
+
+    def test_unknown_options_are_ignored(self):
+        policy = JidPolicy(DEFAULTS, [{'jids': ['a@example.com'], 'no_such_option': True}])
+        self.assertEqual(policy.flags('a@example.com'), policy.flags('b@example.com'))
+
+    def test_cache_is_bounded(self):
+        policy = JidPolicy(DEFAULTS, [], cache_size=2)
+        for i in range(5):
+            policy.flags('{}@example.com'.format(i))
+        self.assertEqual(list(policy.cache), ['3@example.com', '4@example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import threading
+import unittest
+
+from mxpp.presence import PresenceAggregator
+
+
+class PresenceAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.digests = []
+        self.emitted = threading.Event()
+
+    def tearDown(self):
+        self.aggregator.shutdown()
+
+    def create(self, **kwargs) -> PresenceAggregator:
+        self.aggregator = PresenceAggregator(self.emit, **kwargs)
+        return self.aggregator
+
+    def emit(self, message: str):
+        self.digests.append(message)
+        self.emitted.set()
+
+    def test_changes_are_collected_into_one_digest(self):
+        aggregator = self.create(window=3600)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        aggregator.update('b@example.com', 'Bob', 'available')
+        aggregator.update('c@example.com', 'Carol', 'unavailable')
+        self.assertEqual(self.digests, [])
+        aggregator.flush()
+        self.assertEqual(self.digests, ['2 available, 1 unavailable:\n'
+                                        'available: Alice (a@example.com), Bob (b@example.com)\n'
+                                        'unavailable: Carol (c@example.com)'])
+
+    def test_single_change(self):
+        aggregator = self.create(window=0)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        self.assertEqual(self.digests, ['Alice available (a@example.com)'])
+
+    def test_unchanged_state_is_dropped(self):
+        aggregator = self.create(window=0)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        aggregator.update('a@example.com', 'Alice', 'available')
+        self.assertEqual(len(self.digests), 1)
+
+    def test_change_and_change_back_cancel_out(self):
+        aggregator = self.create(window=3600)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        aggregator.flush()
+        aggregator.update('a@example.com', 'Alice', 'away')
+        aggregator.update('a@example.com', 'Alice', 'available')
+        aggregator.flush()
+        self.assertEqual(len(self.digests), 1)
+
+    def test_flushes_after_window(self):
+        aggregator = self.create(window=0.05)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        self.assertTrue(self.emitted.wait(5))
+        self.assertEqual(self.digests, ['Alice available (a@example.com)'])
+
+    def test_flushes_early_when_full(self):
+        aggregator = self.create(window=3600, max_pending=2)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        aggregator.update('b@example.com', 'Bob', 'available')
+        self.assertEqual(len(self.digests), 1)
+
+    def test_long_lists_are_truncated(self):
+        aggregator = self.create(window=3600, max_listed=2)
+        for i in range(5):
+            aggregator.update('{}@example.com'.format(i), str(i), 'available')
+        aggregator.flush()
+        self.assertEqual(self.digests, ['5 available:\navailable: 0 (0@example.com), 1 (1@example.com) and 3 more'])
+
+    def test_tracked_jids_are_bounded(self):
+        aggregator = self.create(window=0, max_tracked=1)
+        aggregator.update('a@example.com', 'Alice', 'available')
+        aggregator.update('b@example.com', 'Bob', 'available')
+        # Alice's state has been forgotten, so the same state is reported again
+        aggregator.update('a@example.com', 'Alice', 'available')
+        self.assertEqual(len(self.digests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import unittest
+
+from mxpp.profiling import Profiler, ProfilerBusy, parse_duration
+
+
+def spin(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def wait(stop: threading.Event):
+    stop.wait(5)
+
+
+class ParseDurationTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(parse_duration('30'), 30)
+        self.assertEqual(parse_duration('30s'), 30)
+        self.assertEqual(parse_duration('2m'), 120)
+        self.assertEqual(parse_duration(' 500MS '), 0.5)
+        self.assertEqual(parse_duration('1.5s'), 1.5)
+
+    def test_invalid(self):
+        for text in ('', 'soon', '-1s', '10h', 's'):
+            with self.assertRaises(ValueError, msg=text):
+                parse_duration(text)
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(directory=os.path.join(self.directory, 'profiles'), max_duration=0.5,
+                                 interval=0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def written(self, summary: str) -> str:
+        path = summary.split('written to ', 1)[1].split('\n', 1)[0]
+        self.assertTrue(path.startswith(self.profiler.directory))
+        with open(path, 'rb') as result:
+            return result.read()
+
+    def test_profile_finds_busy_thread(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=spin, args=(stop,), name='spinner')
+        worker.start()
+        try:
+            summary = self.profiler.run('profile', 0.1)
+        finally:
+            stop.set()
+            worker.join()
+        self.assertIn('Hottest functions', summary)
+        self.assertIn('spin (test_profiling.py:', summary)
+        self.assertIn(b'spin (test_profiling.py:', self.written(summary))
+
+    def test_duration_is_clamped(self):
+        self.assertEqual(self.profiler.clamp(3600), 0.5)
+        self.assertEqual(self.profiler.clamp(-1), 0)
+        self.assertIn('Profiled for 0s', self.profiler.run('profile', -5))
+
+    def test_memory_snapshot(self):
+        summary = self.profiler.run('memory_snapshot', 0.01)
+        self.assertTrue(summary.startswith('Traced allocations over 0.01s'))
+        snapshot = tracemalloc.Snapshot.load(summary.split('written to ', 1)[1].split('\n', 1)[0])
+        self.assertIsInstance(snapshot, tracemalloc.Snapshot)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_thread_dump_groups_pools(self):
+        stop = threading.Event()
+        workers = [threading.Thread(target=wait, args=(stop,), name='pool-{}'.format(i)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        try:
+            summary = self.profiler.run('thread_dump')
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        self.assertIn('3x pool: ', summary)
+        # The bridge-side caller of the blocking call is shown
+        self.assertIn('<- wait (test_profiling.py:', summary)
+        self.assertIn(b'Thread pool-0', self.written(summary))
+
+    def test_one_diagnostic_at_a_time(self):
+        with self.profiler.lock:
+            self.assertTrue(self.profiler.busy())
+            with self.assertRaises(ProfilerBusy):
+                self.profiler.run('thread_dump')
+        self.assertFalse(self.profiler.busy())
+
+
+if __name__ == '__main__':
+    unittest.main()
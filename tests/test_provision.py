@@ -0,0 +1,168 @@
+import threading
+import time
+import unittest
+
+from matrix_client.errors import MatrixRequestError
+
+from mxpp.provision import RoomProvisioner, TokenBucket
+
+
+class FakeRoom:
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.topic = None
+        self.name = None
+
+
+class FakeMatrix:
+    """
+    Answers createRoom requests, optionally blocking until `gate` is set or failing with
+     the errors queued in `errors`.
+    """
+    def __init__(self):
+        self.api = self
+        self.created = []
+        self.errors = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.lock = threading.Lock()
+
+    def _send(self, method: str, path: str, content: dict):
+        assert (method, path) == ('POST', '/createRoom')
+        self.gate.wait(5)
+        with self.lock:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.created.append(content['topic'])
+            return {'room_id': '!{}'.format(len(self.created))}
+
+    def _mkroom(self, room_id: str) -> FakeRoom:
+        return FakeRoom(room_id)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=20.0, burst=3)
+        start = time.monotonic()
+        for _i in range(3):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.04)
+        for _i in range(2):
+            bucket.acquire()
+        # Two more tokens at 20/s take ~0.1s
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_hold_blocks_callers(self):
+        bucket = TokenBucket(rate=1000.0, burst=5)
+        bucket.hold(0.1)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class RoomProvisionerTest(unittest.TestCase):
+    def setUp(self):
+        self.matrix = FakeMatrix()
+        self.created = {}
+        self.reports = []
+
+    def tearDown(self):
+        self.matrix.gate.set()
+        self.provisioner.shutdown()
+
+    def create(self, **kwargs) -> RoomProvisioner:
+        self.provisioner = RoomProvisioner(self.matrix, ['@me:example.com'], self.created.__setitem__,
+                                           report=self.reports.append, **kwargs)
+        return self.provisioner
+
+    def test_retries_when_rate_limited(self):
+        provisioner = self.create(rate=1000.0, burst=5)
+        self.matrix.errors.append(MatrixRequestError(429, '{"retry_after_ms": 50}'))
+        start = time.monotonic()
+        room = provisioner.create_room('a@example.com', 'A')
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+        self.assertEqual((room.room_id, room.topic, room.name), ('!1', 'a@example.com', 'A'))
+        self.assertEqual(self.matrix.created, ['a@example.com'])
+
+    def test_other_errors_are_raised(self):
+        provisioner = self.create()
+        self.matrix.errors.append(MatrixRequestError(403, 'forbidden'))
+        with self.assertRaises(MatrixRequestError):
+            provisioner.create_room('a@example.com')
+
+    def test_rate_limits_creations(self):
+        provisioner = self.create(concurrency=4, rate=20.0, burst=2)
+        start = time.monotonic()
+        jobs = [provisioner.request('{}@example.com'.format(i)) for i in range(4)]
+        for job in jobs:
+            self.assertTrue(job.done.wait(5))
+        # Two rooms in the burst, then two more at 20/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(self.matrix.created), 4)
+
+    def test_concurrent_requests_are_deduplicated(self):
+        provisioner = self.create(concurrency=2)
+        self.matrix.gate.clear()
+        first = provisioner.request('a@example.com', 'A')
+        second = provisioner.request('a@example.com', 'A', priority=5)
+        self.assertIs(first, second)
+        self.assertEqual(provisioner.pending_count(), 1)
+
+        rooms = []
+        waiters = [threading.Thread(target=lambda: rooms.append(provisioner.wait_for('a@example.com', 5)))
+                   for _i in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        self.matrix.gate.set()
+        for waiter in waiters:
+            waiter.join(5)
+
+        self.assertEqual(self.matrix.created, ['a@example.com'])
+        self.assertEqual(len(rooms), 3)
+        self.assertTrue(all(room is first.room for room in rooms))
+        self.assertIs(self.created['a@example.com'], first.room)
+        self.assertFalse(provisioner.is_pending('a@example.com'))
+
+    def test_waited_for_rooms_go_first(self):
+        provisioner = self.create(concurrency=1)
+        self.matrix.gate.clear()
+        provisioner.request('busy@example.com')
+        # Wait for the worker to pick up the first job, so the rest stay queued
+        deadline = time.monotonic() + 5
+        while not provisioner.jobs['busy@example.com'].started and time.monotonic() < deadline:
+            time.sleep(0.005)
+        provisioner.request('low@example.com', priority=1)
+        provisioner.request('urgent@example.com')
+        waiter = threading.Thread(target=provisioner.wait_for, args=('urgent@example.com', 5))
+        waiter.start()
+        deadline = time.monotonic() + 5
+        while provisioner.jobs['urgent@example.com'].priority < 1000 and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.matrix.gate.set()
+        waiter.join(5)
+        self.assertEqual(self.matrix.created[:2], ['busy@example.com', 'urgent@example.com'])
+
+    def test_wait_for_times_out(self):
+        provisioner = self.create()
+        self.matrix.gate.clear()
+        provisioner.request('a@example.com')
+        self.assertIsNone(provisioner.wait_for('a@example.com', 0.05))
+        self.assertIsNone(provisioner.wait_for('unknown@example.com', 0.05))
+
+    def test_failed_creation(self):
+        provisioner = self.create()
+        self.matrix.errors.append(MatrixRequestError(500, 'oops'))
+        job = provisioner.request('a@example.com')
+        self.assertTrue(job.done.wait(5))
+        self.assertIsNone(job.room)
+        self.assertEqual(self.created, {})
+        # Progress is reported after waiters are woken up
+        deadline = time.monotonic() + 5
+        while not self.reports and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(self.reports[-1].startswith('Created 0 of 1 rooms'))
+        self.assertIn('(1 failed)', self.reports[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
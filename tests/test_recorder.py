@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+from mxpp.recorder import TrafficRecorder
+from mxpp.rooms import DIRECT_ROOM, GROUPCHAT_ROOM, RoomRegistry
+
+try:
+    from mxpp.bench.replay import Replay, load_recording
+except ImportError:
+    # The replay driver runs a whole BridgeBot, so it needs the XMPP library
+    Replay = load_recording = None
+
+Jid = namedtuple('Jid', ['bare', 'resource'])
+
+
+def stanza(**items) -> dict:
+    return items
+
+
+class RecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, anonymise: bool, salt: str='salt'):
+        recorder = TrafficRecorder(self.path, anonymise=anonymise, salt=salt, own_nick='bot')
+        recorder.record_xmpp('message', stanza(type='chat', body='héllo', **{'from': Jid('a@example.com', 'phone')}))
+        recorder.record_xmpp('message', stanza(type='groupchat', body='hi',
+                                               **{'from': Jid('room@muc.example.com', 'alice')}))
+        recorder.record_xmpp('message', stanza(type='groupchat', body='echo',
+                                               **{'from': Jid('room@muc.example.com', 'bot')}))
+        recorder.record_xmpp('presence_unavailable', stanza(**{'from': Jid('a@example.com', 'phone')}))
+        recorder.record_xmpp('roster_update', stanza(type='set', roster={'items': {'b@example.com': {
+            'subscription': 'both'}}}))
+        recorder.record_xmpp('roster_update', stanza(type='result', roster={'items': {'a@example.com': {},
+                                                                                      'b@example.com': {}}}))
+        recorder.record_matrix({'type': 'm.room.message', 'content': {'body': 'reply'}}, DIRECT_ROOM,
+                               'a@example.com', own=False)
+        recorder.record_matrix({'type': 'm.room.message', 'content': {'body': 'x'}}, 'control', None, own=True)
+        self.assertEqual(recorder.recorded, 8)
+        recorder.close()
+        with open(self.path) as recording:
+            return [json.loads(line) for line in recording]
+
+    def strip_times(self, events):
+        for event in events:
+            self.assertGreaterEqual(event.pop('t'), 0)
+        return events
+
+    def test_records_without_bodies(self):
+        header, *events = self.record(anonymise=False)
+        self.assertEqual((header['v'], header['anon']), (1, False))
+        self.assertEqual(self.strip_times(events), [
+            {'s': 'x', 'e': 'message', 'y': 'chat', 'f': 'a@example.com', 'n': 6},
+            {'s': 'x', 'e': 'message', 'y': 'groupchat', 'f': 'room@muc.example.com', 'n': 2, 'nick': 'alice'},
+            {'s': 'x', 'e': 'message', 'y': 'groupchat', 'f': 'room@muc.example.com', 'n': 4, 'o': 1},
+            {'s': 'x', 'e': 'presence', 'y': 'unavailable', 'f': 'a@example.com'},
+            {'s': 'x', 'e': 'roster', 'y': 'set', 'i': [['b@example.com', 'both']]},
+            {'s': 'x', 'e': 'roster', 'y': 'result', 'c': 2},
+            {'s': 'm', 'e': 'm.room.message', 'k': DIRECT_ROOM, 'f': 'a@example.com', 'n': 5},
+            {'s': 'm', 'e': 'm.room.message', 'k': 'control', 'o': 1, 'n': 1},
+        ])
+        with open(self.path) as recording:
+            self.assertNotIn('héllo', recording.read())
+
+    def test_anonymised_names_are_consistent(self):
+        _header, *events = self.record(anonymise=True)
+        with open(self.path) as recording:
+            text = recording.read()
+        for name in ('a@example.com', 'b@example.com', 'room@muc.example.com', 'alice'):
+            self.assertNotIn(name, text)
+        self.assertEqual(events[0]['f'], events[3]['f'])
+        self.assertEqual(events[0]['f'], events[6]['f'])
+        self.assertNotEqual(events[0]['f'], events[4]['i'][0][0])
+
+        # Same salt, same pseudonyms
+        os.remove(self.path)
+        _header, *again = self.record(anonymise=True)
+        self.assertEqual(again[0]['f'], events[0]['f'])
+        os.remove(self.path)
+        _header, *other = self.record(anonymise=True, salt='other')
+        self.assertNotEqual(other[0]['f'], events[0]['f'])
+
+    def test_writes_after_close_are_dropped(self):
+        recorder = TrafficRecorder(self.path, anonymise=False)
+        recorder.close()
+        recorder.event('x', 'message')
+        with open(self.path) as recording:
+            self.assertEqual(len(recording.readlines()), 1)
+
+
+class FakeXMPP:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, jid, body, mtype):
+        self.sent.append(('message', jid, body, mtype))
+
+    def send_presence(self, jid, available):
+        self.sent.append(('presence', jid, available))
+
+    def send_roster_push(self, items):
+        self.sent.append(('roster', items))
+
+
+class FakeMatrix:
+    def __init__(self):
+        self.sent = []
+
+    def inject_message(self, room_id, sender, body):
+        self.sent.append((room_id, body))
+
+
+class FakeBot:
+    def __init__(self):
+        self.rooms = RoomRegistry('MUC: ', ['control'])
+
+    def special_room(self, topic):
+        entry = self.rooms.by_topic(topic)
+        return namedtuple('Room', ['room_id'])(entry.room_id) if entry is not None else None
+
+
+@unittest.skipIf(Replay is None, 'the replay driver needs sleekxmpp')
+class ReplayTest(unittest.TestCase):
+    EVENTS = [
+        {'t': 0.0, 's': 'x', 'e': 'message', 'y': 'chat', 'f': 'aaa', 'n': 20},
+        {'t': 0.1, 's': 'x', 'e': 'message', 'y': 'groupchat', 'f': 'mmm', 'nick': 'nnn', 'n': 5},
+        {'t': 0.2, 's': 'x', 'e': 'message', 'y': 'groupchat', 'f': 'mmm', 'o': 1, 'n': 5},
+        {'t': 0.3, 's': 'x', 'e': 'presence', 'y': 'available', 'f': 'bbb'},
+        {'t': 0.4, 's': 'x', 'e': 'roster', 'y': 'set', 'i': [['ccc', 'both']]},
+        {'t': 0.5, 's': 'm', 'e': 'm.room.message', 'k': DIRECT_ROOM, 'f': 'aaa', 'n': 3},
+        {'t': 0.6, 's': 'm', 'e': 'm.room.message', 'k': 'control', 'n': 7},
+        {'t': 0.7, 's': 'm', 'e': 'm.room.member', 'k': DIRECT_ROOM, 'f': 'aaa'},
+    ]
+
+    def test_roster_and_groupchats(self):
+        replay = Replay({'v': 1, 'anon': True}, self.EVENTS)
+        self.assertEqual(replay.groupchats, {'mmm'})
+        self.assertEqual(replay.roster, [('aaa@replay.local', 'aaa'), ('bbb@replay.local', 'bbb'),
+                                         ('ccc@replay.local', 'ccc')])
+        self.assertEqual(Replay({'v': 1, 'anon': False}, []).jid('a@example.com'), 'a@example.com')
+
+    def test_send(self):
+        replay = Replay({'v': 1, 'anon': True}, self.EVENTS)
+        bot, matrix, xmpp = FakeBot(), FakeMatrix(), FakeXMPP()
+        bot.rooms.add('aaa@replay.local', '!a')
+        bot.rooms.add('control', '!c')
+        categories = [replay.send(i, event, bot, matrix, xmpp) for i, event in enumerate(self.EVENTS)]
+        self.assertEqual(categories, ['xmpp_chat', 'xmpp_groupchat', None, 'xmpp_presence', 'xmpp_roster',
+                                      'matrix_message', 'matrix_special', None])
+        self.assertEqual(xmpp.sent, [
+            ('message', 'aaa@replay.local/replay', 'replay-0 ' + 'x' * 11, 'chat'),
+            ('message', 'mmm@muc.replay.local/nnn', 'replay-1 ', 'groupchat'),
+            ('presence', 'bbb@replay.local/replay', True),
+            ('roster', [('ccc@replay.local', 'both')]),
+        ])
+        self.assertEqual(matrix.sent, [('!a', 'replay-5 '), ('!c', 'replay-6 ')])
+
+    def test_load_recording(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'traffic.jsonl')
+        with open(path, 'w') as recording:
+            recording.write('{"v": 1, "anon": true}\n' + json.dumps(self.EVENTS[0]) + '\n\n')
+        self.assertEqual(load_recording(path), ({'v': 1, 'anon': True}, self.EVENTS[:1]))
+        with open(path, 'w') as recording:
+            recording.write(json.dumps(self.EVENTS[0]) + '\n')
+        with self.assertRaises(ValueError):
+            load_recording(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
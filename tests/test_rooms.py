@@ -0,0 +1,65 @@
+import unittest
+
+from mxpp.rooms import DIRECT_ROOM, GROUPCHAT_ROOM, SPECIAL_ROOM, RoomEntry, RoomRegistry
+
+
+class RoomRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.rooms = RoomRegistry('MUC: ', ['control', 'all-chat'])
+
+    def test_kinds(self):
+        self.assertEqual(self.rooms.add('a@example.com', '!a'), RoomEntry('a@example.com', '!a', DIRECT_ROOM,
+                                                                          'a@example.com'))
+        self.assertEqual(self.rooms.add('MUC: m@muc.example.com', '!m'),
+                         RoomEntry('MUC: m@muc.example.com', '!m', GROUPCHAT_ROOM, 'm@muc.example.com'))
+        self.assertEqual(self.rooms.add('control', '!c'), RoomEntry('control', '!c', SPECIAL_ROOM, None))
+
+        self.assertEqual(self.rooms.by_jid('m@muc.example.com', GROUPCHAT_ROOM).room_id, '!m')
+        self.assertIsNone(self.rooms.by_jid('m@muc.example.com'))
+        self.assertEqual(self.rooms.topic('m@muc.example.com', GROUPCHAT_ROOM), 'MUC: m@muc.example.com')
+        self.assertEqual(self.rooms.jids(), ['a@example.com'])
+        self.assertEqual(self.rooms.room_ids(), {'!a', '!m', '!c'})
+        self.assertEqual((self.rooms.count(), self.rooms.count(SPECIAL_ROOM)), (3, 1))
+
+    def test_new_room_for_topic_replaces_old_one(self):
+        self.rooms.add('a@example.com', '!old')
+        self.rooms.add('a@example.com', '!new')
+        self.assertEqual(self.rooms.by_topic('a@example.com').room_id, '!new')
+        self.assertEqual(self.rooms.by_jid('a@example.com').room_id, '!new')
+        self.assertIsNone(self.rooms.by_room_id('!old'))
+        self.assertEqual(self.rooms.count(), 1)
+
+    def test_renamed_topic(self):
+        # The room's topic changed to another JID: the old topic and JID no longer find it
+        self.rooms.add('a@example.com', '!a')
+        self.rooms.add('b@example.com', '!a')
+        self.assertIsNone(self.rooms.by_topic('a@example.com'))
+        self.assertIsNone(self.rooms.by_jid('a@example.com'))
+        self.assertEqual(self.rooms.by_room_id('!a').topic, 'b@example.com')
+        self.assertEqual(self.rooms.by_jid('b@example.com').room_id, '!a')
+        self.assertEqual(self.rooms.count(), 1)
+
+    def test_direct_room_turned_groupchat(self):
+        self.rooms.add('m@muc.example.com', '!m')
+        self.rooms.add('MUC: m@muc.example.com', '!m')
+        self.assertIsNone(self.rooms.by_jid('m@muc.example.com'))
+        self.assertEqual(self.rooms.by_jid('m@muc.example.com', GROUPCHAT_ROOM).room_id, '!m')
+        self.assertEqual(self.rooms.jids(), [])
+
+    def test_remove(self):
+        self.rooms.add('a@example.com', '!a')
+        self.rooms.add('b@example.com', '!b')
+        self.assertEqual(self.rooms.remove('a@example.com').room_id, '!a')
+        self.assertIsNone(self.rooms.remove('a@example.com'))
+        self.assertIsNone(self.rooms.by_topic('a@example.com'))
+        self.assertIsNone(self.rooms.by_room_id('!a'))
+        self.assertIsNone(self.rooms.by_jid('a@example.com'))
+        self.assertEqual(self.rooms.entries(), [RoomEntry('b@example.com', '!b', DIRECT_ROOM, 'b@example.com')])
+
+        # The room ID can be reused for another topic afterwards
+        self.rooms.add('c@example.com', '!a')
+        self.assertEqual(self.rooms.by_room_id('!a').jid, 'c@example.com')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from mxpp.roster import RosterItem, diff_roster
+
+
+def roster_iq(iq_type: str, items: dict, version: str=''):
+    """
+    :param items: {jid: (name, subscription)}
+    :return: Stand-in for a jabber:iq:roster stanza, as far as diff_roster looks at it
+    """
+    return {
+        'type': iq_type,
+        'roster': {
+            'items': {jid: {'name': name, 'subscription': subscription}
+                      for jid, (name, subscription) in items.items()},
+            'ver': version,
+        },
+    }
+
+
+KNOWN = {
+    'a@example.com': RosterItem('A', 'both'),
+    'b@example.com': RosterItem('B', 'to'),
+}
+
+
+class DiffRosterTest(unittest.TestCase):
+    def test_full_result(self):
+        diff = diff_roster(KNOWN, roster_iq('result', {'a@example.com': ('A', 'both'),
+                                                       'c@example.com': ('C', 'from')}, 'v2'))
+        self.assertEqual(diff.changed, {'c@example.com': RosterItem('C', 'from')})
+        self.assertEqual(diff.removed, ['b@example.com'])
+        self.assertEqual(diff.version, 'v2')
+        self.assertTrue(diff.full)
+
+    def test_empty_versioned_result_means_no_changes(self):
+        diff = diff_roster(KNOWN, roster_iq('result', {}), known_version='v1')
+        self.assertEqual((diff.changed, diff.removed, diff.full), ({}, [], False))
+
+    def test_empty_result_without_version_clears_roster(self):
+        diff = diff_roster(KNOWN, roster_iq('result', {}))
+        self.assertTrue(diff.full)
+        self.assertEqual(sorted(diff.removed), sorted(KNOWN))
+
+    def test_push(self):
+        diff = diff_roster(KNOWN, roster_iq('set', {'a@example.com': ('Alice', 'both'),
+                                                    'b@example.com': ('B', 'remove'),
+                                                    'z@example.com': ('Z', 'remove')}, 'v3'), 'v2')
+        self.assertEqual(diff.changed, {'a@example.com': RosterItem('Alice', 'both')})
+        # Removing a JID we didn't have is not a change
+        self.assertEqual(diff.removed, ['b@example.com'])
+        self.assertFalse(diff.full)
+        self.assertEqual(diff.version, 'v3')
+
+    def test_unchanged_item(self):
+        diff = diff_roster(KNOWN, roster_iq('set', {'a@example.com': ('A', 'both')}))
+        self.assertEqual((diff.changed, diff.removed, diff.version), ({}, [], None))
+
+
+if __name__ == '__main__':
+    unittest.main()
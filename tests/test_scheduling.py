@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mxpp.scheduling import CHAT, GROUPCHAT, PRESENCE, ROSTER, ClassedBuffer, ClassScheduler
+
+
+class ClassSchedulerTest(unittest.TestCase):
+    def test_strict_priority(self):
+        scheduler = ClassScheduler(3, max_skips=100)
+        self.assertEqual(scheduler.pick([False, True, True]), 1)
+        self.assertEqual(scheduler.pick([True, True, True]), 0)
+        self.assertIsNone(scheduler.pick([False, False, False]))
+
+    def test_bulk_class_runs_under_sustained_flood(self):
+        scheduler = ClassScheduler(4, max_skips=4)
+        picks = [scheduler.pick([True, False, False, True]) for _i in range(50)]
+        # The bulk class gets every (max_skips + 1)th turn, however long the flood lasts
+        self.assertEqual(picks[:5], [0, 0, 0, 0, 3])
+        self.assertEqual(picks.count(3), 10)
+        self.assertNotIn(1, picks)
+
+    def test_skips_reset_when_class_is_idle(self):
+        scheduler = ClassScheduler(2, max_skips=2)
+        scheduler.pick([True, True])
+        scheduler.pick([True, False])
+        self.assertEqual(scheduler.skips[1], 0)
+
+
+class ClassedBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.buffer.close()
+        shutil.rmtree(self.directory)
+
+    def create(self, **kwargs) -> ClassedBuffer:
+        # Items are (class, text)
+        self.buffer = ClassedBuffer(os.path.join(self.directory, 'spill'),
+                                    lambda item: item[0],
+                                    lambda item: '{}:{}'.format(*item),
+                                    lambda data: (int(data.split(':', 1)[0]), data.split(':', 1)[1]),
+                                    **kwargs)
+        return self.buffer
+
+    def pop_all(self):
+        items = []
+        while True:
+            found, queued = self.buffer.pop()
+            if not found:
+                return items
+            items.append(queued)
+
+    def test_fifo_within_class_and_priority_between(self):
+        buffer = self.create()
+        for i in range(3):
+            buffer.push((PRESENCE, 'p{}'.format(i)))
+            buffer.push((CHAT, 'c{}'.format(i)))
+        buffer.push((ROSTER, 'r0'))
+
+        queued = self.pop_all()
+        self.assertEqual([q.event[1] for q in queued], ['c0', 'c1', 'c2', 'p0', 'p1', 'p2', 'r0'])
+        self.assertEqual([q.cls for q in queued], [CHAT] * 3 + [PRESENCE] * 3 + [ROSTER])
+        self.assertTrue(all(q.received > 0 for q in queued))
+
+    def test_bulk_class_is_not_starved(self):
+        buffer = self.create(max_skips=3)
+        for i in range(5):
+            buffer.push((ROSTER, 'r{}'.format(i)))
+        served = []
+        # A steady flood of chat: one new message for every one served
+        for i in range(40):
+            buffer.push((CHAT, 'c{}'.format(i)))
+            _found, queued = buffer.pop()
+            served.append(queued.event[1])
+
+        roster = [item for item in served if item.startswith('r')]
+        self.assertEqual(roster, ['r0', 'r1', 'r2', 'r3', 'r4'])
+        chat = [item for item in served if item.startswith('c')]
+        self.assertEqual(chat, ['c{}'.format(i) for i in range(len(chat))])
+
+    def test_fifo_within_class_across_spill(self):
+        buffer = self.create(memory_budget=4 * 20)
+        for i in range(10):
+            buffer.push((GROUPCHAT, 'g{}'.format(i)))
+        self.assertGreater(buffer.stats()['on_disk'], 0)
+        self.assertEqual([q.event[1] for q in self.pop_all()], ['g{}'.format(i) for i in range(10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
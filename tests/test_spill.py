@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mxpp.spill import SpillBuffer, SpillQueue
+
+
+def identity(item):
+    return item
+
+
+class SpillBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spill')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, memory_budget: int=10) -> SpillBuffer:
+        return SpillBuffer(self.path, identity, identity, memory_budget=memory_budget)
+
+    def drain(self, buffer: SpillBuffer):
+        items = []
+        while True:
+            found, item = buffer.pop()
+            if not found:
+                return items
+            items.append(item)
+
+    def test_spills_over_budget_in_order(self):
+        buffer = self.open()
+        for item in ['aaaa', 'bbbb', 'cccc', 'dd', 'e']:
+            buffer.push(item)
+        stats = buffer.stats()
+        self.assertEqual((stats['in_memory'], stats['on_disk']), (2, 3))
+        self.assertEqual(len(buffer), 5)
+        # Once something is on disk, small items go there too, to keep the order
+        self.assertEqual(self.drain(buffer), ['aaaa', 'bbbb', 'cccc', 'dd', 'e'])
+        self.assertEqual(os.path.getsize(self.path), 0)
+        buffer.close()
+
+    def test_none_stays_in_memory(self):
+        buffer = self.open(memory_budget=0)
+        buffer.push(None)
+        self.assertEqual(buffer.stats()['on_disk'], 0)
+        self.assertEqual(buffer.pop(), (True, None))
+        buffer.close()
+
+    def test_close_saves_items_for_next_buffer(self):
+        buffer = self.open()
+        for item in ['aaaa', 'bbbb', 'cccc', 'dddd']:
+            buffer.push(item)
+        self.assertEqual(buffer.pop(), (True, 'aaaa'))
+        buffer.close()
+        buffer.push('late')
+
+        reopened = self.open()
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual(self.drain(reopened), ['bbbb', 'cccc', 'dddd'])
+        reopened.close()
+
+    def test_skips_torn_write(self):
+        with open(self.path, 'w') as spill_file:
+            spill_file.write('"one"\n"tw')
+        buffer = self.open()
+        self.assertEqual(self.drain(buffer), ['one'])
+        buffer.close()
+
+
+class SpillQueueTest(unittest.TestCase):
+    def test_get_blocks_until_put(self):
+        directory = tempfile.mkdtemp()
+        try:
+            queue = SpillQueue(SpillBuffer(os.path.join(directory, 'spill'), identity, identity))
+            got = []
+            consumer = threading.Thread(target=lambda: got.append(queue.get()))
+            consumer.start()
+            queue.put('item')
+            consumer.join(5)
+            self.assertEqual(got, ['item'])
+            queue.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mxpp.mam import Checkpoint
+from mxpp.roster import RosterItem
+from mxpp.state import StateStore
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.db')
+        self.store = StateStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self) -> StateStore:
+        self.store.close()
+        self.store = StateStore(self.path)
+        return self.store
+
+    def test_rooms_survive_restart(self):
+        self.store.set_room('a@example.com', '!a')
+        self.store.set_room('MUC: m@muc.example.com', '!m')
+        self.store.set_special_room('control', '!c')
+        self.store.set_room_name('!a', 'Alice')
+        self.store.add_groupchat('m@muc.example.com')
+        self.store.add_groupchat('m@muc.example.com')
+
+        store = self.reopen()
+        self.assertEqual(store.get_room_map(), {'a@example.com': '!a', 'MUC: m@muc.example.com': '!m'})
+        self.assertEqual(store.get_special_rooms(), {'control': '!c'})
+        self.assertEqual(store.get_room_names(), {'!a': 'Alice'})
+        self.assertEqual(store.get_groupchat_jids(), ['m@muc.example.com'])
+
+    def test_set_room_replaces_topic(self):
+        self.store.set_room('a@example.com', '!old')
+        self.store.set_room('a@example.com', '!new')
+        self.assertEqual(self.store.get_room_map(), {'a@example.com': '!new'})
+
+    def test_remove(self):
+        self.store.set_room('a@example.com', '!a')
+        self.store.set_room('b@example.com', '!b')
+        self.store.set_room_name('!b', 'Bob')
+        self.store.remove_room('a@example.com')
+        self.store.remove_room_id('!b')
+        self.assertEqual(self.store.get_room_map(), {})
+        self.assertEqual(self.store.get_room_names(), {})
+
+        self.store.add_groupchat('m@muc.example.com')
+        self.store.set_muc_history('m@muc.example.com', 1.0, ['k1', 'k2'])
+        self.assertEqual(self.store.get_muc_history(), {'m@muc.example.com': (1.0, ['k1', 'k2'])})
+        self.store.remove_groupchat('m@muc.example.com')
+        self.assertEqual((self.store.get_groupchat_jids(), self.store.get_muc_history()), ([], {}))
+
+    def test_roster_and_version(self):
+        self.assertIsNone(self.store.roster_version)
+        self.store.update_roster({'a@example.com': RosterItem('Alice', 'both'),
+                                  'b@example.com': RosterItem('', 'to')}, [], 'v1')
+        self.store.update_roster({'a@example.com': RosterItem('Al', 'both')}, ['b@example.com'], 'v2')
+        store = self.reopen()
+        self.assertEqual(store.get_roster(), {'a@example.com': RosterItem('Al', 'both')})
+        self.assertEqual(store.roster_version, 'v2')
+
+    def test_checkpoints_and_values(self):
+        self.store.set_checkpoint('a@example.com', Checkpoint(1.5, 'x'))
+        self.store.set_virtual_user('a@example.com', 'Alice')
+        self.store.sync_token = 's1'
+        store = self.reopen()
+        self.assertEqual(store.get_checkpoints(), {'a@example.com': Checkpoint(1.5, 'x')})
+        self.assertEqual(store.get_virtual_users(), {'a@example.com': 'Alice'})
+        self.assertEqual(store.sync_token, 's1')
+        self.assertEqual(store.get_value('missing', 'default'), 'default')
+        store.remove_checkpoint('a@example.com')
+        self.assertEqual(store.get_checkpoints(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
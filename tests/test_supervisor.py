@@ -0,0 +1,88 @@
+import threading
+import unittest
+from unittest import mock
+
+from mxpp.supervisor import Backoff, ComponentSupervisor
+
+
+class BackoffTest(unittest.TestCase):
+    def test_grows_to_maximum(self):
+        backoff = Backoff(initial=1, maximum=5, factor=2)
+        self.assertEqual([backoff.next() for _i in range(5)], [1, 2, 4, 5, 5])
+
+    @mock.patch('time.monotonic')
+    def test_resets_after_stable_period(self, monotonic):
+        backoff = Backoff(initial=1, maximum=100, factor=2, reset_after=60)
+        monotonic.return_value = 0
+        self.assertEqual([backoff.next(), backoff.next()], [1, 2])
+        monotonic.return_value = 61
+        self.assertEqual(backoff.next(), 1)
+
+
+class ComponentSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.restarted = threading.Event()
+        self.errors = []
+
+    def create(self, restart) -> ComponentSupervisor:
+        supervisor = ComponentSupervisor('test', restart, Backoff(initial=0.01, maximum=0.01))
+        self.addCleanup(supervisor.stop)
+        return supervisor
+
+    def wait_until_idle(self, supervisor: ComponentSupervisor):
+        for _i in range(500):
+            with supervisor.lock:
+                if not supervisor.restarting:
+                    return
+            self.restarted.wait(0.01)
+        self.fail('Supervisor still restarting')
+
+    def test_restarts_failed_component(self):
+        def restart(error):
+            self.errors.append(error)
+            self.restarted.set()
+
+        supervisor = self.create(restart)
+        error = ConnectionError('lost')
+        supervisor.failed(error)
+        self.assertTrue(self.restarted.wait(5))
+        self.wait_until_idle(supervisor)
+        self.assertEqual((self.errors, supervisor.restarts), ([error], 1))
+
+    def test_failures_during_restart_are_merged(self):
+        gate = threading.Event()
+
+        def restart(error):
+            self.errors.append(error)
+            gate.wait(5)
+
+        supervisor = self.create(restart)
+        supervisor.failed(ConnectionError('first'))
+        supervisor.failed(ConnectionError('second'))
+        gate.set()
+        self.wait_until_idle(supervisor)
+        self.assertEqual([str(e) for e in self.errors], ['first'])
+        self.assertEqual(supervisor.restarts, 1)
+
+    def test_failed_restart_is_retried(self):
+        def restart(error):
+            self.errors.append(error)
+            if len(self.errors) < 3:
+                raise ConnectionError('still down {}'.format(len(self.errors)))
+
+        supervisor = self.create(restart)
+        supervisor.failed(ConnectionError('lost'))
+        self.wait_until_idle(supervisor)
+        self.assertEqual([str(e) for e in self.errors], ['lost', 'still down 1', 'still down 2'])
+        self.assertEqual(supervisor.restarts, 1)
+
+    def test_stopped_supervisor_does_not_restart(self):
+        supervisor = self.create(self.errors.append)
+        supervisor.stop()
+        supervisor.failed(ConnectionError('lost'))
+        self.assertFalse(supervisor.restarting)
+        self.assertEqual(self.errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()